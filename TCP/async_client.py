@@ -0,0 +1,164 @@
+# Description: asyncio download engine for the TCP client.
+# It speaks the same CHUNK/REQUEST protocol as the threaded engine in client.py, so it works
+# against the unchanged server.py. Every chunk is a task inside a TaskGroup: a failing chunk
+# cancels its siblings, and cancelling the download (Ctrl+C) closes every open connection.
+import asyncio
+import os
+import signal
+import time
+
+NUM_OF_CHUNKS = 4
+MAX_RETRIES = 3
+MAX_CONNECTIONS = 64  # Upper bound of open data connections across all files
+BUFFER_SIZE = 1024 * 64
+FORMAT = "utf-8"
+CONNECT_TIMEOUT = 5.0  # seconds
+READ_TIMEOUT = 10.0  # seconds without any data before the connection is retried
+
+
+class DownloadCancelled(Exception):
+    """Raised when a download is interrupted by the user."""
+
+
+def split_chunks(file_size, num_chunks=NUM_OF_CHUNKS):
+    """Split a file into (offset, size) ranges, the last one taking the remainder."""
+    num_chunks = max(1, num_chunks)
+    chunk_size = file_size // num_chunks
+    ranges = [(i * chunk_size, chunk_size) for i in range(num_chunks)]
+    offset, size = ranges[-1]
+    ranges[-1] = (offset, file_size - offset)
+    return ranges
+
+
+def display_progress(progress, filename):
+    progress_str = []
+
+    for part_id, (downloaded, total) in enumerate(progress):
+        percent_complete = (downloaded / total) * 100 if total > 0 else 100
+        progress_str.append(f"Chunk {part_id + 1} ... {percent_complete:.1f}%")
+
+    print(f"\rDownloading {filename}: " + " | ".join(progress_str), end="")
+
+
+async def close_writer(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+def new_stats():
+    """Counters filled in by a download: retries and monotonic time of the first data byte."""
+    return {"retries": 0, "first_byte": None}
+
+
+async def download_chunk(addr, filename, path, order, offset, size, progress, limiter, quiet=False, stats=None):
+    """Download one range straight into its place in the output file, resuming on retry."""
+    received = 0
+    retry_count = 0
+
+    while received < size:
+        try:
+            async with limiter:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*addr), CONNECT_TIMEOUT)
+                try:
+                    request = f"CHUNK {order}\nREQUEST {filename} {offset + received} {size - received}\n"
+                    writer.write(request.encode(FORMAT))
+                    await writer.drain()
+
+                    with open(path, "r+b") as f:
+                        f.seek(offset + received)
+                        while received < size:
+                            data = await asyncio.wait_for(reader.read(min(BUFFER_SIZE, size - received)), READ_TIMEOUT)
+                            if not data:
+                                raise ConnectionError("server closed the connection")
+                            if stats is not None and stats["first_byte"] is None:
+                                stats["first_byte"] = time.monotonic()
+
+                            f.write(data)
+                            received += len(data)
+                            progress[order - 1][0] = received
+                            if not quiet:
+                                display_progress(progress, filename)
+                finally:
+                    await close_writer(writer)
+
+        except (OSError, asyncio.TimeoutError) as e:
+            retry_count += 1
+            if stats is not None:
+                stats["retries"] += 1
+            if retry_count >= MAX_RETRIES:
+                raise ConnectionError(f"chunk {order} of {filename} failed: {e}") from e
+            if not quiet:
+                print(f"\nRetrying chunk {order} of {filename} from byte {offset + received}...")
+
+    return received
+
+
+async def download_file_async(addr, filename, file_size, output_dir, limiter=None, num_chunks=NUM_OF_CHUNKS, quiet=False,
+                              target=None, stats=None):
+    """Download a file over num_chunks parallel connections. Returns the number of bytes received.
+
+    The file is saved as output_dir/filename unless an explicit target path is given.
+    """
+    limiter = limiter or asyncio.Semaphore(MAX_CONNECTIONS)
+    path = target or os.path.join(output_dir, filename)
+
+    # Preallocate the output file so every chunk writes at its own offset, no merge step needed
+    with open(path, "wb") as f:
+        f.truncate(file_size)
+    if file_size == 0:
+        return 0
+
+    ranges = split_chunks(file_size, num_chunks)
+    progress = [[0, size] for _, size in ranges]
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(download_chunk(addr, filename, path, i + 1, offset, size, progress, limiter, quiet, stats))
+                     for i, (offset, size) in enumerate(ranges)]
+    except ExceptionGroup as e:
+        raise e.exceptions[0] from None
+
+    if not quiet:
+        print(f"\n{filename} downloaded successfully!\n")
+    return sum(task.result() for task in tasks)
+
+
+async def download_files_async(addr, files, output_dir, num_chunks=NUM_OF_CHUNKS, quiet=False):
+    """Download several files at once. files maps file name to size; returns name -> bytes or exception."""
+    limiter = asyncio.Semaphore(MAX_CONNECTIONS)
+    names = list(files)
+    results = await asyncio.gather(*(download_file_async(addr, name, files[name], output_dir, limiter, num_chunks, quiet)
+                                     for name in names), return_exceptions=True)
+    return dict(zip(names, results))
+
+
+async def run_cancellable(coro):
+    """Run coro, cancelling it (and so every chunk task) on SIGINT."""
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(coro)
+    previous = signal.getsignal(signal.SIGINT)
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+        installed = True
+    except (NotImplementedError, RuntimeError):
+        installed = False  # Not supported on Windows event loops, Ctrl+C raises KeyboardInterrupt instead
+
+    try:
+        return await task
+    except asyncio.CancelledError:
+        raise DownloadCancelled() from None
+    finally:
+        if installed:
+            loop.remove_signal_handler(signal.SIGINT)
+            signal.signal(signal.SIGINT, previous)
+
+
+def download_file(addr, filename, file_size, output_dir, num_chunks=NUM_OF_CHUNKS, quiet=False):
+    """Blocking entry point used by client.py."""
+    try:
+        return asyncio.run(run_cancellable(download_file_async(addr, filename, file_size, output_dir, None, num_chunks, quiet)))
+    except KeyboardInterrupt:
+        raise DownloadCancelled() from None
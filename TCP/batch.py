@@ -0,0 +1,194 @@
+# Description: Non-interactive batch client for schedulers and scripts.
+#
+#   python batch.py --host 10.0.0.5 manifest.txt --report report.json
+#
+# The manifest lists one file per line, optionally followed by the target path
+# ("LeagueClient.exe /data/lc.exe"), or is a JSON list of {"file": ..., "target": ...}.
+# The process exits with 0 if every file was downloaded, 1 if any failed and 2 on
+# usage or connection errors, and writes a JSON report (bytes, wall time,
+# throughput, retries and time to first byte per file).
+#
+# Like client.py, files whose local copy still matches the server (see cache.py) are not
+# downloaded again and are reported as "cached". Only targets named after their file are
+# indexed, in the .cache_index.json of their folder.
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import async_client
+from cache import CacheIndex, parse_stat
+from manifest import load_manifest
+
+PORT = 12345
+FORMAT = "utf-8"
+CUR_PATH = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_DIR = os.path.join(CUR_PATH, "output")
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+CACHE_HASH = False  # As in client.py: also record a whole-file hash on download
+
+
+class ControlConnection:
+    """The line based control connection (CONNECT, SIZE, ACK, EXIT) to server.py."""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.lock = asyncio.Lock()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.addr), async_client.CONNECT_TIMEOUT)
+        await self.request("CONNECT")
+
+    async def request(self, line, reply=True):
+        async with self.lock:
+            self.writer.write(f"{line}\n".encode(FORMAT))
+            await self.writer.drain()
+            if reply:
+                data = await asyncio.wait_for(self.reader.readline(), async_client.READ_TIMEOUT)
+                return data.decode(FORMAT).strip()
+
+    async def file_stat(self, filename):
+        """(size, mtime) of filename on the server, None if it does not have it."""
+        return parse_stat(await self.request(f"STAT {filename}"))
+
+    async def close(self):
+        with contextlib.suppress(OSError):
+            await self.request("EXIT", reply=False)
+            await async_client.close_writer(self.writer)
+
+
+class TargetCaches:
+    """The CacheIndex of every folder targets are downloaded into."""
+
+    def __init__(self):
+        self.indexes = {}
+
+    def get(self, filename, target):
+        """The index that can track target, None unless it is named after filename."""
+        folder, name = os.path.split(os.path.abspath(target))
+        if name != filename:
+            return None
+        if folder not in self.indexes:
+            self.indexes[folder] = CacheIndex(folder)
+        return self.indexes[folder]
+
+
+async def is_cached(control, cache, filename, size, mtime):
+    """True if the local copy in cache still matches the server's (size, mtime), asking for the
+    server's hash only when the index recorded one."""
+    if cache.is_valid(filename, size, mtime):
+        return True
+    if not (cache.entries.get(filename) or {}).get("hash"):
+        return False
+    server_hash = await control.request(f"HASH {filename}")
+    return cache.is_valid(filename, size, mtime, lambda name: server_hash)
+
+
+async def transfer(control, filename, target, limiter, num_chunks, caches):
+    result = {"file": filename, "target": target, "status": "failed", "bytes": 0, "size": None,
+              "wall_time": 0.0, "throughput": 0.0, "retries": 0, "ttfb": None, "error": None}
+    stats = async_client.new_stats()
+    start = time.monotonic()
+
+    try:
+        stat = await control.file_stat(filename)
+        if stat is None:
+            raise FileNotFoundError(f"{filename} is not available on the server")
+        size, mtime = stat
+        result["size"] = size
+
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        cache = caches.get(filename, target)
+        if cache is not None and await is_cached(control, cache, filename, size, mtime):
+            result["status"] = "cached"
+        else:
+            result["bytes"] = await async_client.download_file_async(control.addr, filename, size, None, limiter,
+                                                                     num_chunks, quiet=True, target=target, stats=stats)
+            if result["bytes"] != size:
+                raise ConnectionError(f"received {result['bytes']} of {size} bytes")
+            if cache is not None:
+                cache.add(filename, size, mtime, with_hash=CACHE_HASH)
+
+            result["status"] = "ok"
+            await control.request(f"ACK {filename}", reply=False)
+    except (OSError, asyncio.TimeoutError) as e:
+        result["error"] = str(e) or type(e).__name__
+
+    wall_time = time.monotonic() - start
+    result["wall_time"] = round(wall_time, 6)
+    result["throughput"] = round(result["bytes"] / wall_time, 1) if wall_time > 0 else 0.0
+    result["retries"] = stats["retries"]
+    if stats["first_byte"] is not None:
+        result["ttfb"] = round(stats["first_byte"] - start, 6)
+    return result
+
+
+async def run_batch(addr, entries, parallel=1, num_chunks=async_client.NUM_OF_CHUNKS):
+    """Download every (file, target) entry and return the report dict."""
+    control = ControlConnection(addr)
+    await control.open()
+
+    limiter = asyncio.Semaphore(async_client.MAX_CONNECTIONS)
+    slots = asyncio.Semaphore(max(1, parallel))
+    num_chunks = max(1, num_chunks)
+    caches = TargetCaches()
+
+    async def run_one(filename, target):
+        async with slots:
+            return await transfer(control, filename, target, limiter, num_chunks, caches)
+
+    start = time.monotonic()
+    try:
+        files = await asyncio.gather(*(run_one(filename, target) for filename, target in entries))
+    finally:
+        await control.close()
+    wall_time = time.monotonic() - start
+
+    total_bytes = sum(item["bytes"] for item in files)
+    return {
+        "server": f"{addr[0]}:{addr[1]}",
+        "transport": "tcp",
+        "files": files,
+        "total_bytes": total_bytes,
+        "wall_time": round(wall_time, 6),
+        "throughput": round(total_bytes / wall_time, 1) if wall_time > 0 else 0.0,
+        "retries": sum(item["retries"] for item in files),
+        "cached": sum(item["status"] == "cached" for item in files),
+        "failed": sum(item["status"] not in ("ok", "cached") for item in files),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download the files of a manifest without any prompt.")
+    parser.add_argument("manifest", help="text (file [target] per line) or .json manifest")
+    parser.add_argument("--host", required=True, help="server IP address")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--report", help="write the JSON report to this path instead of stdout")
+    parser.add_argument("--parallel", type=int, default=1, help="number of files downloaded at the same time")
+    parser.add_argument("--chunks", type=int, default=async_client.NUM_OF_CHUNKS, help="connections per file")
+    args = parser.parse_args(argv)
+
+    try:
+        entries = load_manifest(args.manifest, OUTPUT_DIR)
+        report = asyncio.run(run_batch((args.host, args.port), entries, args.parallel, args.chunks))
+    except (OSError, ValueError, KeyError, asyncio.TimeoutError) as e:
+        print(f"Batch failed: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    return EXIT_OK if report["failed"] == 0 else EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
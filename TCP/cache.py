@@ -0,0 +1,96 @@
+# Description: Persistent index of files already downloaded into the output folder.
+import json
+import os
+import hashlib
+
+INDEX_NAME = ".cache_index.json"
+HASH_BLOCK = 1024 * 1024
+
+
+def file_hash(path):
+    """Calculate the MD5 checksum of a whole file."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def parse_stat(reply):
+    """Parse a 'size mtime' STAT reply. Returns None if the server does not know the file."""
+    info = reply.split()
+    if len(info) != 2 or not info[0].isdigit():
+        return None
+    return int(info[0]), int(info[1])
+
+
+class CacheIndex:
+    """Maps server file names to the size, mtime and optional hash of the local copy."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_NAME)
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def local_path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def is_valid(self, filename, size, mtime, fetch_hash=None):
+        """Check whether the local copy of filename still matches the server's (size, mtime).
+
+        If only the mtime differs and fetch_hash is given, the server's hash is
+        fetched and compared with the one recorded at download time.
+        """
+        entry = self.entries.get(filename)
+        path = self.local_path(filename)
+        if entry is None or not os.path.isfile(path):
+            return False
+
+        # The local file must not have been touched since it was indexed
+        local = os.stat(path)
+        if local.st_size != entry["size"] or local.st_mtime_ns != entry["local_mtime"]:
+            return False
+
+        if entry["size"] != size:
+            return False
+        if entry["mtime"] == mtime:
+            return True
+
+        if fetch_hash is None or not entry.get("hash"):
+            return False
+        if fetch_hash(filename) != entry["hash"]:
+            return False
+
+        # Same content with a new server mtime, remember it to skip the hash next time
+        entry["mtime"] = mtime
+        self.save()
+        return True
+
+    def add(self, filename, size, mtime, with_hash=False):
+        """Record a completed download of filename."""
+        path = self.local_path(filename)
+        self.entries[filename] = {
+            "size": size,
+            "mtime": mtime,
+            "hash": file_hash(path) if with_hash else None,
+            "local_mtime": os.stat(path).st_mtime_ns,
+        }
+        self.save()
+
+    def remove(self, filename):
+        if self.entries.pop(filename, None) is not None:
+            self.save()
@@ -4,6 +4,8 @@ import os
 import time
 import sys
 import signal
+from cache import CacheIndex, parse_stat
+import async_client
 
 '''
 - Kết nối đến Server, nhận thông tin danh sách các file từ server và hiển thị trên màn hình.
@@ -14,13 +16,15 @@ yêu cầu server gửi từng chunk cho mỗi kết nối.
 dung lượng và mở file thành công)
 '''
 
-HOST = input("Enter the server IP address: ")
+HOST = socket.gethostbyname(socket.gethostname())
 PORT = 12345
 ADDR = (HOST, PORT)
 NUM_OF_CHUNKS = 4
 MAX_RETRIES = 3
 BUFFER_SIZE = 1024 * 4
 FORMAT = "utf-8"
+ENGINE = "asyncio"  # "asyncio" or "thread" (fallback)
+CACHE_HASH = False  # Also record a whole-file hash so a touched but unchanged server file is not downloaded again
 
 # Get the directory of the current script
 CUR_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -162,10 +166,22 @@ def download_file(filename, file_size):
     print(f"\n{filename} downloaded successfully!\n")
 
 
+# Function to ask the server for the size and modification time of a file
+def fetch_file_stat(client, filename):
+    client.send(f"STAT {filename}\n".encode(FORMAT))
+    return parse_stat(client.recv(BUFFER_SIZE).decode(FORMAT))
+
+
+def fetch_file_hash(client, filename):
+    client.send(f"HASH {filename}\n".encode(FORMAT))
+    return client.recv(BUFFER_SIZE).decode(FORMAT).strip()
+
+
 # Function to monitor the input file for new downloads
 def monitor_input_file(client, available_files):
     downloaded_files = set()
     unavailable_files = set()
+    cache = CacheIndex(OUTPUT_DIR)
     global is_running
 
     while is_running:
@@ -189,6 +205,15 @@ def monitor_input_file(client, available_files):
                         unavailable_files.add(filename)
                     continue  # Skip unavailable files
                 
+                # Skip files whose local copy still matches the server
+                stat = fetch_file_stat(client, filename)
+                if stat is not None:
+                    file_size, mtime = stat
+                    if cache.is_valid(filename, file_size, mtime, lambda name: fetch_file_hash(client, name)):
+                        print(f"{filename} is up to date, skipping download.\n")
+                        downloaded_files.add(filename)
+                        continue
+
                 print(f"Request to download {filename}... detected.")
                 
                 # Request the file size from the server
@@ -196,7 +221,18 @@ def monitor_input_file(client, available_files):
                 file_size = int(client.recv(BUFFER_SIZE).decode())
                 
                 # Download file
-                download_file(filename, file_size)
+                if ENGINE == "asyncio":
+                    try:
+                        async_client.download_file(ADDR, filename, file_size, OUTPUT_DIR)
+                    except async_client.DownloadCancelled:
+                        signal_handler(signal.SIGINT, None, client)
+                    except ConnectionError as e:
+                        print(f"\nError downloading {filename}: {e}")
+                        continue
+                else:
+                    download_file(filename, file_size)
+                if stat is not None and stat[0] == file_size:
+                    cache.add(filename, file_size, stat[1], with_hash=CACHE_HASH)
 
                 # Respond to the server that the file has been downloaded
                 client.send(f"ACK {filename}\n".encode())
@@ -211,7 +247,10 @@ def monitor_input_file(client, available_files):
 
 
 def main():
-    global is_running
+    global is_running, HOST, ADDR
+    
+    HOST = input("Enter the server IP address: ")
+    ADDR = (HOST, PORT)
     
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
         # Register signal handler for Ctrl+C
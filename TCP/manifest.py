@@ -0,0 +1,34 @@
+# Description: Manifest format of the batch clients, shared by TCP/batch.py and UDP/batch.py.
+#
+# One file per line, optionally followed by the target path ("LeagueClient.exe /data/lc.exe"),
+# or a JSON list of {"file": ..., "target": ...}. Only the standard library is imported, so
+# the UDP tree can load this module by path (see UDP/tcp_tree.py).
+import json
+import os
+
+
+def load_manifest(path, output_dir):
+    """Return a list of (file name on the server, local target path)."""
+    with open(path, "r") as f:
+        text = f.read()
+
+    entries = []
+    if path.endswith(".json"):
+        items = json.loads(text)
+        if not isinstance(items, list):
+            raise ValueError(f"{path}: a JSON manifest must be a list, not {type(items).__name__}")
+        for number, item in enumerate(items):
+            if isinstance(item, str):
+                item = {"file": item}
+            if not isinstance(item, dict) or not isinstance(item.get("file"), str):
+                raise ValueError(f"{path}: entry {number} must be a file name or a {{\"file\": ..., \"target\": ...}} "
+                                 f"object, not {item!r}")
+            entries.append((item["file"], item.get("target") or os.path.join(output_dir, item["file"])))
+    else:
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            info = line.split(maxsplit=1)
+            entries.append((info[0], info[1] if len(info) > 1 else os.path.join(output_dir, info[0])))
+    return entries
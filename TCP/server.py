@@ -3,6 +3,7 @@ import os
 import threading
 import signal
 import sys
+import hashlib
 
 HOST = socket.gethostbyname(socket.gethostname())
 PORT = 12345
@@ -40,6 +41,14 @@ def scanFiles():
             list.write(f"{file} {round(os.path.getsize(os.path.join(FOLDER, file)) / MB, 2)}MB\n")
         
 
+def getFileHash(file):
+    md5 = hashlib.md5()
+    with open(os.path.join(FOLDER, file), 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
 def sendFileChunk(client, file, offset, chunk):
     with open(os.path.join(FOLDER, file), 'rb') as f:
         totalSent = 0
@@ -80,6 +89,24 @@ def processClient(server, client, addr):
                     fileName = request.split()[1]
                     client.send(str(os.path.getsize(os.path.join(FOLDER, fileName))).encode(FORMAT) + delimiter.encode(FORMAT))
                     
+                elif request.startswith('STAT'):
+                    fileName = request.split()[1]
+                    path = os.path.join(FOLDER, fileName)
+                    if os.path.isfile(path):
+                        stat = os.stat(path)
+                        reply = f"{stat.st_size} {stat.st_mtime_ns}"
+                    else:
+                        reply = "NOTFOUND"
+                    client.send(reply.encode(FORMAT) + delimiter.encode(FORMAT))
+
+                elif request.startswith('HASH'):
+                    fileName = request.split()[1]
+                    if os.path.isfile(os.path.join(FOLDER, fileName)):
+                        reply = getFileHash(fileName)
+                    else:
+                        reply = "NOTFOUND"
+                    client.send(reply.encode(FORMAT) + delimiter.encode(FORMAT))
+
                 elif request.startswith('CHUNK'):
                     order = request.split()[1]
                     print(f"Connection from {addr} to download chunk {order}.")
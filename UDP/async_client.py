@@ -0,0 +1,254 @@
+# Description: asyncio download engine for the UDP client.
+#
+#   python async_client.py big.bin small.bin --host 10.0.0.5 --chunks 4 [--copies 50]
+#
+# Speaks the protocol of client_SR.py, so it works against server_SR.py and async_server.py.
+# Every byte range is a session of its own (its own socket, sequence space and congestion
+# controller on the server) and a task receiving straight into the memory-mapped output file
+# (see placement.py and async_rdt.py), so one process downloads hundreds of ranges at once
+# without a thread per range. --copies downloads every file that many times at once, which
+# makes it a load generator for servers. Transfer settings default to those of client_SR.
+import argparse
+import asyncio
+import os
+import sys
+import time
+import client_SR
+from async_rdt import AsyncReceiver, connect, disconnect
+from fec import FEC_CODES, FecDecoder, data_payload
+from placement import MappedRange, PlacedReceiver
+from pmtu import PROBE_ATTEMPTS, datagram_ceiling, probe_sizes, set_dont_fragment
+from utils import (DEFAULT_INTEGRITY, FORMAT, HEADER_SIZE, INTEGRITY_NAMES, MAX_PAYLOAD, MAX_RETRIES, file_checksum,
+                   make_packet, set_integrity)
+
+NUM_OF_CHUNKS = 4
+MAX_SESSIONS = 256  # Sessions (sockets) open at once across all downloads
+MESSAGE_ATTEMPTS = 8  # Timeouts before a request is given up, about a minute with backoff
+REPLY_TIMEOUT = 30.0  # seconds to wait for the answer of an acknowledged request
+
+# Payload size found to cross the path unfragmented, per server address
+path_payloads = {}
+
+
+async def discover_payload_size(peer):
+    """pmtu.discover_payload_size on a Peer. Returns None if not even the smallest probe was acknowledged."""
+    dont_fragment = set_dont_fragment(peer.socket)
+    try:
+        for size in probe_sizes(datagram_ceiling(peer.addr)):
+            padding = size - HEADER_SIZE - len(b"PROBE \n")
+            probe = make_packet(0, b"PROBE " + b"x" * padding + b"\n")
+            # The transport reports EMSGSIZE to error_received, so a probe over the MTU times out
+            if await peer.send(probe, max_attempts=PROBE_ATTEMPTS) == 1:
+                return size - HEADER_SIZE
+        return None
+    finally:
+        if dont_fragment:
+            set_dont_fragment(peer.socket, False)
+
+
+async def open_session(peer, integrity=None):
+    """Handshake with the server and negotiate the integrity scheme of the session, in the
+    context of the calling task. Returns the welcome message or None on failure."""
+    integrity = integrity or client_SR.INTEGRITY
+    if integrity not in INTEGRITY_NAMES:
+        raise ValueError(f"unknown integrity scheme {integrity}")
+
+    set_integrity(DEFAULT_INTEGRITY, session=True)
+    if await peer.send(make_packet(0, f"CONNECT {integrity}".encode()), max_attempts=MAX_RETRIES) != 1:
+        return None
+    welcome = await asyncio.wait_for(peer.receive(), REPLY_TIMEOUT)
+
+    lines = welcome.decode().splitlines()
+    if lines and lines[-1].startswith("INTEGRITY"):
+        set_integrity(INTEGRITY_NAMES[lines.pop().split()[1]], session=True)
+
+    if client_SR.PATH_MTU_DISCOVERY and peer.addr not in path_payloads:
+        payload_size = await discover_payload_size(peer)
+        if payload_size is not None:
+            path_payloads[peer.addr] = payload_size
+    return "\n".join(lines)
+
+
+async def close_session(peer):
+    return await peer.send(make_packet(0, "EXIT\n".encode()), max_attempts=MAX_RETRIES) == 1
+
+
+async def fetch(peer, request):
+    """Send a request line, returns the answer or None if the request was not acknowledged."""
+    if await peer.send(make_packet(0, f"{request}\n".encode(FORMAT)), max_attempts=MESSAGE_ATTEMPTS) != 1:
+        return None
+    return (await asyncio.wait_for(peer.receive(), REPLY_TIMEOUT)).decode(FORMAT).strip()
+
+
+async def session(addr, work, integrity=None):
+    """Open a session with addr on a socket of its own, return await work(peer) and close it."""
+    peer = await connect(addr)
+
+    async def serve():
+        if await open_session(peer, integrity) is None:
+            raise ConnectionError(f"failed to open a session with {addr}")
+        try:
+            return await work(peer)
+        finally:
+            await close_session(peer)
+
+    try:
+        return await peer.run(serve())
+    finally:
+        disconnect(peer)
+
+
+async def fetch_sizes(peer, filenames):
+    """Sizes of the files of filenames the server has, by name."""
+    file_list = await fetch(peer, "FILE_LIST")
+    if file_list is None:
+        raise ConnectionError("failed to fetch the file list")
+    available = {line.split()[0] for line in file_list.splitlines() if line.strip()}
+    sizes = {}
+    for filename in filenames:
+        if filename in available and filename not in sizes:
+            size = await fetch(peer, f"SIZE {filename}")
+            if size is None:
+                raise ConnectionError(f"failed to fetch the size of {filename}")
+            sizes[filename] = int(size)
+    return sizes
+
+
+async def receive_range(peer, filename, path, offset, size, fec, flow, congestion, max_rate, progress=None, stats=None):
+    """Request bytes [offset, offset + size) of filename and receive them in place into path."""
+    payload_size = path_payloads.get(peer.addr, MAX_PAYLOAD)
+    request = (f"REQUEST {filename} {offset} {size} 0 {congestion} {int(max_rate)} {fec} {payload_size} {flow} "
+               f"fixed\n")
+    if await peer.send(make_packet(0, request.encode(FORMAT)), max_attempts=MESSAGE_ATTEMPTS) != 1:
+        raise ConnectionError(f"request of {filename} was not acknowledged")
+
+    decoder = FecDecoder() if fec != "none" else None
+    pull_from = peer.addr if flow == "pull" else None
+    with MappedRange(path, offset, size) as mapped:
+        receiver = PlacedReceiver(peer.socket, 0, mapped.view, data_payload(payload_size, FEC_CODES[fec]), decoder,
+                                  pull_from=pull_from)
+        received = await AsyncReceiver(peer, receiver, progress).run()
+    if decoder is not None and stats is not None:
+        stats["recovered"] = stats.get("recovered", 0) + decoder.recovered
+    return received
+
+
+async def download_range(addr, filename, path, offset, size, limiter, fec, flow, congestion, max_rate, stats=None):
+    """Download one range of filename in a session of its own, retried up to MAX_RETRIES times."""
+    def first_byte(received):
+        if stats is not None and stats["first_byte"] is None:
+            stats["first_byte"] = time.monotonic()
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with limiter:
+                return await session(addr, lambda peer: receive_range(peer, filename, path, offset, size, fec, flow,
+                                                                      congestion, max_rate, first_byte, stats))
+        except (OSError, TimeoutError, ValueError) as e:
+            if stats is not None:
+                stats["retries"] += 1
+            if attempt + 1 == MAX_RETRIES:
+                raise ConnectionError(f"range {offset} of {filename} failed: {e}") from e
+
+
+async def download_file_async(addr, filename, file_size, target, limiter=None, chunks=NUM_OF_CHUNKS, fec=None,
+                              flow=None, congestion=None, max_rate=None, stats=None):
+    """Download filename into target as chunks ranges at once. Returns the number of bytes received."""
+    limiter = limiter or asyncio.Semaphore(MAX_SESSIONS)
+    fec = fec or client_SR.FEC
+    flow = flow or client_SR.FLOW_CONTROL
+    congestion = congestion or client_SR.CONGESTION
+    if fec not in FEC_CODES:
+        raise ValueError(f"unknown FEC scheme {fec}")
+    if flow not in client_SR.FLOW_MODES:
+        raise ValueError(f"unknown flow control {flow}")
+
+    # Preallocate the output file so every range is mapped at its own offset, no merge step needed
+    with open(target, "wb") as f:
+        f.truncate(file_size)
+    if file_size == 0:
+        return 0
+
+    chunks = max(1, min(chunks, -(-file_size // MAX_PAYLOAD)))  # No ranges of less than a packet
+    chunk_size = file_size // chunks
+    ranges = [(i * chunk_size, chunk_size) for i in range(chunks)]
+    ranges[-1] = (ranges[-1][0], file_size - ranges[-1][0])  # Remainder goes to the last chunk
+    # A rate cap applies to the whole file, not to every range
+    rate = client_SR.MAX_RATE if max_rate is None else max_rate
+    rate = rate / chunks if rate else 0
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(download_range(addr, filename, target, offset, size, limiter, fec, flow,
+                                                      congestion, rate, stats))
+                     for offset, size in ranges]
+    except ExceptionGroup as e:
+        raise e.exceptions[0] from None
+    received = sum(task.result() for task in tasks)
+
+    # Without per packet integrity the whole file is checked end-to-end
+    if client_SR.INTEGRITY == "none":
+        expected = await session(addr, lambda peer: fetch(peer, f"HASH {filename}"))
+        if expected != await asyncio.get_running_loop().run_in_executor(None, file_checksum, target):
+            raise ValueError(f"hash mismatch for {filename}")
+    return received
+
+
+async def download_files_async(addr, downloads, chunks=NUM_OF_CHUNKS, fec=None, flow=None, congestion=None):
+    """Download (file name, size, target) triples at once. Returns the bytes or the exception of each."""
+    limiter = asyncio.Semaphore(MAX_SESSIONS)
+    return await asyncio.gather(*(download_file_async(addr, filename, size, target, limiter, chunks, fec, flow,
+                                                      congestion)
+                                  for filename, size, target in downloads), return_exceptions=True)
+
+
+async def run_downloads(args):
+    addr = (args.host, args.port)
+    sizes = await session(addr, lambda peer: fetch_sizes(peer, args.files))
+    downloads = []
+    for filename in args.files:
+        if filename not in sizes:
+            print(f"{filename} is not available on the server.", file=sys.stderr)
+            continue
+        for copy in range(args.copies):
+            name = filename if args.copies == 1 else f"{filename}.{copy}"
+            downloads.append((filename, sizes[filename], os.path.join(args.output, name)))
+
+    os.makedirs(args.output, exist_ok=True)
+    start = time.monotonic()
+    results = await download_files_async(addr, downloads, args.chunks, args.fec, args.flow, args.congestion)
+    elapsed = max(time.monotonic() - start, 1e-9)
+
+    failed = 0
+    for (filename, _, target), result in zip(downloads, results):
+        if isinstance(result, BaseException):
+            failed += 1
+            print(f"Error downloading {filename} to {target}: {result}", file=sys.stderr)
+    received = sum(result for result in results if not isinstance(result, BaseException))
+    sessions = len(downloads) * args.chunks
+    print(f"{len(downloads) - failed} of {len(downloads)} downloads ({sessions} sessions) in {elapsed:.2f} s, "
+          f"{received / elapsed / 1e6:.2f} MB/s")
+    return 1 if failed or len(downloads) < len(args.files) * args.copies else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download files over reliable UDP, every range in a session of its own.")
+    parser.add_argument("files", nargs="+", help="file names on the server")
+    parser.add_argument("--host", default=client_SR.HOST, help="server address")
+    parser.add_argument("--port", type=int, default=client_SR.PORT, help="server port")
+    parser.add_argument("--chunks", type=int, default=NUM_OF_CHUNKS, help="byte ranges of every file downloaded at once")
+    parser.add_argument("--copies", type=int, default=1, help="download every file this many times at once")
+    parser.add_argument("--output", default=client_SR.OUTPUT_DIR, help="folder of the downloaded files")
+    parser.add_argument("--fec", choices=sorted(FEC_CODES), help="forward error correction to ask for")
+    parser.add_argument("--flow", choices=client_SR.FLOW_MODES, help="flow control to ask for")
+    parser.add_argument("--congestion", help="congestion control the server should use")
+    args = parser.parse_args(argv)
+    try:
+        return asyncio.run(run_downloads(args))
+    except KeyboardInterrupt:
+        print("\nDownload cancelled.", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
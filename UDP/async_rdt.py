@@ -0,0 +1,394 @@
+# Description: asyncio implementation of the reliable UDP protocol of utils.py.
+#
+# send_rdt, recv_rdt and the windowed loops block in settimeout + recvfrom, so a thread waits
+# for one exchange at a time and sessions.py needs a thread per client. Here the event loop
+# reads the sockets and every retransmission deadline is a loop timer, so one process drives
+# hundreds of sessions:
+#
+#   RdtProtocol    the DatagramProtocol of a socket, hands datagrams to the Peer of their sender
+#   Peer           one session: stop-and-wait messages with the counters, echoes and RTT
+#                  estimator of send_rdt/recv_rdt, and the windowed transfer in progress
+#   AsyncSender    runs a SelectiveRepeatSender (fill, on_response, expire) from loop callbacks
+#   AsyncReceiver  runs a placement.PlacedReceiver from loop callbacks
+#
+# The packets and the state machines are those of utils.py, placement.py, congestion.py,
+# pacing.py and fec.py, so asyncio peers and blocking peers talk to each other. Every Peer
+# runs in a contextvars context of its own, where set_integrity(session=True) applies to
+# that session alone. Datagram transports have no scatter-gather send, header and payload are
+# joined before they are sent, and pacing delays below the loop's timer resolution (about a
+# millisecond on Linux) turn into small bursts instead of a spin.
+import asyncio
+import contextvars
+import socket
+import time
+from utils import (ACK, HEADER_SIZE, INITIAL_TIMEOUT, INVALID_PACKET, MAX_IDLE, MESSAGE_FLAG, PACKET_STAMP,
+                   STAMP_OFFSET, echo_rtt, extract_data, extract_message, extract_scheme, extract_seq_num,
+                   extract_stamp, forget_session, is_duplicate_message, is_grant, is_sack, message_counters_for,
+                   pack_header, pending_packets, send_parts, session_rtt, split_packet, timestamp, tune_socket,
+                   verify_packet, verify_parts)
+
+
+class PeerSocket:
+    """The part of a socket that utils needs, sending through a datagram transport."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, addr=None):
+        self.transport.sendto(b"".join(buffers), addr)
+
+    def getsockopt(self, *args):
+        return self.transport.get_extra_info("socket").getsockopt(*args)
+
+    def setsockopt(self, *args):
+        return self.transport.get_extra_info("socket").setsockopt(*args)
+
+
+class OutgoingMessage:
+    """A stop-and-wait message waiting for its ACK, resent by a loop timer as send_rdt resends it.
+    future gets the ACK number, or None after max_attempts timeouts."""
+
+    def __init__(self, peer, packet, max_attempts=None):
+        self.peer = peer
+        self.max_attempts = max_attempts
+        head, self.payload = split_packet(packet)
+        self.seq_num = extract_seq_num(head)
+        self.header = bytearray(HEADER_SIZE)
+        pack_header(self.header, self.seq_num, self.payload, extract_scheme(head), message=MESSAGE_FLAG | peer.counters[0])
+        self.stamps = set()  # Timestamps of our transmissions, an ACK echoing one of them is an exact sample
+        self.attempts = 0
+        self.timer = None
+        self.future = peer.loop.create_future()
+
+    def transmit(self):
+        stamp = timestamp()
+        self.stamps.add(stamp)
+        PACKET_STAMP.pack_into(self.header, STAMP_OFFSET, stamp)
+        send_parts(self.peer.socket, self.peer.addr, self.header, self.payload)
+        self.timer = self.peer.loop.call_later(self.peer.rtt.rto, self.expire)
+
+    def expire(self):
+        self.peer.rtt.backoff()
+        self.attempts += 1
+        if self.max_attempts is not None and self.attempts >= self.max_attempts:
+            self.finish(None)
+        else:
+            print("Timeout, resending packet")
+            self.transmit()
+
+    def on_ack(self, ack_num, echo):
+        if ack_num == INVALID_PACKET:  # NACK received
+            self.timer.cancel()
+            self.transmit()
+        elif echo in self.stamps:
+            self.peer.rtt.sample(echo_rtt(echo))
+            self.finish(ack_num)
+        # Otherwise a late ACK of an earlier message
+
+    def finish(self, result):
+        self.cancel()
+        if not self.future.done():
+            if result is not None:
+                self.peer.counters[0] = (self.peer.counters[0] + 1) % 128
+            self.future.set_result(result)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+class Peer:
+    """The session with addr: datagrams from addr are passed to deliver, coroutines of the
+    session run in its context (see run)."""
+
+    def __init__(self, transport, addr):
+        self.loop = asyncio.get_running_loop()
+        self.addr = addr
+        self.socket = PeerSocket(transport)  # Key of the per session state of utils
+        self.context = contextvars.copy_context()
+        self.rtt = session_rtt(self.socket, addr)
+        self.counters = message_counters_for(self.socket, addr)
+        self.inbox = asyncio.Queue()  # Messages received and acknowledged, not read yet
+        self.outgoing = None  # OutgoingMessage waiting for its ACK
+        self.transfer = None  # AsyncSender or AsyncReceiver of the windowed transfer in progress
+        self.last_activity = time.monotonic()
+        self.number = 0  # For the logs of servers
+        self.task = None
+
+    def run(self, coro):
+        """Run coro as a task in the context of this session. Returns the task."""
+        return self.loop.create_task(coro, context=self.context)
+
+    def deliver(self, data):
+        self.last_activity = time.monotonic()
+        self.context.run(self.datagram_received, data)
+
+    def datagram_received(self, data):
+        if len(data) == ACK.size and self.outgoing is not None:
+            self.outgoing.on_ack(*ACK.unpack(data))
+        elif self.transfer is not None:
+            self.transfer.datagram_received(data)
+        elif len(data) != ACK.size and not is_sack(data) and not is_grant(data):
+            self.message_received(data)
+        # Otherwise a late ACK or grant of a finished transfer
+
+    def message_received(self, data):
+        if not verify_packet(data):
+            self.socket.sendto(ACK.pack(INVALID_PACKET, 0), self.addr)  # NACK
+            return
+        message = extract_message(data)
+        if not message:
+            return  # Windowed data of a finished transfer
+        seq_num = extract_seq_num(data)
+        echo = extract_stamp(data)
+        if is_duplicate_message(self.socket, self.addr, message):
+            # Already delivered, only our ACK got lost
+            self.socket.sendto(ACK.pack(seq_num + 1, echo), self.addr)
+            return
+        if self.outgoing is not None:
+            # The peer already sent its next message, so ours arrived and only the ACK was lost
+            self.outgoing.finish(self.outgoing.seq_num + 1)
+        if seq_num != 0:
+            self.socket.sendto(ACK.pack(0, echo), self.addr)  # Stop-and-wait messages are all numbered 0
+            return
+        self.counters[1] = ((message & ~MESSAGE_FLAG) + 1) % 128
+        self.socket.sendto(ACK.pack(seq_num + 1, echo), self.addr)
+        self.inbox.put_nowait(bytes(extract_data(data)))
+
+    def replay(self):
+        """Handle the datagrams a finished transfer handed back, see utils.unread_packet."""
+        for data, _ in pending_packets.pop(self.socket, []):
+            self.datagram_received(data)
+
+    async def send(self, packet, max_attempts=None):
+        """send_rdt: returns the ACK number, or None after max_attempts timeouts (default: retry forever)."""
+        message = self.outgoing = OutgoingMessage(self, packet, max_attempts)
+        try:
+            message.transmit()
+            return await message.future
+        finally:
+            message.cancel()
+            self.outgoing = None
+
+    async def receive(self):
+        """recv_rdt: the data of the next message."""
+        return await self.inbox.get()
+
+    def close(self):
+        if self.outgoing is not None:
+            self.outgoing.cancel()
+        if self.transfer is not None:
+            self.transfer.cancel()
+        forget_session(self.socket, self.addr)
+
+
+class AsyncSender:
+    """Sends with a SelectiveRepeatSender: every datagram of the receiver and a single loop
+    timer, armed at the earliest retransmission deadline or pacing delay, call its steps."""
+
+    def __init__(self, peer, sender):
+        self.peer = peer
+        self.sender = sender
+        self.loop = peer.loop
+        self.future = self.loop.create_future()
+        self.timer = None
+        self.last_progress = time.monotonic()
+
+    async def run(self):
+        """Send every packet. Returns False if the receiver stopped responding."""
+        self.peer.transfer = self
+        try:
+            self.step()
+            return await self.future
+        finally:
+            self.cancel()
+            self.peer.transfer = None
+            self.peer.replay()
+
+    def datagram_received(self, data):
+        if self.future.done():
+            return
+        if self.sender.on_response(data, self.peer.addr):
+            self.last_progress = time.monotonic()
+        self.step()
+
+    def step(self):
+        sender = self.sender
+        if not sender.done():
+            sender.expire()
+        if sender.done():
+            self.finish(True)
+            return
+        if time.monotonic() - self.last_progress > MAX_IDLE:
+            print(f"Receiver {self.peer.addr} stopped responding.")
+            self.finish(False)
+            return
+
+        pacing_delay = sender.fill()
+        delay = sender.next_timeout()
+        if pacing_delay > 0:
+            delay = min(delay, pacing_delay)
+        self.arm(self.loop.time() + delay)
+
+    def arm(self, when):
+        if self.timer is not None:
+            if self.timer.when() <= when:
+                return  # The earlier timer steps again and re-arms
+            self.timer.cancel()
+        self.timer = self.loop.call_at(when, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        if not self.future.done():
+            self.step()
+
+    def finish(self, result):
+        self.cancel()
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class AsyncReceiver:
+    """Receives a range with a placement.PlacedReceiver: datagrams are placed as they arrive and
+    one loop timer sends the delayed SACKs, and the window updates or grants of a quiet link.
+    progress(bytes) is called as the range fills up in order."""
+
+    def __init__(self, peer, receiver, progress=None):
+        self.peer = peer
+        self.receiver = receiver
+        self.progress = progress
+        self.loop = peer.loop
+        self.future = self.loop.create_future()
+        self.timer = None
+        self.last_received = self.last_event = time.monotonic()
+
+    async def run(self):
+        """Receive until the range is complete. Returns the size of the range."""
+        self.peer.transfer = self
+        try:
+            if self.receiver.count == 0:
+                return 0
+            self.receiver.update_credit()
+            self.arm()
+            return await self.future
+        finally:
+            self.cancel()
+            self.receiver.flush()
+            self.peer.transfer = None
+
+    def datagram_received(self, data):
+        receiver = self.receiver
+        if self.future.done() or len(data) < HEADER_SIZE:
+            return
+        view = memoryview(data)
+        header, payload = view[:HEADER_SIZE], view[HEADER_SIZE:]
+        if extract_message(header) & MESSAGE_FLAG or not verify_parts(header, payload):
+            return  # A late message, or corrupted: the sender's timer will resend it
+        self.last_received = self.last_event = time.monotonic()
+        receiver.addr = self.peer.addr
+        try:
+            grew = receiver.on_packet(header, payload, None)
+        except ValueError as e:
+            self.future.set_exception(e)
+            return
+        if grew and self.progress is not None:
+            self.progress(min(receiver.expected * receiver.payload_size, receiver.size))
+        if receiver.expected >= receiver.count:
+            self.future.set_result(receiver.size)
+            return
+        receiver.update_credit()
+        self.arm()
+
+    def deadline(self):
+        if self.receiver.ack_deadline is not None:
+            return self.receiver.ack_deadline
+        return self.last_event + INITIAL_TIMEOUT
+
+    def arm(self):
+        when = self.deadline()
+        if self.timer is not None:
+            if self.timer.when() <= when:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_at(when, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        if self.future.done():
+            return
+        now = time.monotonic()
+        if now >= self.deadline():
+            try:
+                self.receiver.on_quiet(now - self.last_received)
+            except TimeoutError as e:
+                self.future.set_exception(e)
+                return
+            if self.receiver.ack_deadline is None:
+                self.last_event = now
+        self.arm()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class RdtProtocol(asyncio.DatagramProtocol):
+    """Hands the datagrams of a socket to the Peer of their sender, those of unknown senders
+    to unknown_peer."""
+
+    def __init__(self):
+        self.transport = None
+        self.peers = {}  # peer address -> Peer
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        peer = self.peers.get(addr)
+        if peer is not None:
+            peer.deliver(data)
+        else:
+            self.unknown_peer(data, addr)
+
+    def unknown_peer(self, data, addr):
+        pass
+
+    def error_received(self, exc):
+        pass  # ICMP errors of earlier datagrams (port unreachable, EMSGSIZE): timers recover
+
+    def connection_lost(self, exc):
+        for peer in list(self.peers.values()):
+            self.remove_peer(peer)
+            if peer.task is not None:
+                peer.task.cancel()
+
+    def add_peer(self, addr):
+        peer = self.peers[addr] = Peer(self.transport, addr)
+        return peer
+
+    def remove_peer(self, peer):
+        if self.peers.get(peer.addr) is peer:
+            del self.peers[peer.addr]
+        peer.close()
+
+
+async def connect(addr):
+    """A Peer for addr on a socket of its own, see disconnect."""
+    loop = asyncio.get_running_loop()
+    sock = tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    transport, protocol = await loop.create_datagram_endpoint(RdtProtocol, sock=sock)
+    return protocol.add_peer(addr)
+
+
+def disconnect(peer):
+    """Close the socket connect opened for peer."""
+    peer.socket.transport.close()  # connection_lost closes the peer
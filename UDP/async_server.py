@@ -0,0 +1,210 @@
+# Description: asyncio UDP server, every client session on one event loop.
+#
+# Serves the requests of server_SR.py (CONNECT, FILE_LIST, SIZE, HASH, REQUEST, PROBE, EXIT)
+# with the same packets, so client_SR.py, batch.py and async_client.py work with both. Instead
+# of a thread per session (sessions.py) every session is a task and every retransmission
+# deadline a loop timer, see async_rdt.py: a client costs its window and file handle, not a
+# thread. The packetizer still reads the file in blocking reads of PREFETCH packets, which
+# the page cache serves; file hashes are computed in the default executor.
+import asyncio
+import os
+import socket
+import time
+import server_SR
+from async_rdt import AsyncSender, RdtProtocol
+from sessions import is_connect
+from server_SR import (count, count_transfer, get_file_list, negotiate_integrity, open_transfer, parse_request,
+                       report_transfer)
+from utils import (ACK, FORMAT, MAX_RETRIES, SelectiveRepeatSender, extract_data, extract_seq_num, extract_stamp,
+                   file_checksum, integrity_name, make_packet, set_integrity, tune_socket, verify_packet)
+
+HOST = server_SR.HOST
+PORT = 12345
+FOLDER = server_SR.FOLDER
+FILE_LIST = server_SR.FILE_LIST
+MAX_SESSIONS = 1024
+SESSION_TIMEOUT = 300.0  # seconds without any datagram from the client
+SWEEP_INTERVAL = 1.0  # how often idle sessions are looked for
+
+active_requests = set()
+
+
+async def reply(peer, text):
+    """Send one line to the client, True once it is acknowledged."""
+    return await peer.send(make_packet(0, text.encode(FORMAT) + b"\n")) == 1
+
+
+async def send_file(peer, file, offset, chunk, seq_num, congestion, max_rate, fec, payload_size, pull, fixed_size):
+    packets, controller, pacer, encoder, sizer = open_transfer(file, offset, chunk, seq_num, congestion, max_rate,
+                                                               fec, payload_size, fixed_size)
+    with packets:
+        sender = SelectiveRepeatSender(peer.socket, peer.addr, packets, controller, pacer, encoder, sizer, pull)
+        sent = await AsyncSender(peer, sender).run()
+        count_transfer(packets, controller, sent)
+        report_transfer(file, offset, chunk, packets, controller, pacer, encoder, sizer)
+
+
+async def handle_request(peer, request):
+    """Serve one request line. Returns False when the session is over."""
+    if request == "FILE_LIST":
+        if not await reply(peer, "\n".join(get_file_list())):
+            print("Failed to send file list.")
+            return False
+
+    elif request.startswith("SIZE"):
+        fileName = request.split()[1]
+        print(f"Request for file size: {fileName}")
+        if not await reply(peer, str(os.path.getsize(os.path.join(FOLDER, fileName)))):
+            print("Failed to send file size.")
+            return False
+
+    elif request.startswith("HASH"):
+        fileName = request.split()[1]
+        loop = asyncio.get_running_loop()
+        file_hash = await loop.run_in_executor(None, file_checksum, os.path.join(FOLDER, fileName))
+        if not await reply(peer, file_hash):
+            print("Failed to send file hash.")
+            return False
+
+    elif request.startswith("REQUEST"):
+        (fileName, offset, chunk, seq_num, congestion, max_rate, fec, payload_size, pull,
+         fixed_size) = parse_request(request)
+        print(f"Request for file chunk: {fileName} {offset} {chunk} {seq_num} ({congestion}, rate cap {max_rate}, "
+              f"fec {fec}, payload {payload_size}, {'pull' if pull else 'credit'})")
+        request_id = (peer.addr, fileName, offset, chunk, seq_num)
+        if not os.path.exists(os.path.join(FOLDER, fileName)) or request_id in active_requests:
+            print(f"File {fileName} not found or request already active.")
+            return False
+        active_requests.add(request_id)
+        try:
+            await send_file(peer, fileName, offset, chunk, seq_num, congestion, max_rate, fec, payload_size, pull,
+                            fixed_size)
+        finally:
+            active_requests.discard(request_id)
+
+    elif request.startswith("PROBE"):
+        pass  # Path MTU probe of the client, see pmtu.py: the ACK was the answer
+
+    elif request.startswith("EXIT"):
+        return False
+    return True
+
+
+async def serve_session(peer):
+    """Handshake with the client of peer and serve its requests."""
+    request = (await peer.receive()).decode(FORMAT).split()
+    if not request or request[0] != "CONNECT":
+        print(f"Invalid connection request from {peer.addr}")
+        return
+    scheme = negotiate_integrity(request[1] if len(request) > 1 else None)
+    welcome = f"Welcome to the server!\nINTEGRITY {integrity_name(scheme)}\n".encode(FORMAT)
+    if await peer.send(make_packet(0, welcome), max_attempts=MAX_RETRIES) != 1:
+        print(f"Failed to send welcome message to {peer.addr}")
+        return
+    set_integrity(scheme, session=True)  # Only in the context of this session's task
+    print(f"Client {peer.addr} connected, integrity {integrity_name(scheme)}.\n")
+
+    count(sessions=1, active_sessions=1)
+    try:
+        buffer = ""
+        while True:
+            buffer += (await peer.receive()).decode(FORMAT)
+            while "\n" in buffer:
+                request, buffer = buffer.split("\n", 1)
+                print(f"Received request from {peer.addr}: {request}")
+                try:
+                    if not await handle_request(peer, request):
+                        return
+                except Exception as e:
+                    print(f"Error processing request from {peer.addr}: {e}")
+    finally:
+        count(active_sessions=-1)
+
+
+class AsyncServer(RdtProtocol):
+    """Opens a session task for every client that sends CONNECT, closes it after EXIT or
+    session_timeout seconds without a datagram."""
+
+    def __init__(self, max_sessions=MAX_SESSIONS, session_timeout=SESSION_TIMEOUT):
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.session_timeout = session_timeout
+        self.opened = 0
+        self.sweeper = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.sweeper = asyncio.get_running_loop().call_later(SWEEP_INTERVAL, self.sweep)
+
+    def connection_lost(self, exc):
+        self.sweeper.cancel()
+        super().connection_lost(exc)
+
+    def unknown_peer(self, data, addr):
+        if is_connect(data):
+            self.open(addr, data)
+        elif len(data) != ACK.size and bytes(extract_data(data)[:4]) == b"EXIT" and verify_packet(data):
+            # The session already ended, our ACK of its EXIT got lost
+            self.transport.sendto(ACK.pack(extract_seq_num(data) + 1, extract_stamp(data)), addr)
+
+    def open(self, addr, data):
+        if len(self.peers) >= self.max_sessions:
+            print(f"Refusing {addr}: {self.max_sessions} sessions already open.")
+            return
+        self.opened += 1
+        peer = self.add_peer(addr)
+        peer.number = self.opened
+        print(f"Session {peer.number} opened for {addr} ({len(self.peers)} active)")
+        peer.deliver(data)
+        peer.task = peer.run(self.serve(peer))
+
+    async def serve(self, peer):
+        try:
+            await serve_session(peer)
+        except Exception as e:
+            print(f"Session {peer.number} ({peer.addr}) failed: {e}")
+        finally:
+            self.close(peer)
+
+    def close(self, peer):
+        if self.peers.get(peer.addr) is peer:
+            self.remove_peer(peer)
+            print(f"Session {peer.number} closed for {peer.addr} ({len(self.peers)} active)")
+
+    def sweep(self):
+        now = time.monotonic()
+        for peer in list(self.peers.values()):
+            if now - peer.last_activity > self.session_timeout:
+                print(f"Session {peer.number} ({peer.addr}) idle for {self.session_timeout:.0f} s, closing.")
+                peer.task.cancel()  # Its finally cleans up
+        self.sweeper = asyncio.get_running_loop().call_later(SWEEP_INTERVAL, self.sweep)
+
+
+async def serve(server=None):
+    """Serve on server, a bound UDP socket (default: one bound to HOST, PORT), until cancelled."""
+    loop = asyncio.get_running_loop()
+    if server is None:
+        server = tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+        server.bind((HOST, PORT))
+    transport, _ = await loop.create_datagram_endpoint(AsyncServer, sock=server)
+    host, port = server.getsockname()[:2]
+    print(f"Server is running on {host} : {port}\n")
+    try:
+        await loop.create_future()  # Until cancelled
+    finally:
+        transport.close()
+
+
+def run():
+    # get_file_list and open_transfer read the folder of server_SR
+    server_SR.FOLDER, server_SR.FILE_LIST = FOLDER, FILE_LIST
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nServer interrupted by user.")
+    finally:
+        print("Server shutting down...")
+
+
+if __name__ == "__main__":
+    run()
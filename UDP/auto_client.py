@@ -0,0 +1,385 @@
+# Description: Client that picks TCP, parallel TCP or reliable UDP per transfer from path measurements.
+#
+#   python auto_client.py big.bin small.bin --host 10.0.0.5 [--tcp-port 12345] [--report decisions.json]
+#
+# Talks to TCP/server.py and server_SR.py (or async_server.py) running on the same host, by
+# default on the same port number. It first probes the path:
+#   rtt        shortest of PROBE_ROUNDS request/reply round trips with the TCP server (the
+#              UDP session RTT without it)
+#   loss       share of a train of TRAIN_BYTES over reliable UDP that had to be retransmitted,
+#              told apart from reordered packets by their send timestamps (ProbeReceiver)
+#   bandwidth  goodput of the train (first to last byte) and of the same bytes over one TCP
+#              connection (request to last byte, less an rtt); the path carries at least the
+#              larger of the two. Once segments ran, the highest rate measured by a transport
+#
+# Decision model (PathModel): a transfer of S bytes over a transport takes
+#   time = SETUP_RTTS x rtt + S / rate
+# with the rate of the transport
+#   tcp           min(bandwidth, mathis)
+#   tcp-parallel  min(bandwidth, TCP_STREAMS x mathis)
+#   udp           goodput of the train
+# where mathis = MATHIS_C x MSS / (rtt x sqrt(loss)) is what one TCP stream sustains under
+# random loss (Mathis et al., 1997), no limit when no loss was seen. Once a transport carried a
+# segment, the rate it achieved replaces its modelled one (so a transport whose model promises
+# more than the measured one achieves gets tried once). The fastest transport wins, but one
+# earlier in CANDIDATES (kernel TCP costs less CPU and shares the path fairly, fewer connections
+# are cheaper) is kept unless a later one is faster by PREFER_MARGIN.
+#
+# Files above SEGMENT_SIZE are downloaded in segments, and after every segment the decision is
+# taken again for the rest of the file with what the segment measured (its rate, a UDP segment
+# its loss too): the transport changes only if another one is faster by SWITCH_MARGIN. Every
+# decision is printed with the estimates and the path it was based on, --report saves them.
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import sys
+import time
+import client_SR
+from placement import MappedRange, PlacedReceiver
+from tcp_tree import load_tcp_module
+from utils import (FORMAT, MAX_PAYLOAD, extract_seq_num, extract_stamp, file_checksum, is_parity,
+                   make_packet, send_rdt, session_rtt, tune_socket)
+
+HOST = client_SR.HOST
+PORT = 12345
+OUTPUT_DIR = client_SR.OUTPUT_DIR
+CONNECT_TIMEOUT = 5.0
+PROBE_ROUNDS = 3
+TRAIN_BYTES = 256 * MAX_PAYLOAD  # About 1 MB, enough packets to see a loss rate of 1%
+SEGMENT_SIZE = 32 * 1024 * 1024  # bytes downloaded between two decisions
+TCP_STREAMS = 4
+MSS = 1460
+MATHIS_C = 1.22  # sqrt(3/2)
+SETUP_RTTS = {"tcp": 2, "tcp-parallel": 2, "udp": 2}  # Handshake and request, or request and first ACK
+CANDIDATES = ("tcp", "tcp-parallel", "udp")  # In order of preference
+PREFER_MARGIN = 0.1
+SWITCH_MARGIN = 0.2
+MEASURE_GAIN = 0.5  # Weight of the latest segment in the measured rate of a transport
+
+
+class PathModel:
+    """What is known of the path and the transfers so far, and the completion time estimates
+    of the decision model described at the top of this file."""
+
+    def __init__(self, rtt, loss, bandwidth, udp_rate, available):
+        self.rtt = rtt
+        self.loss = loss
+        self.bandwidth = bandwidth
+        self.udp_rate = udp_rate
+        self.available = set(available)  # Transports whose server answered
+        self.measured = {}  # Transport -> rate its segments achieved
+
+    def mathis_rate(self):
+        if self.loss <= 0:
+            return math.inf
+        return MATHIS_C * MSS / (self.rtt * math.sqrt(self.loss))
+
+    def rate(self, transport):
+        """(bytes per second, where the figure comes from)."""
+        if transport in self.measured:
+            return self.measured[transport], "measured"
+        if transport == "udp":
+            return self.udp_rate, "train"
+        streams = TCP_STREAMS if transport == "tcp-parallel" else 1
+        mathis = streams * self.mathis_rate()
+        if mathis < self.bandwidth:
+            return mathis, "loss bound"
+        return self.bandwidth, "bandwidth"
+
+    def estimate(self, transport, size):
+        rate, _ = self.rate(transport)
+        return SETUP_RTTS[transport] * self.rtt + size / max(rate, 1.0)
+
+    def choose(self, size, current=None):
+        """The transport for size more bytes, and the estimated seconds of every candidate.
+        current is kept unless another transport is faster by SWITCH_MARGIN."""
+        estimates = {transport: self.estimate(transport, size) for transport in CANDIDATES
+                     if transport in self.available}
+        if not estimates:
+            raise ConnectionError("no transport left")
+        best = None
+        for transport in estimates:
+            if best is None or estimates[transport] < estimates[best] * (1 - PREFER_MARGIN):
+                best = transport
+        if current in estimates and estimates[best] >= estimates[current] * (1 - SWITCH_MARGIN):
+            best = current
+        return best, estimates
+
+    def observe(self, transport, size, elapsed, loss=None):
+        """A segment of size bytes took elapsed seconds over transport (loss: its loss rate)."""
+        rate = size / max(elapsed - SETUP_RTTS[transport] * self.rtt, 1e-6)
+        previous = self.measured.get(transport)
+        self.measured[transport] = rate if previous is None else (1 - MEASURE_GAIN) * previous + MEASURE_GAIN * rate
+        self.bandwidth = max(self.measured.values())
+        if loss is not None:
+            self.loss = (1 - MEASURE_GAIN) * self.loss + MEASURE_GAIN * loss
+
+    def describe(self):
+        return (f"rtt {self.rtt * 1000:.2f} ms, loss {self.loss * 100:.2f}%, "
+                f"bandwidth {self.bandwidth / 1e6:.2f} MB/s")
+
+    def explain(self, estimates):
+        words = []
+        for transport, seconds in sorted(estimates.items(), key=lambda item: item[1]):
+            rate, source = self.rate(transport)
+            words.append(f"{transport} {seconds:.2f} s ({rate / 1e6:.2f} MB/s, {source})")
+        return ", ".join(words)
+
+
+class ProbeReceiver(PlacedReceiver):
+    """PlacedReceiver that counts the packets whose first copy to arrive was sent after a higher
+    packet that arrived: retransmissions, the first transmission was lost. Reordering on the way
+    leaves the send timestamps in order, so it does not count."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stamps = [None] * self.count  # Send timestamp of the first copy of every packet
+        self.lost = 0
+        self.arrived = 0
+
+    def on_packet(self, header, payload, slot_index):
+        index = extract_seq_num(header) - self.first_seq
+        first = not is_parity(header) and 0 <= index < self.count and not self.has(index)
+        grew = super().on_packet(header, payload, slot_index)
+        if first:
+            stamp = self.stamps[index] = extract_stamp(header)
+            self.arrived += 1
+            for higher in range(index + 1, self.highest + 1):
+                if self.stamps[higher] is not None:
+                    # Sent strictly later than the next higher packet, modulo the 32 bit clock
+                    self.lost += 0 < (stamp - self.stamps[higher]) & 0xFFFFFFFF < 0x80000000
+                    break
+        return grew
+
+    def loss_rate(self):
+        return self.lost / self.arrived if self.arrived else 0.0
+
+
+def probe_rtt(addr, filename, rounds=PROBE_ROUNDS):
+    """Shortest of rounds STAT round trips to the TCP server at addr in seconds, None if it does
+    not accept connections. Timed above the handshake, which a middlebox may complete itself."""
+    best = None
+    try:
+        with socket.create_connection(addr, timeout=CONNECT_TIMEOUT) as sock:
+            for _ in range(rounds):
+                start = time.monotonic()
+                sock.sendall(f"STAT {filename}\n".encode(FORMAT))
+                reply = b""
+                while not reply.endswith(b"\n"):
+                    data = sock.recv(1024)
+                    if not data:
+                        return None
+                    reply += data
+                elapsed = time.monotonic() - start
+                best = elapsed if best is None else min(best, elapsed)
+            sock.sendall(b"EXIT\n")
+    except OSError:
+        return None
+    return best
+
+
+def tcp_sample(addr, filename, size, rtt):
+    """Goodput in bytes per second of size bytes of filename over one TCP connection. Timed from
+    the request less the rtt it takes to reach the server and the first byte to come back: from
+    the first byte on, most of a sample no larger than the socket buffers is already queued in
+    them and would be read at memory speed."""
+    with socket.create_connection(addr, timeout=CONNECT_TIMEOUT) as sock:
+        start = time.monotonic()
+        sock.sendall(f"CHUNK 1\nREQUEST {filename} 0 {size}\n".encode(FORMAT))
+        received = 0
+        while received < size:
+            data = sock.recv(1024 * 64)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            received += len(data)
+    return size / max(time.monotonic() - start - rtt, 1e-6)
+
+
+def udp_range(client, filename, offset, size, target):
+    """Receive bytes [offset, offset + size) of filename over reliable UDP into target (a
+    writable buffer). Returns (seconds from the first byte to the last, loss rate on first
+    transmission)."""
+    payload_size = client_SR.path_payloads.get(client_SR.ADDR, MAX_PAYLOAD)
+    request = (f"REQUEST {filename} {offset} {size} 0 {client_SR.CONGESTION} 0 none {payload_size} "
+               f"{client_SR.FLOW_CONTROL} fixed\n")
+    if send_rdt(client, client_SR.ADDR, make_packet(0, request.encode(FORMAT))) != 1:
+        raise ConnectionError(f"request of {filename} was not acknowledged")
+    receiver = ProbeReceiver(client, 0, target, payload_size,
+                             pull_from=client_SR.ADDR if client_SR.FLOW_CONTROL == "pull" else None)
+    first = []
+    receiver.run(lambda received: first or first.append(time.monotonic()))
+    elapsed = time.monotonic() - (first[0] if first else time.monotonic())
+    return elapsed, receiver.loss_rate()
+
+async def tcp_range(tcp, addr, filename, path, offset, size, streams):
+    """Download bytes [offset, offset + size) of filename into path over streams TCP connections."""
+    limiter = asyncio.Semaphore(streams)
+    ranges = [(start, length) for start, length in tcp.split_chunks(size, min(streams, max(size, 1)))]
+    progress = [[0, length] for _, length in ranges]
+    try:
+        async with asyncio.TaskGroup() as group:
+            for i, (start, length) in enumerate(ranges):
+                group.create_task(tcp.download_chunk(addr, filename, path, i + 1, offset + start, length, progress,
+                                                     limiter, quiet=True))
+    except ExceptionGroup as e:
+        raise e.exceptions[0] from None
+
+
+def probe_path(client, tcp_addr, filename, file_size):
+    """Measure the path with filename, returns the PathModel. client is the UDP session socket or None."""
+    available = set()
+    rtt = probe_rtt(tcp_addr, filename)
+    if rtt is not None:
+        available.update(("tcp", "tcp-parallel"))
+    if client is not None:
+        available.add("udp")
+        udp_rtt = session_rtt(client, client_SR.ADDR).srtt
+        if rtt is None:
+            rtt = udp_rtt
+    if not available:
+        raise ConnectionError("neither the TCP nor the UDP server answered")
+    rtt = rtt or 0.001
+
+    size = min(TRAIN_BYTES, file_size)
+    loss, udp_rate, tcp_rate = 0.0, 0.0, 0.0
+    if "udp" in available and size:
+        elapsed, loss = udp_range(client, filename, 0, size, memoryview(bytearray(size)))
+        udp_rate = size / max(elapsed, 1e-6)
+    if "tcp" in available and size:
+        tcp_rate = tcp_sample(tcp_addr, filename, size, rtt)
+    model = PathModel(rtt, loss, max(udp_rate, tcp_rate), udp_rate, available)
+    print(f"Path: {model.describe()} (train of {size} bytes: udp {udp_rate / 1e6:.2f} MB/s, "
+          f"tcp {tcp_rate / 1e6:.2f} MB/s), transports: {', '.join(sorted(available))}")
+    return model
+
+
+def download_file(model, client, tcp, tcp_addr, filename, size, target, decisions):
+    """Download filename into target segment by segment, choosing the transport of every segment."""
+    with open(target, "wb") as f:
+        f.truncate(size)
+    offset = 0
+    current = None
+    while offset < size:
+        length = min(SEGMENT_SIZE, size - offset)
+        transport, estimates = model.choose(size - offset, current)
+        reason = "kept" if transport == current else "switched to" if current else "chose"
+        print(f"{filename} [{offset}, {offset + length}): {reason} {transport}, estimates for the "
+              f"remaining {size - offset} bytes: {model.explain(estimates)}; {model.describe()}")
+        decisions.append({"file": filename, "offset": offset, "size": length, "transport": transport,
+                          "decision": reason,
+                          "estimates": {name: round(seconds, 3) for name, seconds in estimates.items()},
+                          "rtt": model.rtt, "loss": model.loss, "bandwidth": model.bandwidth})
+
+        start = time.monotonic()
+        try:
+            if transport == "udp":
+                with MappedRange(target, offset, length) as mapped:
+                    _, loss = udp_range(client, filename, offset, length, mapped.view)
+                model.observe(transport, length, time.monotonic() - start, loss)
+            else:
+                streams = TCP_STREAMS if transport == "tcp-parallel" else 1
+                asyncio.run(tcp_range(tcp, tcp_addr, filename, target, offset, length, streams))
+                model.observe(transport, length, time.monotonic() - start)
+        except (OSError, ValueError) as e:
+            print(f"{transport} failed for {filename} [{offset}, {offset + length}): {e}, not using it any more.")
+            decisions[-1]["error"] = str(e)
+            model.available.discard(transport)
+            current = None
+            continue
+        decisions[-1]["rate"] = round(model.measured[transport])
+        offset += length
+        current = transport
+
+
+def run_downloads(args):
+    client_SR.set_server(args.host, args.port)
+    tcp_addr = (args.host, args.tcp_port or args.port)
+    tcp = load_tcp_module("async_client")
+    decisions = []
+    failed = 0
+    with tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as client:
+        session = client_SR.open_session(client) is not None
+        if not session:
+            print(f"The UDP server at {client_SR.ADDR} did not answer, using TCP only.")
+        try:
+            sizes = {}
+            if session:
+                available = client_SR.fetch_file_list(client) or []
+                for filename in args.files:
+                    if filename in available and filename not in sizes:
+                        sizes[filename] = client_SR.fetch_file_size(client, filename)
+            else:
+                with socket.create_connection(tcp_addr, timeout=CONNECT_TIMEOUT) as control:
+                    for filename in args.files:
+                        control.sendall(f"STAT {filename}\n".encode(FORMAT))
+                        reply = control.recv(1024).decode(FORMAT).split()
+                        if len(reply) == 2:
+                            sizes[filename] = int(reply[0])
+                    control.sendall(b"EXIT\n")
+            if not sizes:
+                print("None of the files is available on the server.", file=sys.stderr)
+                return 1
+
+            # The largest file gives the longest train
+            probe_file = max(sizes, key=sizes.get)
+            model = probe_path(client if session else None, tcp_addr, probe_file, sizes[probe_file])
+
+            os.makedirs(args.output, exist_ok=True)
+            for filename in args.files:
+                if filename not in sizes:
+                    print(f"{filename} is not available on the server.", file=sys.stderr)
+                    failed += 1
+                    continue
+                target = os.path.join(args.output, filename)
+                start = time.monotonic()
+                try:
+                    download_file(model, client if session else None, tcp, tcp_addr, filename, sizes[filename],
+                                  target, decisions)
+                    if args.verify and session and client_SR.fetch_file_hash(client, filename) != file_checksum(target):
+                        raise ValueError("hash mismatch")
+                except (OSError, ValueError) as e:
+                    print(f"Error downloading {filename}: {e}", file=sys.stderr)
+                    failed += 1
+                    continue
+                elapsed = max(time.monotonic() - start, 1e-9)
+                print(f"Finished downloading {filename}: {sizes[filename] / elapsed / 1e6:.2f} MB/s\n")
+        finally:
+            if session:
+                client_SR.close_session(client)
+            if args.report:
+                with open(args.report, "w") as f:
+                    f.write(json.dumps(decisions, indent=2) + "\n")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    global SEGMENT_SIZE
+    parser = argparse.ArgumentParser(description="Download files over TCP, parallel TCP or reliable UDP, "
+                                                 "whichever the path measurements favour.")
+    parser.add_argument("files", nargs="+", help="file names on the server")
+    parser.add_argument("--host", default=HOST, help="server address")
+    parser.add_argument("--port", type=int, default=PORT, help="UDP server port")
+    parser.add_argument("--tcp-port", type=int, help="TCP server port (default: the UDP one)")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="folder of the downloaded files")
+    parser.add_argument("--segment", type=float, default=SEGMENT_SIZE / 1024 / 1024,
+                        help="MB downloaded between two decisions")
+    parser.add_argument("--verify", action="store_true",
+                        help="compare the MD5 of every file with the one the UDP server reports")
+    parser.add_argument("--report", help="write the decisions as JSON to this path")
+    args = parser.parse_args(argv)
+    SEGMENT_SIZE = max(MAX_PAYLOAD, int(args.segment * 1024 * 1024))
+    try:
+        return run_downloads(args)
+    except ConnectionError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print("\nDownload cancelled.", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
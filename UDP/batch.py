@@ -0,0 +1,126 @@
+# Description: Non-interactive batch client over reliable UDP (selective repeat).
+#
+#   python batch.py --host 10.0.0.5 manifest.txt --report report.json
+#
+# Same manifest and report format as TCP/batch.py: one "file [target]" per line or a
+# JSON list of {"file": ..., "target": ...}. Exits with 0 if every file was downloaded,
+# 1 if any failed and 2 if the server could not be reached. Progress output of the
+# transfer goes to stderr so stdout only carries the report.
+import argparse
+import contextlib
+import json
+import sys
+import client_SR
+from fec import FEC_CODES
+from tcp_tree import load_tcp_module
+from utils import *
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+load_manifest = load_tcp_module("manifest").load_manifest  # The format of TCP/batch.py
+
+
+def transfer(client, available_files, filename, target, max_rate=None, chunks=1, fec=None, flow=None):
+    result = {"file": filename, "target": target, "status": "failed", "bytes": 0, "size": None,
+              "wall_time": 0.0, "throughput": 0.0, "retries": 0, "ttfb": None, "recovered": 0, "error": None}
+    stats = {"retries": 0, "first_byte": None, "recovered": 0}
+    start = time.monotonic()
+
+    if filename not in available_files:
+        result["error"] = f"{filename} is not available on the server"
+        return result
+
+    size = client_SR.fetch_file_size(client, filename)
+    if size is None:
+        result["error"] = "failed to fetch file size"
+        return result
+    result["size"] = size
+
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    if chunks > 1:
+        result["bytes"] = client_SR.download_file_parallel(client, filename, size, target=target, stats=stats,
+                                                          max_rate=max_rate, chunks=chunks, fec=fec, flow=flow)
+    else:
+        result["bytes"] = client_SR.download_file(client, filename, 0, size, target=target, stats=stats,
+                                                 max_rate=max_rate, fec=fec, flow=flow)
+    if result["bytes"] >= size:
+        result["status"] = "ok"
+    else:
+        result["error"] = f"received {result['bytes']} of {size} bytes"
+
+    wall_time = time.monotonic() - start
+    result["wall_time"] = round(wall_time, 6)
+    result["throughput"] = round(result["bytes"] / wall_time, 1) if wall_time > 0 else 0.0
+    result["retries"] = stats["retries"]
+    result["recovered"] = stats["recovered"]
+    if stats["first_byte"] is not None:
+        result["ttfb"] = round(stats["first_byte"] - start, 6)
+    return result
+
+
+def run_batch(host, port, entries, max_rate=None, chunks=1, fec=None, flow=None):
+    """Download every (file, target) entry over one UDP session and return the report dict."""
+    client_SR.set_server(host, port)
+
+    with tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as client:
+        if client_SR.open_session(client) is None:
+            raise ConnectionError(f"failed to connect to {host}:{port}")
+
+        start = time.monotonic()
+        try:
+            available_files = client_SR.fetch_file_list(client) or []
+            files = [transfer(client, available_files, filename, target, max_rate, chunks, fec, flow)
+                     for filename, target in entries]
+        finally:
+            client_SR.close_session(client)
+        wall_time = time.monotonic() - start
+
+    total_bytes = sum(item["bytes"] for item in files)
+    return {
+        "server": f"{host}:{port}",
+        "transport": "udp",
+        "files": files,
+        "total_bytes": total_bytes,
+        "wall_time": round(wall_time, 6),
+        "throughput": round(total_bytes / wall_time, 1) if wall_time > 0 else 0.0,
+        "retries": sum(item["retries"] for item in files),
+        "failed": sum(item["status"] != "ok" for item in files),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download the files of a manifest over UDP without any prompt.")
+    parser.add_argument("manifest", help="text (file [target] per line) or .json manifest")
+    parser.add_argument("--host", required=True, help="server IP address")
+    parser.add_argument("--port", type=int, default=client_SR.PORT)
+    parser.add_argument("--report", help="write the JSON report to this path instead of stdout")
+    parser.add_argument("--rate", type=int, help="cap the sending rate of the server, bytes per second")
+    parser.add_argument("--chunks", type=int, default=client_SR.NUM_OF_CHUNKS,
+                        help="byte ranges of a file downloaded at once over separate sessions, 1: one stream")
+    parser.add_argument("--fec", choices=sorted(FEC_CODES), help="forward error correction for lossy links")
+    parser.add_argument("--flow", choices=client_SR.FLOW_MODES,
+                        help="flow control: the server sends within our credit, or only the ranges we grant (pull)")
+    args = parser.parse_args(argv)
+
+    try:
+        entries = load_manifest(args.manifest, client_SR.OUTPUT_DIR)
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run_batch(args.host, args.port, entries, args.rate, args.chunks, args.fec, args.flow)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Batch failed: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    return EXIT_OK if report["failed"] == 0 else EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
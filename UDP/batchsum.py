@@ -0,0 +1,115 @@
+# Description: Check values and headers of a batch of equal sized packets at once, with NumPy.
+#
+# pack_header computes one check value per call, so a block of PREFETCH packets costs as
+# many Python level calls and checksum runs. With INTEGRITY_ADLER32 the payloads of a block,
+# read back to back, are viewed as a (count, payload_size) uint8 array and the check values
+# of all of them are computed in one go (adler32_rows):
+#   A = 1 + sum of the bytes       B = L + sum of (L - i) x byte i      (both mod 65521)
+# over prefix + payload (L bytes), the same value as zlib.adler32, so peers without NumPy
+# check the packets one by one with zlib. The weighted sum is a float32 matrix product over
+# CHUNK byte pieces of the rows, exact since every partial sum stays below 2**24. The headers
+# are then written as one structured array.
+#
+# Only the opt-in INTEGRITY_ADLER32 scheme (and INTEGRITY_NONE) is vectorized: with the
+# default CRC-32 and with BLAKE2b, which have no vectorized form worth having, and without
+# NumPy, the headers are packed by the per packet functions of utils.py. Only the sender
+# packs blocks: receivers verify every packet on arrival with verify_parts, since it is
+# acknowledged as soon as it lands. verify_block is the block counterpart bench_batch.py
+# checks pack_headers against and times.
+from utils import (HEADER_SIZE, INTEGRITY_ADLER32, INTEGRITY_NONE, PACKET_PREFIX, STAMP_OFFSET, accepts_scheme,
+                   current_integrity, pack_header, verify_parts)
+
+try:
+    import numpy as np
+except ImportError:  # Optional, see the fallbacks
+    np = None
+
+HAS_NUMPY = np is not None
+VECTOR_SCHEMES = (INTEGRITY_NONE, INTEGRITY_ADLER32)
+ADLER_MOD = 65521
+CHUNK = 256  # bytes per piece of the weighted sum, 255 x (0 + 1 + ... + 255) < 2**24
+ROW_GROUP = 64  # rows computed together, the float32 copy of more falls out of the CPU caches
+MIN_ROWS = 16  # fewer packets are checksummed one by one, NumPy call overhead dominates
+
+if HAS_NUMPY:
+    # The fields of a packed header, as in utils.pack_header
+    HEADER_DTYPE = np.dtype({"names": ["seq", "scheme", "message", "check", "stamp"],
+                             "formats": [">u4", "u1", "u1", ">u8", ">u4"],
+                             "offsets": [0, 4, 5, PACKET_PREFIX.size, STAMP_OFFSET],
+                             "itemsize": HEADER_SIZE})
+    # Column 0 sums the bytes of a piece, column 1 weighs byte j by j
+    CHUNK_WEIGHTS = np.stack([np.ones(CHUNK), np.arange(CHUNK)], axis=1).astype(np.float32)
+
+
+def adler32_rows(prefixes, payloads):
+    """zlib.adler32(prefix + payload) of every row of two uint8 arrays, (count, p) and (count, n)."""
+    count, n = payloads.shape
+    if count > ROW_GROUP:
+        return np.concatenate([adler32_rows(prefixes[i:i + ROW_GROUP], payloads[i:i + ROW_GROUP])
+                               for i in range(0, count, ROW_GROUP)])
+    p = prefixes.shape[1]
+    chunks = -(-n // CHUNK)
+    padded = np.zeros((count, chunks * CHUNK), np.float32)
+    padded[:, :n] = payloads
+    sums = (padded.reshape(-1, CHUNK) @ CHUNK_WEIGHTS).reshape(count, chunks, 2).astype(np.float64)
+    # Byte j of piece c is byte i = CHUNK x c + j of the payload, weighted n - i
+    data_a = sums[..., 0].sum(axis=1)
+    data_b = sums[..., 0] @ (n - CHUNK * np.arange(chunks)) - sums[..., 1].sum(axis=1)
+    # Byte i of the prefix comes first, weighted p + n - i
+    prefix = prefixes.astype(np.float64)
+    a = 1 + prefix.sum(axis=1) + data_a
+    b = (p + n) + prefix @ (p + n - np.arange(p)) + data_b
+    return (b.astype(np.uint64) % ADLER_MOD) << 16 | (a.astype(np.uint64) % ADLER_MOD)
+
+
+def header_rows(headers, count):
+    """headers (a buffer of count packed headers) as a structured array and as (count, HEADER_SIZE) bytes."""
+    rows = np.frombuffer(headers, HEADER_DTYPE, count)
+    return rows, np.frombuffer(headers, np.uint8, count * HEADER_SIZE).reshape(count, HEADER_SIZE)
+
+
+def pack_headers(headers, payloads, first_seq, payload_size, scheme=None):
+    """Write the headers of the packets whose payloads lie back to back in payloads (the last one
+    may be shorter), numbered from first_seq, into headers: HEADER_SIZE bytes each, the same bytes
+    pack_header writes one by one. Returns the number of packets."""
+    scheme = current_integrity() if scheme is None else scheme
+    count = -(-len(payloads) // payload_size)
+    full = len(payloads) // payload_size if HAS_NUMPY and scheme in VECTOR_SCHEMES else 0
+    if scheme == INTEGRITY_ADLER32 and full < MIN_ROWS:
+        full = 0
+    if full:
+        rows, raw = header_rows(headers, full)
+        raw[:] = 0
+        rows["seq"] = first_seq + np.arange(full)
+        rows["scheme"] = scheme
+        if scheme == INTEGRITY_ADLER32:
+            data = np.frombuffer(payloads, np.uint8, full * payload_size).reshape(full, payload_size)
+            rows["check"] = adler32_rows(raw[:, :PACKET_PREFIX.size], data)
+    headers, payloads = memoryview(headers), memoryview(payloads)
+    for i in range(full, count):
+        pack_header(headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE], first_seq + i,
+                    payloads[i * payload_size:(i + 1) * payload_size], scheme)
+    return count
+
+
+def verify_block(headers, payloads, payload_size):
+    """Check the packets whose headers and payloads lie back to back in two buffers, as
+    pack_headers writes them (see bench_batch.py). Returns a list with True for every packet
+    that verifies."""
+    count = -(-len(payloads) // payload_size)
+    full = len(payloads) // payload_size if HAS_NUMPY else 0
+    valid = [None] * count
+    if full:
+        rows, raw = header_rows(headers, full)
+        vector = rows["scheme"] == INTEGRITY_ADLER32
+        if vector.sum() >= MIN_ROWS and accepts_scheme(INTEGRITY_ADLER32):
+            data = np.frombuffer(payloads, np.uint8, full * payload_size).reshape(full, payload_size)
+            checks = adler32_rows(raw[vector, :PACKET_PREFIX.size], data[vector])
+            for i, ok in zip(np.flatnonzero(vector).tolist(), (checks == rows["check"][vector]).tolist()):
+                valid[i] = ok
+    headers, payloads = memoryview(headers), memoryview(payloads)
+    for i in range(count):
+        if valid[i] is None:
+            valid[i] = verify_parts(headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE],
+                                    payloads[i * payload_size:(i + 1) * payload_size])
+    return valid
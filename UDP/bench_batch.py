@@ -0,0 +1,78 @@
+# Description: CPU cost per GB of building and checking packet headers a block at a time.
+#
+#   python bench_batch.py [--mb 256] [--batch 64]
+#
+# For every integrity scheme, packs the headers of blocks of --batch MAX_PAYLOAD sized
+# packets with pack_header one by one (what the packetizer did before) and with
+# batchsum.pack_headers, then checks them with verify_parts one by one and with
+# batchsum.verify_block, and prints the process CPU time scaled to one GB of payload.
+# Only adler32 (opt-in) and none have a vectorized path; the default crc32 and keyed, and
+# every scheme without NumPy, fall back to the per packet functions, so their two columns match.
+import argparse
+import os
+import time
+import utils
+import batchsum
+from utils import *
+
+
+def per_packet_pack(headers, payloads, first_seq, payload_size, scheme):
+    for i in range(len(payloads) // payload_size):
+        pack_header(headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE], first_seq + i,
+                    payloads[i * payload_size:(i + 1) * payload_size], scheme)
+
+
+def per_packet_verify(headers, payloads, payload_size):
+    return [verify_parts(headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE], payloads[i * payload_size:(i + 1) * payload_size])
+            for i in range(len(payloads) // payload_size)]
+
+
+def timed(function, blocks, *args):
+    start = time.process_time()
+    results = [function(headers, payloads, *args) for headers, payloads in blocks]
+    return time.process_time() - start, results
+
+
+def run(name, scheme, blocks, batch):
+    set_integrity(scheme)
+    gb = sum(len(payloads) for _, payloads in blocks) / 1024 ** 3
+    pack_time, _ = timed(per_packet_pack, blocks, 0, MAX_PAYLOAD, scheme)
+    reference = [bytes(headers) for headers, _ in blocks]
+    batch_pack_time, _ = timed(batchsum.pack_headers, blocks, 0, MAX_PAYLOAD, scheme)
+    same = all(bytes(headers) == expected for (headers, _), expected in zip(blocks, reference))
+
+    verify_time, results = timed(per_packet_verify, blocks, MAX_PAYLOAD)
+    batch_verify_time, batch_results = timed(batchsum.verify_block, blocks, MAX_PAYLOAD)
+    ok = same and results == batch_results and all(all(block) for block in results)
+    print(f"{name:<8} pack {pack_time / gb:7.3f} -> {batch_pack_time / gb:7.3f} s/GB   "
+          f"verify {verify_time / gb:7.3f} -> {batch_verify_time / gb:7.3f} s/GB   {'ok' if ok else 'FAILED'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per packet against batch header packing and checking.")
+    parser.add_argument("--mb", type=int, default=256, help="payload megabytes per scheme")
+    parser.add_argument("--batch", type=int, default=64, help="packets per block")
+    args = parser.parse_args()
+
+    block = os.urandom(MAX_PAYLOAD * args.batch)
+    count = max(1, args.mb * 1024 * 1024 // len(block))
+    blocks = [(memoryview(bytearray(HEADER_SIZE * args.batch)), memoryview(block)) for _ in range(count)]
+    print(f"{count} blocks of {args.batch} packets of {MAX_PAYLOAD} bytes per scheme, "
+          f"NumPy {batchsum.np.__version__ if batchsum.HAS_NUMPY else 'not installed'}\n")
+    if batchsum.HAS_NUMPY:
+        vector = [name for name, scheme in INTEGRITY_NAMES.items()
+                  if scheme in batchsum.VECTOR_SCHEMES and scheme != INTEGRITY_NONE]
+        scalar = [name for name, scheme in INTEGRITY_NAMES.items() if scheme not in batchsum.VECTOR_SCHEMES]
+        print(f"Vectorized: {', '.join(vector)} (opt-in). One packet at a time: {', '.join(scalar)} "
+              f"(the default is {integrity_name(INTEGRITY_CRC32)}).")
+    else:
+        print("Without NumPy every scheme is handled one packet at a time.")
+    print("per packet -> batch")
+
+    utils.integrity_key = utils.integrity_key or os.urandom(32)
+    for name, scheme in INTEGRITY_NAMES.items():
+        run(name, scheme, blocks, args.batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Description: CPU cost per GB of the per packet integrity schemes.
+#
+#   python bench_integrity.py [--mb 256]
+#
+# Packs and verifies MAX_PAYLOAD sized packets with every scheme and prints the
+# process CPU time scaled to one GB of payload. "md5-hex" is the previous
+# 32-byte ASCII MD5 header, kept here as the baseline.
+import argparse
+import hashlib
+import os
+import struct
+import time
+import utils
+from utils import *
+
+
+def legacy_make_packet(seq_num, data):
+    header = struct.pack('!I', seq_num)
+    return struct.pack('!32s', hashlib.md5(header + data).hexdigest().encode()) + header + data
+
+
+def legacy_verify_packet(packet):
+    return packet[:32].decode() == hashlib.md5(packet[32:]).hexdigest()
+
+
+def run(name, make, verify, payloads):
+    start = time.process_time()
+    packets = [make(seq, data) for seq, data in enumerate(payloads)]
+    pack_time = time.process_time() - start
+
+    start = time.process_time()
+    ok = all(verify(packet) for packet in packets)
+    verify_time = time.process_time() - start
+
+    gb = sum(len(data) for data in payloads) / 1024 ** 3
+    header = len(packets[0]) - len(payloads[0])
+    print(f"{name:<10} header {header:>2} B   pack {pack_time / gb:7.3f} s/GB   verify {verify_time / gb:7.3f} s/GB"
+          f"   {'ok' if ok else 'FAILED'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the UDP packet integrity schemes.")
+    parser.add_argument("--mb", type=int, default=256, help="payload megabytes per scheme")
+    args = parser.parse_args()
+
+    count = args.mb * 1024 * 1024 // MAX_PAYLOAD
+    block = os.urandom(MAX_PAYLOAD * 64)
+    payloads = [block[(i % 64) * MAX_PAYLOAD:(i % 64 + 1) * MAX_PAYLOAD] for i in range(count)]
+    print(f"{count} packets of {MAX_PAYLOAD} bytes per scheme\n")
+
+    run("md5-hex", legacy_make_packet, legacy_verify_packet, payloads)
+    utils.integrity_key = utils.integrity_key or os.urandom(32)
+    for name, scheme in INTEGRITY_NAMES.items():
+        set_integrity(scheme)
+        run(name, make_packet, verify_packet, payloads)
+
+
+if __name__ == "__main__":
+    main()
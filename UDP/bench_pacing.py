@@ -0,0 +1,53 @@
+# Description: Accuracy of the token bucket pacer.
+#
+#   python bench_pacing.py [--seconds 2] [--host 127.0.0.1 --port 9]
+#
+# Sends MAX_PAYLOAD sized datagrams through Pacer at several target rates and prints
+# the achieved rate, the mean and p99 lateness of paced releases and the spread of the
+# gaps between batches. The datagrams go to a discard address so only the scheduler
+# and sendto are measured.
+import argparse
+import socket
+import statistics
+import time
+from pacing import Pacer, PACING_BATCH
+from utils import HEADER_SIZE, MAX_PAYLOAD, tune_socket
+
+RATES_MBPS = [10, 50, 100, 400, 1000]
+
+
+def run(sock, addr, rate, seconds):
+    packet = bytes(HEADER_SIZE + MAX_PAYLOAD)
+    pacer = Pacer(rate=rate, packet_size=len(packet))
+    release_times = []
+
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pacer.wait(len(packet))
+        sock.sendto(packet, addr)
+        release_times.append(time.perf_counter())
+
+    stats = pacer.stats()
+    gaps = [b - a for a, b in zip(release_times[PACING_BATCH - 1::PACING_BATCH], release_times[2 * PACING_BATCH - 1::PACING_BATCH])]
+    expected_gap = PACING_BATCH * len(packet) / rate
+    jitter = statistics.pstdev(gaps) if len(gaps) > 1 else 0.0
+    achieved = stats["achieved_rate"] or 0.0
+    print(f"{rate * 8 / 1e6:7.0f} Mbit/s   achieved {achieved * 8 / 1e6:7.1f} Mbit/s ({achieved / rate:6.1%})"
+          f"   late mean {stats.get('mean_error_us', 0):7.1f} us  p99 {stats.get('p99_error_us', 0):7.1f} us"
+          f"   batch gap {expected_gap * 1e6:7.1f} us +- {jitter * 1e6:6.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pacing accuracy of the UDP sender.")
+    parser.add_argument("--seconds", type=float, default=2.0, help="duration per rate")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9, help="discard port, nothing needs to listen")
+    args = parser.parse_args()
+
+    with tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+        for mbps in RATES_MBPS:
+            run(sock, (args.host, args.port), mbps * 1e6 / 8, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+# Description: Rate-based UDP blast with loss reports over a TCP control connection.
+#
+# The hybrid transport of hybrid_server.py and hybrid_client.py, in the style of Tsunami and
+# UDT: commands and their answers travel over a TCP connection (ControlChannel), so they are
+# never lost, reordered or mistaken for data, and the UDP socket only carries file data.
+# BlastSender sends the packets of a range at the rate of its Pacer without waiting for any
+# acknowledgement. BlastReceiver places them in the output file like PlacedReceiver does and
+# every REPORT_INTERVAL sends a report over the control connection:
+#
+#   MISSING <loss> <receive rate> <queue delay> <first>-<last> <index> ...
+#
+# with the packet indices it is missing below the highest one received (the whole tail too
+# once nothing arrived for a while), the share of the packets it skipped since the last loss
+# sample (- before LOSS_SAMPLE of them), the bytes per second it received since the last
+# report and the milliseconds the data queues on its way (see BlastReceiver.on_packet). The
+# sender resends the reported packets before any new one and adjusts its rate: up by
+# RATE_INCREASE while the loss stays under LOSS_TARGET and the queue delay under DELAY_TARGET
+# (to at most RATE_HEADROOM times the receive rate), down towards the receive rate when the
+# loss is higher or the queue delay twice as high, so a deep bottleneck buffer does not have
+# to overflow before the sender slows down. DONE ends the transfer. An index is not reported again before the resent packet had the
+# time to arrive, see BlastReceiver.
+import collections
+import socket
+import time
+from pacing import SPIN_THRESHOLD, Pacer, precise_sleep
+from placement import PlacedReceiver
+from utils import (BUFFER_SIZE, FORMAT, HEADER_SIZE, MAX_IDLE, MAX_PAYLOAD, extract_stamp, is_parity, packet_size,
+                   send_packet, timestamp)
+
+REPORT_INTERVAL = 0.1  # seconds between two reports of the receiver
+MAX_REPORT_RANGES = 512  # missing ranges per report, the rest goes into the next one
+LOSS_SAMPLE = 64  # new packets a loss rate is measured over
+REORDER_SLACK = 16  # packets below the highest one that may still arrive late, not counted as lost yet
+LOSS_TARGET = 0.02  # loss rate up to which the sender keeps speeding up
+DELAY_TARGET = 0.05  # seconds of queue delay up to which the sender keeps speeding up
+START_RATE = 4 * 1024 * 1024  # bytes per second of a new transfer
+MIN_RATE = 64 * 1024  # bytes per second
+RATE_INCREASE = 1.25  # per report under LOSS_TARGET
+RATE_DECREASE = 0.85  # per report over LOSS_TARGET, unless the receive rate is lower
+MAX_DECREASE = 0.5  # never below this fraction of the rate at once
+RATE_HEADROOM = 1.25  # the rate grows to at most this many times what the receiver gets
+POLL_EVERY = 32  # packets sent between two looks at the control connection
+
+
+class ControlChannel:
+    """Line protocol over a TCP connection. Requests are lines, answers are OK <length>
+    followed by length bytes, or ERROR <reason>."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.rtt = None  # Shortest round trip of a call, seconds
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    def send(self, data):
+        self.sock.settimeout(None)  # poll may have left the socket non-blocking
+        self.sock.sendall(data)
+
+    def send_line(self, line):
+        self.send(line.encode(FORMAT) + b"\n")
+
+    def reply(self, body=""):
+        data = body.encode(FORMAT)
+        self.send(f"OK {len(data)}\n".encode(FORMAT) + data)
+
+    def error(self, reason):
+        self.send_line(f"ERROR {reason}")
+
+    def fill(self, timeout):
+        """Receive what arrives within timeout seconds (None: until something does)."""
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(BUFFER_SIZE)
+        except (socket.timeout, BlockingIOError):
+            return False
+        if not data:
+            raise ConnectionError("control connection closed")
+        self.buffer += data
+        return True
+
+    def read_line(self, timeout=None):
+        while b"\n" not in self.buffer:
+            if not self.fill(timeout):
+                raise TimeoutError("no line on the control connection")
+        line, _, rest = self.buffer.partition(b"\n")
+        self.buffer = bytearray(rest)
+        return line.decode(FORMAT)
+
+    def read_exact(self, size, timeout=None):
+        while len(self.buffer) < size:
+            if not self.fill(timeout):
+                raise TimeoutError("control connection stalled")
+        data, self.buffer = bytes(self.buffer[:size]), self.buffer[size:]
+        return data
+
+    def poll(self, timeout=0):
+        """The next line if it was received already or arrives within timeout seconds, else None."""
+        if b"\n" not in self.buffer and not self.fill(timeout) or b"\n" not in self.buffer:
+            return None
+        line, _, rest = self.buffer.partition(b"\n")
+        self.buffer = bytearray(rest)
+        return line.decode(FORMAT)
+
+    def call(self, request, timeout=None):
+        """Send a request line and return the body of its answer. Raises ValueError on ERROR."""
+        start = time.monotonic()
+        self.send_line(request)
+        header = self.read_line(timeout).split(maxsplit=1)
+        rtt = time.monotonic() - start
+        self.rtt = rtt if self.rtt is None else min(self.rtt, rtt)
+        if not header or header[0] != "OK":
+            raise ValueError(header[1] if len(header) > 1 else "malformed answer")
+        return self.read_exact(int(header[1]), timeout).decode(FORMAT)
+
+    def close(self):
+        self.sock.close()
+
+
+def format_ranges(indices):
+    """'first-last' and 'index' words for sorted packet indices."""
+    words = []
+    first = last = None
+    for index in indices:
+        if first is not None and index == last + 1:
+            last = index
+            continue
+        if first is not None:
+            words.append(f"{first}-{last}" if last > first else str(first))
+        first = last = index
+    if first is not None:
+        words.append(f"{first}-{last}" if last > first else str(first))
+    return words
+
+
+def parse_ranges(words):
+    """(first, last) pairs of 'first-last' and 'index' words, malformed words skipped."""
+    ranges = []
+    for word in words:
+        first, _, last = word.partition("-")
+        if first.isdigit() and (not last or last.isdigit()):
+            ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+class BlastSender:
+    """Sends the packets of a range to addr at a paced rate, resends what the receiver reports
+    missing over control and ends with its DONE."""
+
+    def __init__(self, sock, addr, packets, control, rate=None, max_rate=0):
+        self.sock = sock
+        self.addr = addr
+        self.packets = packets
+        self.control = control
+        self.max_rate = max_rate or None
+        self.rate = min(rate or START_RATE, self.max_rate or float("inf"))
+        self.pacer = Pacer(self.rate, packet_size=HEADER_SIZE + MAX_PAYLOAD)
+        self.next_new = 0  # Index of the first packet never sent
+        self.resend = collections.deque()  # Indices reported missing, sent before new ones
+        self.queued = set()
+        self.header = bytearray(HEADER_SIZE)
+        self.finished = False
+        self.last_report = time.monotonic()
+        self.sent = 0
+        self.resent = 0
+        self.reports = 0
+        self.slowdowns = 0
+
+    def next_index(self):
+        if self.resend:
+            return self.resend[0]
+        if self.next_new < len(self.packets):
+            return self.next_new
+        return None
+
+    def run(self):
+        """Blast until the receiver is done. Returns True, raises TimeoutError if it went silent."""
+        since_poll = 0
+        while not self.finished:
+            index = self.next_index()
+            if index is None:
+                self.poll(REPORT_INTERVAL)  # Everything sent once, waiting for reports
+                continue
+            packet = self.packets[index]
+            wait = self.pacer.delay(packet_size(packet))
+            if wait > SPIN_THRESHOLD:
+                self.poll(wait - SPIN_THRESHOLD)  # Waiting for tokens is waiting for reports
+                continue
+            if wait > 0:
+                precise_sleep(time.perf_counter() + wait)
+            if since_poll >= POLL_EVERY:
+                since_poll = 0
+                self.poll(0)
+                continue
+            self.pacer.consume(packet_size(packet))
+            send_packet(self.sock, self.addr, packet, timestamp(), self.header)
+            since_poll += 1
+            if self.resend and index == self.resend[0]:
+                self.queued.discard(self.resend.popleft())
+                self.resent += 1
+            else:
+                self.next_new += 1
+                self.sent += 1
+        return True
+
+    def poll(self, timeout):
+        # Lines after DONE are the next requests of the client, they stay in the channel
+        line = self.control.poll(timeout)
+        while line is not None:
+            self.on_line(line)
+            line = None if self.finished else self.control.poll(0)
+        if time.monotonic() - self.last_report > MAX_IDLE:
+            raise TimeoutError("receiver stopped reporting")
+
+    def on_line(self, line):
+        words = line.split()
+        if words and words[0] == "DONE":
+            self.finished = True
+        elif words and words[0] == "MISSING" and len(words) >= 4:
+            self.last_report = time.monotonic()
+            self.reports += 1
+            for first, last in parse_ranges(words[4:]):
+                for index in range(max(first, 0), min(last + 1, self.next_new)):
+                    if index not in self.queued:
+                        self.queued.add(index)
+                        self.resend.append(index)
+            loss = None if words[1] == "-" else float(words[1])
+            self.adjust_rate(loss, float(words[2]), float(words[3]) / 1000)
+
+    def adjust_rate(self, loss, receive_rate, queue_delay):
+        """loss is None if the report carries no loss sample, then only the queue delay counts."""
+        if loss is not None and loss > LOSS_TARGET:
+            rate = self.rate * RATE_DECREASE
+            if receive_rate > 0:
+                rate = max(self.rate * MAX_DECREASE, min(rate, receive_rate))
+            self.slowdowns += 1
+        elif queue_delay > 2 * DELAY_TARGET:
+            # Below what gets through, so the queue drains, without compounding while it does
+            rate = min(self.rate, receive_rate * RATE_DECREASE) if receive_rate > 0 else self.rate * RATE_DECREASE
+            self.slowdowns += 1
+        elif loss is None or queue_delay > DELAY_TARGET:
+            return  # No news, or the bottleneck queue is filling up: hold the rate
+        else:
+            rate = self.rate * RATE_INCREASE
+            if receive_rate > 0:
+                rate = max(self.rate, min(rate, receive_rate * RATE_HEADROOM))
+        self.rate = max(MIN_RATE, min(rate, self.max_rate or rate))
+        self.pacer.set_rate(self.rate)
+
+    def stats(self):
+        return {"packets": len(self.packets), "sent": self.sent, "resent": self.resent, "reports": self.reports,
+                "slowdowns": self.slowdowns, "rate": round(self.rate)}
+
+
+class BlastReceiver(PlacedReceiver):
+    """PlacedReceiver for a blast: nothing is acknowledged on the data socket, the missing
+    packets are reported over control instead. join is sent to join_addr until the first
+    packet arrives. rtt is the round trip of the control connection; the data may queue on
+    its way on top of it, which the send timestamps of the packets tell."""
+
+    def __init__(self, client, control, target, payload_size, join, join_addr, rtt=None):
+        super().__init__(client, 0, target, payload_size)
+        self.control = control
+        self.join = join
+        self.join_addr = join_addr
+        self.rtt = rtt or REPORT_INTERVAL
+        self.base_delay = None  # Smallest arrival minus send timestamp, microseconds (clock offset included)
+        self.queue_delay = 0.0  # Seconds the last packet took longer than that
+        self.next_report = time.monotonic() + REPORT_INTERVAL
+        self.reported = {}  # Index -> when it was last reported missing
+        self.sampled = 0  # Index the next loss sample starts at
+        self.interval_bytes = 0
+        self.interval_start = time.monotonic()
+        self.reports = 0
+
+    def start(self):
+        self.client.sendto(self.join, self.join_addr)
+
+    def acknowledge(self):
+        self.unacked, self.ack_deadline = 0, None  # The reports stand in for ACKs
+
+    def update_credit(self):
+        if time.monotonic() >= self.next_report:
+            self.report()
+
+    def next_timeout(self):
+        return max(self.next_report - time.monotonic(), 0.0001)
+
+    def on_quiet(self, idle):
+        if idle > MAX_IDLE:
+            raise TimeoutError("sender stopped sending")
+        if self.highest < 0:
+            self.start()  # Our JOIN may have been lost
+            self.next_report = time.monotonic() + REPORT_INTERVAL
+        elif time.monotonic() >= self.next_report:
+            self.report(tail=idle >= self.holdoff())
+
+    def on_packet(self, header, payload, slot_index):
+        if not is_parity(header):
+            self.interval_bytes += len(payload)
+        delay = (timestamp() - extract_stamp(header)) & 0xFFFFFFFF
+        if self.base_delay is None or (delay - self.base_delay) & 0xFFFFFFFF > 0x7FFFFFFF:
+            self.base_delay = delay
+        self.queue_delay = ((delay - self.base_delay) & 0xFFFFFFFF) / 1e6
+        return super().on_packet(header, payload, slot_index)
+
+    def holdoff(self):
+        """Seconds before a reported packet may be reported again: the report's trip, the way
+        back of the resent packet behind the queue and a report more."""
+        return 2 * self.rtt + self.queue_delay + REPORT_INTERVAL
+
+    def missing(self, end):
+        """Indices below end not received, skipping whole bytes of the bitmap that are complete."""
+        index = self.expected
+        while index < end:
+            if self.received[index >> 3] == 0xFF:
+                index = (index | 7) + 1
+                continue
+            if not self.has(index):
+                yield index
+            index += 1
+
+    def count_received(self, start, end):
+        bits = int.from_bytes(self.received[start >> 3:(end + 7) >> 3], 'little') >> (start & 7)
+        return (bits & ((1 << (end - start)) - 1)).bit_count()
+
+    def report(self, tail=False):
+        """Report the missing packets (up to the end of the range if tail), the loss rate and the
+        receive rate over control."""
+        now = time.monotonic()
+        end = self.count if tail else self.highest
+        holdoff = self.holdoff()
+        indices = []
+        words = 0
+        for index in self.missing(end):
+            if now - self.reported.get(index, -holdoff) < holdoff:
+                continue
+            if not indices or index != indices[-1] + 1:
+                words += 1
+                if words > MAX_REPORT_RANGES:
+                    break
+            indices.append(index)
+            self.reported[index] = now
+        for index in [index for index in self.reported if index < self.expected]:
+            del self.reported[index]
+
+        # Measured before any resend of these packets could arrive, so it is the loss of the path
+        sample_end = self.highest - REORDER_SLACK
+        loss = "-"
+        if sample_end - self.sampled >= LOSS_SAMPLE:
+            lost = sample_end - self.sampled - self.count_received(self.sampled, sample_end)
+            loss = f"{lost / (sample_end - self.sampled):.4f}"
+            self.sampled = sample_end
+        elapsed = max(now - self.interval_start, 1e-6)
+        rate = int(self.interval_bytes / elapsed)
+        self.interval_bytes, self.interval_start = 0, now
+
+        words = ["MISSING", loss, str(rate), f"{self.queue_delay * 1000:.1f}"] + format_ranges(indices)
+        self.control.send_line(" ".join(words))
+        self.next_report = now + REPORT_INTERVAL
+        self.reports += 1
+
+    def run(self, progress=None):
+        self.start()
+        return super().run(progress)
+
+    def stats(self):
+        stats = super().stats()
+        stats["reports"] = self.reports
+        return stats
@@ -2,16 +2,87 @@ import socket
 import threading
 import sys
 from utils import *
+from fec import FecDecoder, FEC_CODES, data_payload
+from placement import MappedRange, receive_into
+from pmtu import discover_payload_size
 
 
 HOST = socket.gethostbyname(socket.gethostname())
-HOST = '192.168.1.42'
 PORT = 12345
 ADDR = (HOST, PORT)
 NUM_OF_CHUNKS = 4
 MAX_RETRIES = 3
 OUTPUT_DIR = os.path.join(CUR_PATH, "output")
 INPUT_FILE = os.path.join(CUR_PATH, "input.txt")
+INTEGRITY = "crc32"  # Per packet integrity to ask for: "crc32", "keyed" (needs RDT_KEY) or "none"
+MAX_RATE = 0  # Ask the server to send at most this many bytes per second, 0: no cap
+CONGESTION = "cubic"  # Congestion control the server uses for our transfers: "newreno", "cubic", "bbr" or "adaptive"
+FEC = "none"  # Forward error correction to ask for on lossy links: "none", "xor" or "rs" (Reed-Solomon)
+PATH_MTU_DISCOVERY = True  # Probe the largest unfragmented datagram when connecting, else MAX_PAYLOAD
+FLOW_CONTROL = "credit"  # "credit": the server sends as far as our advertised credit goes, "pull": only what we grant
+FLOW_MODES = ("credit", "pull")
+ZERO_COPY = True  # Receive packets straight into the memory-mapped output file (fixed packet size)
+
+# Payload size found to cross the path unfragmented, per server address
+path_payloads = {}
+
+
+def set_server(host, port=PORT):
+    global HOST, PORT, ADDR
+    HOST, PORT = host, port
+    ADDR = (HOST, PORT)
+
+
+def open_session(client, integrity=None, session=False):
+    """Handshake with the server and negotiate the integrity scheme, process wide or
+    (session=True) only for the calling thread. Returns the welcome message or None on failure."""
+    integrity = integrity or INTEGRITY
+    if integrity not in INTEGRITY_NAMES:
+        raise ValueError(f"unknown integrity scheme {integrity}")
+    
+    set_integrity(DEFAULT_INTEGRITY, session=session)
+    msg_hello = make_packet(0, f"CONNECT {integrity}".encode())
+    ack = send_rdt(client, ADDR, msg_hello, max_attempts=MAX_RETRIES)
+    if ack != 1:
+        return None
+    welcome, _, _ = recv_rdt(client, 0, {})
+    
+    # The server answers with the scheme it agreed to, older servers do not answer at all
+    lines = welcome.decode().splitlines()
+    if lines and lines[-1].startswith("INTEGRITY"):
+        set_integrity(INTEGRITY_NAMES[lines.pop().split()[1]], session=session)
+    
+    if PATH_MTU_DISCOVERY and ADDR not in path_payloads:
+        payload_size = discover_payload_size(client, ADDR)
+        if payload_size is not None:
+            path_payloads[ADDR] = payload_size
+            print(f"Path to {ADDR} carries {payload_size} byte payloads unfragmented.")
+    return "\n".join(lines)
+
+
+def close_session(client):
+    msg_exit = make_packet(0, "EXIT\n".encode())
+    closed = send_rdt(client, ADDR, msg_exit, max_attempts=MAX_RETRIES) == 1
+    forget_session(client, ADDR)
+    return closed
+
+
+def fetch_file_size(client, filename):
+    msg_size = make_packet(0, f"SIZE {filename}\n".encode())
+    ack = send_rdt(client, ADDR, msg_size)
+    if ack != 1:
+        return None
+    file_size, _, _ = recv_rdt(client, 0, {})
+    return int(file_size.decode())
+
+
+def fetch_file_hash(client, filename):
+    msg_hash = make_packet(0, f"HASH {filename}\n".encode())
+    ack = send_rdt(client, ADDR, msg_hash)
+    if ack != 1:
+        return None
+    file_hash, _, _ = recv_rdt(client, 0, {})
+    return file_hash.decode().strip()
 
 
 def fetch_file_list(client):
@@ -43,67 +114,167 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
             sys.stdout.write('\n')
 
 
-def download_file(client, filename, offset, total_size):
+def download_file(client, filename, offset, total_size, target=None, stats=None, congestion=None, max_rate=None,
+                  preallocated=False, progress=None, fec=None, flow=None):
+    """Download total_size bytes of filename into OUTPUT_DIR (or target). Returns the bytes received.
+
+    With preallocated the bytes are written at offset of an existing target instead of
+    replacing it. progress(received) replaces the progress bar."""
+    if total_size == 0:
+        if not preallocated:
+            open(target or os.path.join(OUTPUT_DIR, filename), "wb").close()
+        return 0  # Nothing to request, no packet would ever come
     retry_count = 0
+    total_received = 0
     seq_num = 0
-    progress = 0
     packets = []
     while retry_count < MAX_RETRIES:
         try:
-            request = f"REQUEST {filename} {offset} {total_size} {seq_num}\n".encode()          
+            rate = MAX_RATE if max_rate is None else max_rate
+            fec = fec or FEC
+            if fec not in FEC_CODES:
+                raise ValueError(f"unknown FEC scheme {fec}")
+            flow = flow or FLOW_CONTROL
+            if flow not in FLOW_MODES:
+                raise ValueError(f"unknown flow control {flow}")
+            payload_size = path_payloads.get(ADDR, MAX_PAYLOAD)
+            placement = ZERO_COPY  # Needs every packet of the range at the same size
+            request = (f"REQUEST {filename} {offset} {total_size} {seq_num} {congestion or CONGESTION} {int(rate)} {fec} "
+                       f"{payload_size} {flow} {'fixed' if placement else 'adaptive'}\n").encode()          
             msg_request = make_packet(0, request)
             ack = send_rdt(client, ADDR, msg_request)
             
             if ack != 1:
                 print(f"Failed to request file {filename}.")
-                return
+                return total_received
             
-            print("OK")
-            chunk_path = os.path.join(OUTPUT_DIR, filename)
+            chunk_path = target or os.path.join(OUTPUT_DIR, filename)
             total_received = 0
+            decoder = FecDecoder() if fec != "none" else None
+            pull_from = ADDR if flow == "pull" else None
 
-            with open(chunk_path, "wb") as chunk_file:
-                adaptive_window = AdaptiveWindow()
-                receiver = modified_sliding_window_recv(client, seq_num, adaptive_window)
-                
-                for data in receiver:
-                    if total_received >= total_size:
-                        receiver.close()  # Signal completion
-                        break
-                    
-                    for seq, packet in data.items():
-                        chunk_file.write(packet)
-                        total_received += len(packet)
-                        progress = total_received
-                        print_progress_bar(progress, total_size, prefix="Downloading", suffix=f"of {filename}")
+            def report(received):
+                if stats is not None and stats["first_byte"] is None:
+                    stats["first_byte"] = time.monotonic()
+                if progress is not None:
+                    progress(received)
+                else:
+                    print_progress_bar(received, total_size, prefix="Downloading", suffix=f"of {filename}")
+
+            if placement:
+                # Packets are received straight into the mapped file, see placement.py
+                if not preallocated:
+                    open(chunk_path, "wb").close()
+                with MappedRange(chunk_path, offset if preallocated else 0, total_size) as mapped:
+                    total_received, _ = receive_into(client, seq_num, mapped.view, data_payload(payload_size, FEC_CODES[fec]),
+                                                     decoder, pull_from, report)
+            else:
+                with open(chunk_path, "r+b" if preallocated else "wb") as chunk_file:
+                    if preallocated:
+                        chunk_file.seek(offset)
+                    receiver = modified_sliding_window_recv(client, seq_num, fec=decoder, pull_from=pull_from)
                     
-                    if total_received >= total_size:
-                        print(f"Finished downloading {filename}\n")
-                        break
-                break
+                    for data in receiver:
+                        for seq, packet in data.items():
+                            chunk_file.write(packet)
+                            total_received += len(packet)
+                            report(total_received)
+                        
+                        if total_received >= total_size:
+                            receiver.close()  # Sends the SACK of the last packets
+                            break
+
+            if decoder is not None and stats is not None:
+                stats["recovered"] = stats.get("recovered", 0) + decoder.recovered
+            if progress is None:
+                print(f"Finished downloading {filename}\n")
+            
+            # Without per packet integrity the whole file is checked end-to-end
+            if current_integrity() == INTEGRITY_NONE and offset == 0 and not preallocated:
+                if fetch_file_hash(client, filename) != file_checksum(chunk_path):
+                    total_received = 0
+                    raise ValueError(f"hash mismatch for {filename}")
+            break
         except Exception as e:
             retry_count += 1
+            if stats is not None:
+                stats["retries"] += 1
             if retry_count == MAX_RETRIES:
                 print(f"Error downloading file {filename}: {e}")
             else:
                 print(f"Retrying download of {filename}...")
+    
+    return total_received
+
+def download_file_parallel(client, filename, total_size, target=None, stats=None, congestion=None, max_rate=None,
+                           chunks=NUM_OF_CHUNKS, fec=None, flow=None):
+    """Download filename as chunks byte ranges at once, like the TCP client does. Returns the bytes received.
+
+    Every range has its own socket and session, so its own sequence space, RTT estimate and
+    congestion controller on the server, and is written in place into a preallocated file.
+    client is only used for the end-to-end hash when packets carry no integrity check."""
+    path = target or os.path.join(OUTPUT_DIR, filename)
+    chunks = max(1, min(chunks, -(-total_size // MAX_PAYLOAD)))  # No ranges of less than a packet
+    chunk_size = total_size // chunks
+    ranges = [(i * chunk_size, chunk_size) for i in range(chunks)]
+    ranges[-1] = (ranges[-1][0], total_size - ranges[-1][0])  # Remainder goes to the last chunk
+
+    with open(path, "wb") as f:
+        f.truncate(total_size)
+    if total_size == 0:
+        return 0
+
+    # A rate cap applies to the whole file, not to every range
+    rate = MAX_RATE if max_rate is None else max_rate
+    rate = rate / chunks if rate else 0
+    received = [0] * chunks
+
+    def update(part_id, total_received):
+        received[part_id] = total_received
+        print_progress_bar(sum(received), total_size, prefix="Downloading", suffix=f"of {filename} ({chunks} chunks)")
+
+    def download_chunk(part_id, offset, size):
+        with tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as chunk_client:
+            if open_session(chunk_client, session=True) is None:
+                print(f"\nFailed to open a session for chunk {part_id} of {filename}.")
+                return
+            try:
+                received[part_id] = download_file(chunk_client, filename, offset, size, target=path, stats=stats,
+                                                  congestion=congestion, max_rate=rate, preallocated=True,
+                                                  progress=lambda total_received: update(part_id, total_received),
+                                                  fec=fec, flow=flow)
+            finally:
+                close_session(chunk_client)
+
+    threads = [threading.Thread(target=download_chunk, args=(i, offset, size), daemon=True)
+               for i, (offset, size) in enumerate(ranges)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total_received = sum(received)
+    if total_received >= total_size:
+        print(f"Finished downloading {filename}\n")
+        if current_integrity() == INTEGRITY_NONE and fetch_file_hash(client, filename) != file_checksum(path):
+            print(f"Error downloading file {filename}: hash mismatch")
+            return 0
+    return total_received
 
 def main():
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+    set_server(input("Enter the server IP address: "))
+    
+    with tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as client:
         print("Connecting to the server...")
         try:
             # Handshake - CONNECT
-            msg_hello = make_packet(0, "CONNECT".encode())
-            ack = send_rdt(client, ADDR, msg_hello)
-            if ack != 1:
+            welcome = open_session(client)
+            if welcome is None:
                 print("Failed to connect to the server.")
                 return
             else:
                 print("Connected to the server.")
-            
-            # Receive welcome message
-            welcome, _, _ = recv_rdt(client, 0, {})
-            print(welcome.decode())
+            print(welcome)
 
             
             available_files = fetch_file_list(client)
@@ -129,34 +300,23 @@ def main():
                     continue  # Skip unavailable files
                 
                 # Request file size
-                msg_size = make_packet(0, f"SIZE {filename}\n".encode())
-                ack = send_rdt(client, ADDR, msg_size)
-                if ack != 1:
+                file_size = fetch_file_size(client, filename)
+                if file_size is None:
                     print("Failed to fetch file size.")
                     return
-                
-                # Receive file size
-                file_size, _, _ = recv_rdt(client, 0, {})
-                file_size = int(file_size.decode())
                 print(f"Size of {filename}: {file_size}")
                 
                 print("Downloading requested files...")
-                download_file(client, filename, 0, file_size)
+                download_file_parallel(client, filename, file_size)
 
             print("Finished downloading requested files.")
             input("Press Enter to exit...")
-            msg_exit = make_packet(0, "EXIT\n".encode())
-
-            ack = send_rdt(client, ADDR, msg_exit)
-            if ack != 1:
+            if not close_session(client):
                 print("Failed to exit the server.")
                 return
         except KeyboardInterrupt:
             print("\nExiting...")
-            msg_exit = make_packet(0, "EXIT\n".encode())
-
-            ack = send_rdt(client, ADDR, msg_exit)
-            if ack != 1:
+            if not close_session(client):
                 print("Failed to exit the server.")
                 return
             
@@ -4,7 +4,7 @@ import sys
 import signal
 from utils import *
 
-HOST = input("Enter the server IP address: ")
+HOST = socket.gethostbyname(socket.gethostname())
 PORT = 12345
 ADDR = (HOST, PORT)
 NUM_OF_CHUNKS = 4
@@ -163,7 +163,10 @@ def monitor_input(client, available_files):
             
 
 def main():
-    global is_running
+    global is_running, HOST, ADDR
+    
+    HOST = input("Enter the server IP address: ")
+    ADDR = (HOST, PORT)
     
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
         print("Connecting to the server ...")
@@ -0,0 +1,325 @@
+# Description: Congestion controllers for the selective repeat sender.
+#
+# Every controller exposes the same interface to SelectiveRepeatSender:
+#   window_size              packets the sender may keep in flight
+#   pacing_rate              target sending rate in bytes per second (None: unpaced)
+#   on_ack(count, rtt)       count packets newly acknowledged, rtt sample in seconds or None
+#   on_loss()                a packet was fast-retransmitted
+#   on_timeout()             a retransmission timer expired
+# and records (time, event, cwnd, pacing rate) in trace for analysis.
+import csv
+import math
+import time
+from collections import deque
+from utils import AdaptiveWindow, MAX_PAYLOAD, RECEIVE_WINDOW, INITIAL_TIMEOUT
+
+INITIAL_CWND = 10  # packets
+MIN_CWND = 2
+DEFAULT_CONGESTION = "cubic"
+
+
+class CongestionControl:
+    name = "base"
+
+    def __init__(self, packet_size=MAX_PAYLOAD, max_cwnd=RECEIVE_WINDOW, trace=False):
+        self.packet_size = packet_size
+        self.max_cwnd = max_cwnd
+        self.cwnd = float(INITIAL_CWND)
+        self.ssthresh = float(max_cwnd)
+        self.srtt = None
+        self.min_rtt = None
+        self.loss_events = 0
+        self.timeouts = 0
+        self.acked = 0
+        self.last_reduction = -math.inf
+        self.trace = [] if trace else None
+        self.start = time.monotonic()
+
+    @property
+    def window_size(self):
+        return max(1, min(self.max_cwnd, int(self.cwnd)))
+
+    @property
+    def pacing_rate(self):
+        # One window per smoothed RTT, with headroom so pacing never limits the window:
+        # 2x while the window doubles in slow start, 1.25x afterwards (as Linux does)
+        if not self.srtt:
+            return None
+        gain = 2.0 if self.cwnd < self.ssthresh else 1.25
+        return gain * self.cwnd * self.packet_size / self.srtt
+
+    def record(self, event):
+        if self.trace is not None:
+            self.trace.append((round(time.monotonic() - self.start, 6), event, round(self.cwnd, 2), self.pacing_rate))
+
+    def update_rtt(self, rtt):
+        if rtt is None:
+            return
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+    def in_recovery(self):
+        # One window reduction per round trip, like NewReno's recovery episode
+        return time.monotonic() - self.last_reduction < (self.srtt or INITIAL_TIMEOUT)
+
+    def on_ack(self, count, rtt=None):
+        self.update_rtt(rtt)
+        self.acked += count
+        self.increase(count)
+        self.cwnd = min(self.cwnd, float(self.max_cwnd))
+        self.record("ack")
+
+    def on_loss(self):
+        self.loss_events += 1
+        if not self.in_recovery():
+            self.last_reduction = time.monotonic()
+            self.decrease()
+        self.record("loss")
+
+    def on_timeout(self):
+        self.timeouts += 1
+        self.last_reduction = time.monotonic()
+        self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+        self.cwnd = 1.0
+        self.record("timeout")
+
+    def increase(self, count):
+        raise NotImplementedError
+
+    def decrease(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"algorithm": self.name, "cwnd": round(self.cwnd, 2), "ssthresh": round(self.ssthresh, 2),
+                "pacing_rate": self.pacing_rate, "srtt": self.srtt, "min_rtt": self.min_rtt,
+                "loss_events": self.loss_events, "timeouts": self.timeouts, "acked": self.acked}
+
+    def write_trace(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time", "event", "cwnd", "pacing_rate"])
+            writer.writerows(self.trace or [])
+
+
+class NewReno(CongestionControl):
+    """Slow start, then additive increase of one packet per RTT; halve on loss."""
+    name = "newreno"
+
+    def increase(self, count):
+        if self.in_recovery():
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += count
+        else:
+            self.cwnd += count / self.cwnd
+
+    def decrease(self):
+        self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+        self.cwnd = self.ssthresh
+
+
+class Cubic(CongestionControl):
+    """CUBIC (RFC 8312): the window grows as a cubic function of the time since the last loss."""
+    name = "cubic"
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.w_max = 0.0
+        self.k = 0.0
+        self.epoch_start = None
+        self.w_est = 0.0
+
+    def increase(self, count):
+        if self.in_recovery():
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += count
+            return
+
+        now = time.monotonic()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+            else:
+                self.k = 0.0
+                self.w_max = self.cwnd
+            self.w_est = self.cwnd
+
+        t = now - self.epoch_start + (self.min_rtt or 0.0)
+        target = self.C * (t - self.k) ** 3 + self.w_max
+
+        # TCP friendly region: never grow slower than Reno would
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * count / self.cwnd
+        target = max(target, self.w_est)
+
+        if target > self.cwnd:
+            self.cwnd = min(target, self.cwnd + count * (target - self.cwnd) / self.cwnd)
+        else:
+            self.cwnd += 0.01 * count / self.cwnd
+
+    def decrease(self):
+        self.epoch_start = None
+        # Fast convergence: release bandwidth sooner when the available share shrinks
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, MIN_CWND)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self.epoch_start = None
+        self.w_max = self.cwnd
+        super().on_timeout()
+
+
+class BBR(CongestionControl):
+    """Model based controller in the style of BBR: estimate the bottleneck bandwidth and the
+    minimum RTT, pace at gain * bandwidth and cap the window at a multiple of the BDP."""
+    name = "bbr"
+    STARTUP_GAIN = 2.885
+    DRAIN_GAIN = 1 / 2.885
+    PROBE_GAINS = [1.25, 0.75, 1, 1, 1, 1, 1, 1]
+    CWND_GAIN = 2.0
+    BW_WINDOW = 10  # round trips of delivery rate samples kept for the max filter
+    MIN_RTT_WINDOW = 10.0  # seconds
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state = "startup"
+        self.delivered = deque()  # (time, total acked) over the last round trips
+        self.bw_samples = deque()  # (time, bytes per second)
+        self.btl_bw = 0.0
+        self.full_bw = 0.0
+        self.full_bw_rounds = 0
+        self.round_start = time.monotonic()
+        self.cycle_index = 0
+        self.min_rtt_stamp = time.monotonic()
+
+    @property
+    def pacing_gain(self):
+        if self.state == "startup":
+            return self.STARTUP_GAIN
+        if self.state == "drain":
+            return self.DRAIN_GAIN
+        return self.PROBE_GAINS[self.cycle_index]
+
+    @property
+    def pacing_rate(self):
+        if not self.btl_bw:
+            return None
+        return self.pacing_gain * self.btl_bw
+
+    def bdp(self):
+        if not self.btl_bw or not self.min_rtt:
+            return None
+        return self.btl_bw * self.min_rtt / self.packet_size
+
+    def update_rtt(self, rtt):
+        if rtt is None:
+            return
+        # min_rtt expires after MIN_RTT_WINDOW so a route change is noticed
+        now = time.monotonic()
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        if self.min_rtt is None or rtt <= self.min_rtt or now - self.min_rtt_stamp > self.MIN_RTT_WINDOW:
+            self.min_rtt = rtt
+            self.min_rtt_stamp = now
+
+    def increase(self, count):
+        now = time.monotonic()
+        self.delivered.append((now, self.acked))
+        horizon = self.srtt or INITIAL_TIMEOUT
+
+        # Delivery rate over roughly the last round trip
+        while len(self.delivered) > 2 and now - self.delivered[1][0] > horizon:
+            self.delivered.popleft()
+        first_time, first_acked = self.delivered[0]
+        if now > first_time and self.acked > first_acked:
+            self.bw_samples.append((now, (self.acked - first_acked) * self.packet_size / (now - first_time)))
+        while self.bw_samples and now - self.bw_samples[0][0] > self.BW_WINDOW * horizon:
+            self.bw_samples.popleft()
+        self.btl_bw = max((rate for _, rate in self.bw_samples), default=0.0)
+
+        if now - self.round_start >= horizon:
+            self.round_start = now
+            self.next_round()
+
+        bdp = self.bdp()
+        if bdp is None or self.state == "startup":
+            self.cwnd += count  # Exponential growth until the pipe is full
+            if bdp is not None:
+                self.cwnd = min(self.cwnd, max(self.STARTUP_GAIN * bdp, INITIAL_CWND))
+        else:
+            self.cwnd = max(self.CWND_GAIN * bdp, 4.0)
+
+    def next_round(self):
+        if self.state == "startup":
+            # The pipe is full once the bandwidth stops growing by 25% for three rounds
+            if self.btl_bw >= self.full_bw * 1.25:
+                self.full_bw = self.btl_bw
+                self.full_bw_rounds = 0
+            else:
+                self.full_bw_rounds += 1
+                if self.full_bw_rounds >= 3:
+                    self.state = "drain"
+                    self.record("drain")
+        elif self.state == "drain":
+            self.state = "probe_bw"
+            self.cycle_index = 0
+            self.record("probe_bw")
+        else:
+            self.cycle_index = (self.cycle_index + 1) % len(self.PROBE_GAINS)
+
+    def decrease(self):
+        pass  # Loss is not a congestion signal for the model
+
+    def on_timeout(self):
+        self.timeouts += 1
+        self.cwnd = max(self.cwnd / 2, INITIAL_CWND)
+        self.record("timeout")
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"state": self.state, "btl_bw": self.btl_bw})
+        return stats
+
+
+class AdaptiveController(CongestionControl):
+    """The original AdaptiveWindow behind the controller interface."""
+    name = "adaptive"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.window = AdaptiveWindow()
+        self.cwnd = float(self.window.window_size)
+
+    def on_ack(self, count, rtt=None):
+        self.update_rtt(rtt)
+        self.acked += count
+        if rtt is not None:
+            self.cwnd = float(self.window.update_window_size(rtt, packet_loss=False))
+        self.record("ack")
+
+    def on_loss(self):
+        self.loss_events += 1
+        self.cwnd = float(self.window.update_window_size(self.srtt or INITIAL_TIMEOUT, packet_loss=True))
+        self.record("loss")
+
+    def on_timeout(self):
+        self.timeouts += 1
+        self.cwnd = float(self.window.update_window_size(self.srtt or INITIAL_TIMEOUT, packet_loss=True))
+        self.record("timeout")
+
+
+CONTROLLERS = {cls.name: cls for cls in (NewReno, Cubic, BBR, AdaptiveController)}
+
+
+def make_controller(name=None, **kwargs):
+    """Create the congestion controller called name (default: DEFAULT_CONGESTION)."""
+    name = (name or DEFAULT_CONGESTION).lower()
+    if name not in CONTROLLERS:
+        raise ValueError(f"unknown congestion control {name}, choose from {', '.join(CONTROLLERS)}")
+    return CONTROLLERS[name](**kwargs)
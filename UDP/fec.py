@@ -0,0 +1,294 @@
+# Description: Forward error correction for the selective repeat transfer.
+#
+# The sender cuts the new packets of a transfer into blocks of k packets and follows every
+# block with m parity packets, so the receiver can rebuild up to m lost packets of the block
+# without waiting a round trip for their retransmission. Retransmission stays in place for
+# whatever FEC cannot repair.
+#
+#   xor  one parity packet, the XOR of the block. The block size adapts to the loss rate.
+#   rs   m parity packets of a systematic Reed-Solomon style erasure code: parity row r is
+#        sum_j C[r][j] * data_j over GF(256), with C a Cauchy matrix (every square submatrix
+#        is invertible, so any m losses are repairable). The block size is fixed and m adapts.
+#
+# Both adapt to the loss rate the receiver reports in its SACKs: parity is planned for
+# FEC_MARGIN times the measured loss. Multiplying a packet by a constant is a bytes.translate
+# with a 256 byte table and adding packets is an XOR of Python integers, so the per byte
+# work runs in C.
+#
+# A parity packet carries seq = first sequence number of its block and PARITY_FLAG in the
+# message byte, its data is PARITY_HEADER followed by the parity of the block's payloads,
+# zero-padded to the longest one. Every packet of a block but the last has the payload size
+# of the first one, the length of the last one is in the header: a block ends early when the
+# payload size changes (see pmtu.PacketSizer).
+import bisect
+import math
+import struct
+from utils import HEADER_SIZE, MAX_PAYLOAD, PARITY_FLAG, extract_data, extract_seq_num, pack_header, split_packet
+
+FEC_NONE = 0
+FEC_XOR = 1
+FEC_RS = 2
+FEC_CODES = {"none": FEC_NONE, "xor": FEC_XOR, "rs": FEC_RS}
+
+# code (1) | block size k (1) | parity packets m (1) | parity row (1) | length of the last packet (2)
+PARITY_HEADER = struct.Struct('!BBBBH')
+FEC_PAYLOAD = MAX_PAYLOAD - PARITY_HEADER.size  # Data payload size leaving room for the parity header
+
+RS_BLOCK = 32  # data packets per Reed-Solomon block
+XOR_MIN_BLOCK = 4
+XOR_MAX_BLOCK = 64
+MAX_PARITY = 16
+FEC_MARGIN = 2.0  # parity planned for this many times the measured loss rate
+CAUCHY_BASE = 128  # Parity row r uses x = CAUCHY_BASE + r, data column j uses y = j, so x != y
+
+# GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    GF_EXP[_power] = _value
+    GF_LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11D
+for _power in range(255, 512):
+    GF_EXP[_power] = GF_EXP[_power - 255]
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+mul_tables = {}  # constant -> translate table multiplying every byte by it
+
+
+def gf_scale(data, c):
+    """data multiplied byte by byte by the constant c (data must be bytes unless c is 1)."""
+    if c == 1:
+        return data
+    table = mul_tables.get(c)
+    if table is None:
+        table = mul_tables[c] = bytes(gf_mul(c, x) for x in range(256))
+    return data.translate(table)
+
+
+def coefficient(code, row, column):
+    if code == FEC_XOR:
+        return 1
+    return gf_inv((CAUCHY_BASE + row) ^ column)
+
+
+def gf_invert(matrix):
+    """Inverse of a square matrix over GF(256) (Gauss-Jordan), None if singular."""
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv, v) for v in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def data_payload(payload_size, code):
+    """Payload size of the data packets of a transfer asking for payload_size with FEC code:
+    with FEC they are shorter, so a parity packet still fits in a datagram of the same size."""
+    return min(payload_size, MAX_PAYLOAD) - (PARITY_HEADER.size if code != FEC_NONE else 0)
+
+
+def plan_block(code, loss):
+    """(k, m) for the next block at the measured loss rate."""
+    if code == FEC_XOR:
+        if loss <= 0:
+            return XOR_MAX_BLOCK, 1
+        return max(XOR_MIN_BLOCK, min(XOR_MAX_BLOCK, int(1 / (FEC_MARGIN * loss)))), 1
+    return RS_BLOCK, max(1, min(MAX_PARITY, math.ceil(RS_BLOCK * loss * FEC_MARGIN)))
+
+
+class FecEncoder:
+    """Builds the parity packets of the blocks of a transfer as its packets are first sent.
+
+    The parity is accumulated packet by packet, so no packet has to be kept until its block
+    is complete. loss is updated by the sender from the receiver's reports.
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.loss = 0.0
+        self.first = None  # Sequence number of the first packet of the current block
+        self.count = 0
+        self.k = self.m = 0
+        self.parity = []
+        self.symbol_size = 0
+        self.last_len = 0
+        self.block_ends = []  # Sequence number after every block whose parity was sent
+        self.blocks = 0
+        self.data_packets = 0
+        self.parity_packets = 0
+
+    def repair_end(self, seq_num):
+        """Sequence number after the block of seq_num once its parity was sent, None before."""
+        i = bisect.bisect_right(self.block_ends, seq_num)
+        return self.block_ends[i] if i < len(self.block_ends) else None
+
+    def add(self, packet, last=False):
+        """Account a packet sent for the first time. Returns the parity packets to send after it."""
+        head, payload = split_packet(packet)
+        packets = []
+        if self.first is not None and len(payload) > self.symbol_size:
+            packets = self.finish()  # Payloads grew, they start a new block
+        if self.first is None:
+            self.first = extract_seq_num(head)
+            self.k, self.m = plan_block(self.code, self.loss)
+            self.parity = [0] * self.m
+            self.symbol_size = 0
+
+        data = bytes(payload) if self.code != FEC_XOR else payload
+        for row in range(self.m):
+            # Little endian, so shorter payloads are implicitly zero-padded
+            self.parity[row] ^= int.from_bytes(gf_scale(data, coefficient(self.code, row, self.count)), 'little')
+        short = 0 < len(payload) < self.symbol_size
+        self.symbol_size = max(self.symbol_size, len(payload))
+        self.last_len = len(payload)
+        self.count += 1
+        self.data_packets += 1
+
+        if self.count < self.k and not last and not short:
+            return packets
+        return packets + self.finish()
+
+    def finish(self):
+        packets = []
+        for row, value in enumerate(self.parity):
+            header = PARITY_HEADER.pack(self.code, self.count, self.m, row, self.last_len)
+            data = header + value.to_bytes(self.symbol_size, 'little')
+            packet = bytearray(HEADER_SIZE + len(data))
+            packet[HEADER_SIZE:] = data
+            pack_header(packet, self.first, data, message=PARITY_FLAG)
+            packets.append(packet)
+        self.block_ends.append(self.first + self.count)
+        self.blocks += 1
+        self.parity_packets += len(packets)
+        self.first = None
+        self.count = 0
+        return packets
+
+    def stats(self):
+        return {"code": self.code, "blocks": self.blocks, "parity_packets": self.parity_packets,
+                "overhead": round(self.parity_packets / self.data_packets, 4) if self.data_packets else 0.0,
+                "loss": round(self.loss, 4), "last_block": (self.k, self.m)}
+
+
+class ParityBlock:
+    def __init__(self, code, k, last_len, size):
+        self.code = code
+        self.k = k
+        self.last_len = last_len
+        self.size = size  # Parity (and longest payload) length
+        self.rows = {}  # parity row -> parity as an integer
+
+
+class FecDecoder:
+    """Rebuilds lost packets of a transfer from the parity packets of their block.
+
+    Keeps a copy of the data packets a block may still need (the last history delivered ones
+    and those waiting for a hole), and the parity of blocks that miss more packets than they
+    have parity for yet.
+    """
+
+    def __init__(self, history=XOR_MAX_BLOCK):
+        self.history = history  # Packets kept below the next expected sequence number
+        self.received = {}  # seq -> payload bytes
+        self.blocks = {}  # first seq -> ParityBlock
+        self.prune_at = 2 * history
+        self.recovered = 0
+        self.failed = 0
+
+    def on_data(self, seq_num, payload, expected_seq):
+        """A data packet arrived. Returns {seq: payload} of the packets it made recoverable."""
+        self.received[seq_num] = bytes(payload)
+        if len(self.received) > self.prune_at:
+            self.prune(expected_seq)
+        recovered = {}
+        for first in [first for first, block in self.blocks.items() if first <= seq_num < first + block.k]:
+            recovered.update(self.decode(first, expected_seq))
+        return recovered
+
+    def on_parity(self, packet, expected_seq):
+        """A parity packet arrived. Returns {seq: payload} of the packets it rebuilt."""
+        data = extract_data(packet)
+        if len(data) < PARITY_HEADER.size:
+            return {}
+        code, k, m, row, last_len = PARITY_HEADER.unpack_from(data)
+        first = extract_seq_num(packet)
+        if code not in (FEC_XOR, FEC_RS) or not k or row >= m or first + k <= expected_seq:
+            return {}
+        size = len(data) - PARITY_HEADER.size
+        block = self.blocks.setdefault(first, ParityBlock(code, k, last_len, size))
+        if (block.code, block.k, block.last_len, block.size) != (code, k, last_len, size):
+            return {}
+        block.rows[row] = int.from_bytes(data[PARITY_HEADER.size:], 'little')
+        return self.decode(first, expected_seq)
+
+    def decode(self, first, expected_seq):
+        block = self.blocks[first]
+        code, k, size = block.code, block.k, block.size
+        missing = [j for j in range(k) if first + j not in self.received]
+        if not missing or first + k <= expected_seq:
+            del self.blocks[first]
+            return {}
+        if any(first + j < expected_seq for j in missing):
+            del self.blocks[first]  # Delivered before we kept a copy, nothing left to repair
+            return {}
+        if len(missing) > len(block.rows):
+            return {}  # Wait for more parity or data
+
+        # Remove the known packets from the parity, what is left is C[rows][missing] * missing
+        parity_rows = sorted(block.rows)[:len(missing)]
+        syndromes = []
+        for row in parity_rows:
+            value = block.rows[row]
+            for j in range(k):
+                if first + j in self.received:
+                    c = coefficient(code, row, j)
+                    payload = self.received[first + j]
+                    value ^= int.from_bytes(payload if c == 1 else gf_scale(payload, c), 'little')
+            syndromes.append(value.to_bytes(size, 'little'))
+
+        inverse = gf_invert([[coefficient(code, row, j) for j in missing] for row in parity_rows])
+        if inverse is None:
+            self.failed += 1
+            del self.blocks[first]
+            return {}
+        recovered = {}
+        for i, j in enumerate(missing):
+            value = 0
+            for c, syndrome in zip(inverse[i], syndromes):
+                if c:
+                    value ^= int.from_bytes(gf_scale(syndrome, c), 'little')
+            length = block.last_len if j == k - 1 else size
+            recovered[first + j] = self.received[first + j] = value.to_bytes(size, 'little')[:length]
+        self.recovered += len(recovered)
+        del self.blocks[first]
+        return recovered
+
+    def prune(self, expected_seq):
+        oldest = expected_seq - self.history
+        self.received = {seq: payload for seq, payload in self.received.items() if seq >= oldest}
+        self.blocks = {first: block for first, block in self.blocks.items() if first + block.k > expected_seq}
+        self.prune_at = len(self.received) + 2 * self.history
+
+    def stats(self):
+        return {"recovered": self.recovered, "failed": self.failed, "pending_blocks": len(self.blocks)}
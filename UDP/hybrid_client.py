@@ -0,0 +1,158 @@
+# Description: Client of hybrid_server.py, commands over TCP and file data over UDP.
+#
+#   python hybrid_client.py big.bin small.bin --host 10.0.0.5 [--rate 5000000] [--output dir]
+#
+# Opens a control connection, asks for every file as one REQUEST and receives it into the
+# memory-mapped output file from a UDP socket of its own (a fresh one per transfer, so no
+# datagram of an earlier transfer can land in a later one) while reporting the missing packets
+# over the control connection, see blast.py. --data-port sends the JOINs (and so receives the
+# data) through another UDP port, an impairment proxy in front of the server for instance.
+import argparse
+import os
+import socket
+import sys
+import time
+import client_SR
+from blast import BlastReceiver, ControlChannel
+from placement import MappedRange
+from utils import (DEFAULT_INTEGRITY, INTEGRITY_CRC32, INTEGRITY_NAMES, INTEGRITY_NONE, MAX_PAYLOAD, current_integrity,
+                   file_checksum, make_packet, set_integrity, tune_socket)
+
+HOST = client_SR.HOST
+PORT = 12345
+OUTPUT_DIR = client_SR.OUTPUT_DIR
+INTEGRITY = client_SR.INTEGRITY
+MAX_RATE = client_SR.MAX_RATE  # Ask the server to send at most this many bytes per second, 0: no cap
+PAYLOAD_SIZE = MAX_PAYLOAD
+DATA_PORT = None  # UDP port to JOIN on instead of the one the server names
+CONNECT_TIMEOUT = 10.0
+
+
+def open_session(host=None, port=None, integrity=None):
+    """Connect the control channel and negotiate the integrity scheme of the data packets.
+    Returns (control, welcome message)."""
+    integrity = integrity or INTEGRITY
+    if integrity not in INTEGRITY_NAMES:
+        raise ValueError(f"unknown integrity scheme {integrity}")
+    sock = socket.create_connection((host or HOST, port or PORT), timeout=CONNECT_TIMEOUT)
+    control = ControlChannel(sock)
+    try:
+        lines = control.call(f"CONNECT {integrity}", CONNECT_TIMEOUT).splitlines()
+    except BaseException:
+        control.close()
+        raise
+    set_integrity(DEFAULT_INTEGRITY)
+    if lines and lines[-1].startswith("INTEGRITY"):
+        set_integrity(INTEGRITY_NAMES[lines.pop().split()[1]])
+    return control, "\n".join(lines)
+
+
+def close_session(control):
+    try:
+        control.call("EXIT", CONNECT_TIMEOUT)
+    except (OSError, ValueError):
+        pass
+    control.close()
+
+
+def fetch_file_list(control):
+    return [line.split()[0] for line in control.call("FILE_LIST").splitlines() if line.strip()]
+
+
+def fetch_file_size(control, filename):
+    return int(control.call(f"SIZE {filename}"))
+
+
+def fetch_file_hash(control, filename):
+    return control.call(f"HASH {filename}").strip()
+
+
+def download_range(control, filename, target, offset, size, max_rate=None, progress=None):
+    """Receive bytes [offset, offset + size) of filename into target at offset. Returns
+    (bytes received, receiver stats)."""
+    rate = MAX_RATE if max_rate is None else max_rate
+    token, count, payload_size, data_port = control.call(
+        f"REQUEST {filename} {offset} {size} {int(rate)} {PAYLOAD_SIZE}").split()
+    count, payload_size = int(count), int(payload_size)
+    if count != -(-size // payload_size):
+        raise ValueError(f"server sends {count} packets of {payload_size} bytes for {size} bytes")
+    if count == 0:
+        return 0, {}
+
+    server = control.sock.getpeername()[0]
+    join = make_packet(0, f"JOIN {token}".encode(), INTEGRITY_CRC32)
+    with tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as data_socket, \
+            MappedRange(target, offset, size) as mapped:
+        data_socket.bind(("", 0))
+        receiver = BlastReceiver(data_socket, control, mapped.view, payload_size, join,
+                                 (server, DATA_PORT or int(data_port)), control.rtt)
+        try:
+            received = receiver.run(progress)
+        finally:
+            control.send_line("DONE")  # Also when giving up, the server stops sending
+    return received, receiver.stats()
+
+
+def download_file(control, filename, target, max_rate=None):
+    """Download filename into target. Returns (bytes received, receiver stats)."""
+    size = fetch_file_size(control, filename)
+    with open(target, "wb") as f:
+        f.truncate(size)
+
+    def progress(received):
+        client_SR.print_progress_bar(received, size, prefix="Downloading", suffix=f"of {filename}")
+
+    received, stats = download_range(control, filename, target, 0, size, max_rate, progress)
+    # Without per packet integrity the whole file is checked end-to-end
+    if current_integrity() == INTEGRITY_NONE and fetch_file_hash(control, filename) != file_checksum(target):
+        raise ValueError(f"hash mismatch for {filename}")
+    return received, stats
+
+
+def main(argv=None):
+    global DATA_PORT
+    parser = argparse.ArgumentParser(description="Download files with commands over TCP and data over UDP.")
+    parser.add_argument("files", nargs="+", help="file names on the server")
+    parser.add_argument("--host", default=HOST, help="server address")
+    parser.add_argument("--port", type=int, default=PORT, help="server port (TCP control)")
+    parser.add_argument("--data-port", type=int, help="UDP port to receive the data through")
+    parser.add_argument("--rate", type=int, default=MAX_RATE, help="ask for at most this many bytes per second")
+    parser.add_argument("--integrity", choices=sorted(INTEGRITY_NAMES), default=INTEGRITY)
+    parser.add_argument("--output", default=OUTPUT_DIR, help="folder of the downloaded files")
+    args = parser.parse_args(argv)
+    DATA_PORT = args.data_port or DATA_PORT
+
+    try:
+        control, welcome = open_session(args.host, args.port, args.integrity)
+    except (OSError, ValueError) as e:
+        print(f"Failed to connect to the server: {e}", file=sys.stderr)
+        return 2
+    print(welcome)
+    os.makedirs(args.output, exist_ok=True)
+    failed = 0
+    try:
+        available = fetch_file_list(control)
+        for filename in args.files:
+            if filename not in available:
+                print(f"{filename} is not available on the server.", file=sys.stderr)
+                failed += 1
+                continue
+            start = time.monotonic()
+            try:
+                received, stats = download_file(control, filename, os.path.join(args.output, filename), args.rate)
+            except (OSError, ValueError) as e:
+                print(f"Error downloading {filename}: {e}", file=sys.stderr)
+                failed += 1
+                continue
+            elapsed = max(time.monotonic() - start, 1e-9)
+            print(f"Finished downloading {filename}: {received / elapsed / 1e6:.2f} MB/s, {stats}")
+    except KeyboardInterrupt:
+        print("\nDownload cancelled.", file=sys.stderr)
+        return 1
+    finally:
+        close_session(control)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
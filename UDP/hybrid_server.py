@@ -0,0 +1,192 @@
+# Description: Hybrid server, commands over TCP and file data blasted over UDP.
+#
+#   python hybrid_server.py    (TCP and UDP port PORT)
+#
+# server_SR.py multiplexes commands, their answers, ACKs and data on one unreliable socket,
+# so every command needs its own stop-and-wait retransmissions and the data path has to tell
+# them apart from ACKs. Here a client opens a TCP control connection for CONNECT, FILE_LIST,
+# SIZE, HASH, REQUEST and EXIT (see blast.ControlChannel), and the UDP port only carries data.
+# REQUEST file offset size rate payload_size is answered with a random transfer token; the
+# client sends JOIN <token> from its data socket to the UDP port, which tells the server where
+# to send (through NAT too) and that the datagram comes from the client of the connection,
+# then blast.BlastSender sends the range at a paced rate and resends what the client reports
+# missing over the control connection. Every control connection is served by a thread of its
+# own, a single thread reads the JOINs of the UDP port.
+import os
+import secrets
+import socket
+import threading
+import server_SR
+from blast import BlastSender, ControlChannel
+from packetizer import FilePacketizer
+from pmtu import MIN_PAYLOAD
+from server_SR import count, get_file_list, negotiate_integrity
+from utils import (FORMAT, BUFFER_SIZE, MAX_PAYLOAD, extract_data, file_checksum, integrity_name, set_integrity,
+                   tune_socket, verify_packet)
+
+HOST = server_SR.HOST
+PORT = 12345
+FOLDER = server_SR.FOLDER
+FILE_LIST = server_SR.FILE_LIST
+MAX_CONNECTIONS = 64
+JOIN_TIMEOUT = 10.0  # seconds a transfer waits for the JOIN of its client
+MAX_RATE = server_SR.MAX_RATE  # Server wide cap in bytes per second, 0: none
+
+joins = {}  # Token -> [event set on JOIN, address the JOIN came from]
+joins_lock = threading.Lock()
+
+
+def receive_joins(data_socket):
+    """Match the JOIN datagrams of clients to their waiting transfers."""
+    while True:
+        try:
+            data, addr = data_socket.recvfrom(BUFFER_SIZE)
+        except OSError:
+            return  # Closed, the server is shutting down
+        if not verify_packet(data):
+            continue
+        words = bytes(extract_data(data)).decode(FORMAT, errors="replace").split()
+        if len(words) == 2 and words[0] == "JOIN":
+            with joins_lock:
+                waiting = joins.get(words[1])
+                if waiting is not None and not waiting[0].is_set():
+                    waiting[1] = addr
+                    waiting[0].set()
+
+
+def wait_join(token):
+    """The address the client of token sent its JOIN from, None if it did not within JOIN_TIMEOUT."""
+    waiting = joins[token]
+    joined = waiting[0].wait(JOIN_TIMEOUT)
+    with joins_lock:
+        del joins[token]
+    return waiting[1] if joined else None
+
+
+def send_range(control, data_socket, file, offset, chunk, rate, payload_size):
+    """Answer a REQUEST and blast the range once the client joined."""
+    with FilePacketizer(os.path.join(FOLDER, file), offset, chunk, 0, payload_size) as packets:
+        token = secrets.token_hex(8)
+        with joins_lock:
+            joins[token] = [threading.Event(), None]
+        control.reply(f"{token} {len(packets)} {payload_size} {data_socket.getsockname()[1]}")
+        addr = wait_join(token) if len(packets) else None
+        if addr is None:
+            if len(packets):
+                print(f"No JOIN for {file} [{offset}, {offset + chunk}), giving up.")
+                count(failed_transfers=1)
+            return
+
+        caps = [cap for cap in (rate, MAX_RATE) if cap]
+        sender = BlastSender(data_socket, addr, packets, control, max_rate=min(caps) if caps else 0)
+        try:
+            sender.run()
+            count(transfers=1, bytes_sent=packets.size, packets_sent=sender.sent + sender.resent,
+                  loss_events=sender.slowdowns)
+        except TimeoutError:
+            count(failed_transfers=1, loss_events=sender.slowdowns)
+            raise
+        finally:
+            print(f"Sent {file} [{offset}, {offset + chunk}) to {addr}: {sender.stats()}")
+            print(f"Pacing {file} [{offset}, {offset + chunk}): {sender.pacer.stats()}")
+
+
+def handle_request(control, data_socket, request):
+    """Serve one request line. Returns False when the session is over."""
+    if request == "FILE_LIST":
+        control.reply("\n".join(get_file_list()))
+
+    elif request.startswith("SIZE"):
+        fileName = request.split()[1]
+        control.reply(str(os.path.getsize(os.path.join(FOLDER, fileName))))
+
+    elif request.startswith("HASH"):
+        fileName = request.split()[1]
+        control.reply(file_checksum(os.path.join(FOLDER, fileName)))
+
+    elif request.startswith("REQUEST"):
+        info = request.split()
+        fileName = info[1]
+        offset, chunk = int(info[2]), int(info[3])
+        rate = int(info[4]) if len(info) > 4 and info[4].isdigit() else 0
+        payload_size = int(info[5]) if len(info) > 5 and info[5].isdigit() else MAX_PAYLOAD
+        payload_size = max(MIN_PAYLOAD, min(payload_size, MAX_PAYLOAD))
+        print(f"Request for file chunk: {fileName} {offset} {chunk} (rate cap {rate}, payload {payload_size})")
+        if not os.path.isfile(os.path.join(FOLDER, fileName)):
+            control.error(f"{fileName} not found")
+        else:
+            send_range(control, data_socket, fileName, offset, chunk, rate, payload_size)
+
+    elif request.startswith("EXIT"):
+        control.reply()
+        return False
+
+    elif request.startswith("DONE") or request.startswith("MISSING"):
+        pass  # Late report of a transfer that already ended
+
+    else:
+        control.error(f"unknown request {request.split()[0] if request else ''}")
+    return True
+
+
+def serve_connection(conn, addr, data_socket):
+    control = ControlChannel(conn)
+    try:
+        request = control.read_line().split()
+        if not request or request[0] != "CONNECT":
+            control.error("expected CONNECT")
+            print(f"Invalid connection request from {addr}")
+            return
+        scheme = negotiate_integrity(request[1] if len(request) > 1 else None)
+        control.reply(f"Welcome to the server!\nINTEGRITY {integrity_name(scheme)}")
+        set_integrity(scheme, session=True)  # Only for this thread, the packets of its transfers
+        print(f"Client {addr} connected, integrity {integrity_name(scheme)}.\n")
+
+        count(sessions=1, active_sessions=1)
+        try:
+            while True:
+                request = control.read_line()
+                print(f"Received request from {addr}: {request}")
+                try:
+                    if not handle_request(control, data_socket, request):
+                        break
+                except (ValueError, IndexError, OSError) as e:
+                    print(f"Error processing request from {addr}: {e}")
+                    control.error(str(e) or type(e).__name__)
+        finally:
+            count(active_sessions=-1)
+    except (ConnectionError, TimeoutError, OSError) as e:
+        print(f"Client {addr}: {e}")
+    finally:
+        control.close()
+        print(f"Client {addr} disconnected.")
+
+
+def run():
+    # get_file_list reads the folder of server_SR
+    server_SR.FOLDER, server_SR.FILE_LIST = FOLDER, FILE_LIST
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((HOST, PORT))
+    server.listen(MAX_CONNECTIONS)
+    data_socket = tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    data_socket.bind((HOST, PORT))
+    threading.Thread(target=receive_joins, args=(data_socket,), daemon=True).start()
+
+    print(f"Server is running on {HOST} : {PORT}\n")
+    try:
+        while True:
+            conn, addr = server.accept()
+            threading.Thread(target=serve_connection, args=(conn, addr, data_socket), daemon=True).start()
+
+    except KeyboardInterrupt:
+        print("\nServer interrupted by user.")
+
+    finally:
+        print("Server shutting down...")
+        server.close()
+        data_socket.close()
+
+
+if __name__ == "__main__":
+    run()
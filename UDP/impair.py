@@ -0,0 +1,327 @@
+# Description: Userspace network impairment proxy for UDP and TCP.
+#
+#   python impair.py scenarios/wan.json --listen 23456 --upstream 127.0.0.1:12345 [--tcp]
+#
+# Sits between a client and a server on localhost and delays, drops, duplicates and
+# reorders what goes through, so retransmission and windowing can be tested without real
+# bad networks, root or netem. Clients connect to the listen port instead of the server.
+#
+# A scenario is a JSON object (see scenarios/), every key is optional:
+#   delay_ms, jitter_ms      one-way delay and its standard deviation
+#   loss                     independent loss probability
+#   burst_loss               Gilbert-Elliott bursts: {"enter": p, "leave": r, "loss": 1.0}, the
+#                            link goes bad with probability p per packet, good again with r,
+#                            and drops with "loss" while bad
+#   duplicate                probability a packet is delivered twice
+#   reorder, reorder_gap_ms  probability a packet is held back reorder_gap_ms longer
+#   rate_mbps, queue_kb      bottleneck bandwidth and the queue in front of it (tail drop)
+#   seed                     random seed, the same seed gives the same fate to every packet
+#   up, down                 overrides for client -> server and server -> client only
+# TCP connections only get delay, jitter (never reordering bytes) and the bandwidth cap, a
+# userspace proxy cannot drop segments of a byte stream.
+import argparse
+import heapq
+import json
+import random
+import select
+import socket
+import sys
+import time
+
+PROXY_BUFFER = 4 * 1024 * 1024  # Socket buffers, so the proxy itself does not drop bursts
+MAX_DATAGRAM = 65536
+TCP_CHUNK = 64 * 1024
+DEFAULT_QUEUE_KB = 256
+DIRECTIONS = ("up", "down")  # client -> server, server -> client
+
+
+def load_scenario(path):
+    with open(path, "r") as f:
+        scenario = json.load(f)
+    scenario.setdefault("name", path.rsplit("/", 1)[-1].rsplit(".", 1)[0])
+    return scenario
+
+
+def direction_config(scenario, direction):
+    """The settings of one direction: the common ones with the direction's overrides on top."""
+    config = {key: value for key, value in scenario.items() if key not in DIRECTIONS}
+    config.update(scenario.get(direction, {}))
+    return config
+
+
+class Impairment:
+    """The fate of every packet sent in one direction of the emulated link."""
+
+    def __init__(self, config, rng):
+        self.rng = rng
+        self.delay = config.get("delay_ms", 0) / 1000
+        self.jitter = config.get("jitter_ms", 0) / 1000
+        self.loss = config.get("loss", 0.0)
+        burst = config.get("burst_loss") or {}
+        self.burst_enter = burst.get("enter", 0.0)
+        self.burst_leave = burst.get("leave", 1.0)
+        self.burst_loss = burst.get("loss", 1.0)
+        self.duplicate = config.get("duplicate", 0.0)
+        self.reorder = config.get("reorder", 0.0)
+        self.reorder_gap = config.get("reorder_gap_ms", 10) / 1000
+        rate = config.get("rate_mbps")
+        self.rate = rate * 1e6 / 8 if rate else None  # bytes per second
+        self.queue_bytes = config.get("queue_kb", DEFAULT_QUEUE_KB) * 1024
+        self.bad = False  # Gilbert-Elliott state
+        self.link_free = 0.0  # When the bottleneck finishes sending what is queued
+        self.last_departure = 0.0
+        self.counters = {"packets": 0, "bytes": 0, "delivered": 0, "lost": 0, "burst_lost": 0,
+                         "queue_dropped": 0, "duplicated": 0, "reordered": 0}
+
+    def lost(self):
+        if self.burst_enter:
+            if self.bad:
+                self.bad = self.rng.random() >= self.burst_leave
+            else:
+                self.bad = self.rng.random() < self.burst_enter
+            if self.bad and self.rng.random() < self.burst_loss:
+                self.counters["burst_lost"] += 1
+                return True
+        if self.loss and self.rng.random() < self.loss:
+            self.counters["lost"] += 1
+            return True
+        return False
+
+    def serialize(self, size, now):
+        """When the bottleneck has sent a packet of size bytes arriving now, None if its queue is full."""
+        if self.rate is None:
+            return now
+        start = max(now, self.link_free)
+        if (start - now) * self.rate + size > self.queue_bytes:
+            self.counters["queue_dropped"] += 1
+            return None
+        self.link_free = start + size / self.rate
+        return self.link_free
+
+    def propagation(self):
+        if not self.jitter:
+            return self.delay
+        return max(0.0, self.rng.gauss(self.delay, self.jitter))
+
+    def datagram(self, size, now):
+        """Delivery times of the copies of a datagram arriving now, empty if it is dropped."""
+        self.counters["packets"] += 1
+        self.counters["bytes"] += size
+        if self.lost():
+            return []
+        sent = self.serialize(size, now)
+        if sent is None:
+            return []
+
+        departure = sent + self.propagation()
+        if self.reorder and self.rng.random() < self.reorder:
+            departure += self.reorder_gap
+            self.counters["reordered"] += 1
+        departures = [departure]
+        if self.duplicate and self.rng.random() < self.duplicate:
+            departures.append(departure + self.rng.random() * max(self.jitter, 0.001))
+            self.counters["duplicated"] += 1
+        self.counters["delivered"] += len(departures)
+        return departures
+
+    def stream(self, size, now):
+        """Delivery time of size bytes of a TCP stream arriving now, never before earlier bytes."""
+        self.counters["packets"] += 1
+        self.counters["bytes"] += size
+        start = max(now, self.link_free)
+        if self.rate is not None:
+            self.link_free = start + size / self.rate  # TCP flow control replaces the drop tail queue
+            start = self.link_free
+        self.last_departure = max(self.last_departure, start + self.propagation())
+        self.counters["delivered"] += 1
+        return self.last_departure
+
+
+class Proxy:
+    """The common event loop: sockets are read as soon as they are readable and what they
+    carried is written out again at its delivery time."""
+
+    def __init__(self, listen, upstream, scenario):
+        self.upstream = upstream
+        self.scenario = scenario
+        rng = random.Random(scenario.get("seed"))
+        self.links = {direction: Impairment(direction_config(scenario, direction), rng) for direction in DIRECTIONS}
+        self.pending = []  # heap of (delivery time, order, deliver function, arguments)
+        self.order = 0
+        self.listener = self.open_listener(listen)
+        self.address = self.listener.getsockname()
+
+    def open_listener(self, listen):
+        raise NotImplementedError
+
+    def schedule(self, when, deliver, *args):
+        self.order += 1
+        heapq.heappush(self.pending, (when, self.order, deliver, args))
+
+    def sockets(self):
+        raise NotImplementedError
+
+    def readable(self, sock, now):
+        raise NotImplementedError
+
+    def run(self, duration=None, stop=None):
+        """Forward until duration seconds have passed or the stop event is set."""
+        end = time.monotonic() + duration if duration else None
+        try:
+            while (stop is None or not stop.is_set()) and (end is None or time.monotonic() < end):
+                now = time.monotonic()
+                timeout = 0.2
+                if self.pending:
+                    timeout = min(timeout, max(0.0, self.pending[0][0] - now))
+                readable, _, _ = select.select(self.sockets(), [], [], timeout)
+                now = time.monotonic()
+                for sock in readable:
+                    self.readable(sock, now)
+                now = time.monotonic()
+                while self.pending and self.pending[0][0] <= now:
+                    _, _, deliver, args = heapq.heappop(self.pending)
+                    try:
+                        deliver(*args)
+                    except OSError:
+                        pass  # The receiving side went away
+        finally:
+            self.close()
+
+    def close(self):
+        self.listener.close()
+
+    def stats(self):
+        return {"scenario": self.scenario.get("name"),
+                **{direction: dict(link.counters) for direction, link in self.links.items()}}
+
+
+class UdpProxy(Proxy):
+    """Every client address gets its own upstream socket, so the server sees one peer per client."""
+
+    def open_listener(self, listen):
+        self.flows = {}  # client address -> upstream socket
+        self.clients = {}  # upstream socket -> client address
+        return self.open_socket(listen)
+
+    @staticmethod
+    def open_socket(address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, PROXY_BUFFER)
+            except OSError:
+                pass
+        sock.bind(address)
+        return sock
+
+    def sockets(self):
+        return [self.listener, *self.clients]
+
+    def readable(self, sock, now):
+        try:
+            data, addr = sock.recvfrom(MAX_DATAGRAM)
+        except OSError:
+            return  # ICMP port unreachable of an earlier datagram
+        if sock is self.listener:
+            upstream = self.flows.get(addr)
+            if upstream is None:
+                upstream = self.flows[addr] = self.open_socket((self.address[0], 0))
+                self.clients[upstream] = addr
+            link, out, destination = self.links["up"], upstream, self.upstream
+        else:
+            link, out, destination = self.links["down"], self.listener, self.clients[sock]
+        for when in link.datagram(len(data), now):
+            self.schedule(when, out.sendto, data, destination)
+
+    def close(self):
+        for upstream in self.clients:
+            upstream.close()
+        super().close()
+
+
+class TcpProxy(Proxy):
+    """Every accepted connection is relayed over its own upstream connection."""
+
+    def open_listener(self, listen):
+        self.peers = {}  # socket -> (the socket it relays to, direction)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(listen)
+        sock.listen()
+        return sock
+
+    def sockets(self):
+        return [self.listener, *self.peers]
+
+    def readable(self, sock, now):
+        if sock is self.listener:
+            client, _ = sock.accept()
+            try:
+                upstream = socket.create_connection(self.upstream)
+            except OSError:
+                client.close()
+                return
+            self.peers[client] = (upstream, "up")
+            self.peers[upstream] = (client, "down")
+            return
+
+        out, direction = self.peers[sock]
+        try:
+            data = sock.recv(TCP_CHUNK)
+        except OSError:
+            data = b""
+        when = self.links[direction].stream(len(data), now)
+        if data:
+            self.schedule(when, out.sendall, data)
+        else:
+            # Pass the end of the stream on after the data before it
+            del self.peers[sock]
+            self.schedule(when, self.shutdown, sock, out)
+
+    def shutdown(self, sock, out):
+        try:
+            out.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        if out not in self.peers:
+            sock.close()
+            out.close()
+
+    def close(self):
+        for sock in self.peers:
+            sock.close()
+        super().close()
+
+
+def parse_address(text, default_host="127.0.0.1"):
+    host, _, port = text.rpartition(":")
+    return (host or default_host, int(port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Forward UDP or TCP through an emulated bad network.")
+    parser.add_argument("scenario", help="JSON scenario file")
+    parser.add_argument("--listen", default="127.0.0.1:23456", help="[host:]port clients connect to")
+    parser.add_argument("--upstream", default="127.0.0.1:12345", help="[host:]port of the server")
+    parser.add_argument("--tcp", action="store_true", help="relay TCP connections instead of UDP datagrams")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--seed", type=int, help="override the seed of the scenario")
+    args = parser.parse_args(argv)
+
+    scenario = load_scenario(args.scenario)
+    if args.seed is not None:
+        scenario["seed"] = args.seed
+    proxy_class = TcpProxy if args.tcp else UdpProxy
+    proxy = proxy_class(parse_address(args.listen), parse_address(args.upstream), scenario)
+    print(f"Impairing {'TCP' if args.tcp else 'UDP'} {proxy.address[0]}:{proxy.address[1]} -> "
+          f"{args.upstream} with scenario {scenario['name']}", file=sys.stderr)
+    try:
+        proxy.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(proxy.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# Description: Token bucket pacer for the UDP sender.
+#
+# Tokens (bytes) refill at the pacing rate up to a bucket of PACING_BATCH packets, so the
+# sender releases small batches evenly spread over time instead of a whole window at once.
+# Waiting is done with a coarse sleep followed by a short spin on perf_counter, because
+# time.sleep alone overshoots by up to a scheduler tick (15 ms on Windows).
+import time
+
+PACING_BATCH = 4  # packets released back-to-back per bucket refill
+SPIN_THRESHOLD = 0.002  # seconds; shorter waits are spun instead of slept
+ERROR_SAMPLES = 4096  # scheduling errors kept for the accuracy statistics
+
+
+def precise_sleep(deadline):
+    """Sleep until the perf_counter deadline, spinning for the last SPIN_THRESHOLD seconds."""
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > SPIN_THRESHOLD:
+            time.sleep(remaining - SPIN_THRESHOLD)
+
+
+class Pacer:
+    """Token bucket limiting the sending rate to rate bytes per second (None: unlimited).
+
+    max_rate is a user cap that applies on top of whatever rate set_rate asks for.
+    """
+
+    def __init__(self, rate=None, packet_size=4096, batch=PACING_BATCH, max_rate=None):
+        self.capacity = packet_size * batch
+        self.tokens = float(self.capacity)
+        self.max_rate = max_rate if max_rate and max_rate > 0 else None
+        self.rate = None
+        self.last = time.perf_counter()
+        self.set_rate(rate)
+        self.due = None  # When the packet we are waiting for is allowed to go
+        self.errors = []  # Release time minus due time, seconds
+        self.sent_bytes = 0
+        self.first_send = None
+        self.last_send = None
+
+    def set_rate(self, rate):
+        self.refill(time.perf_counter())
+        rates = [r for r in (rate, self.max_rate) if r and r > 0]
+        self.rate = min(rates) if rates else None
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        else:
+            self.tokens = float(self.capacity)
+        self.last = now
+
+    def delay(self, nbytes):
+        """Seconds until nbytes may be sent (0 if they may go now)."""
+        if self.rate is None:
+            return 0.0
+        now = time.perf_counter()
+        self.refill(now)
+        if self.tokens >= min(nbytes, self.capacity):
+            return 0.0
+        wait = (min(nbytes, self.capacity) - self.tokens) / self.rate
+        if self.due is None:
+            self.due = now + wait
+        return wait
+
+    def consume(self, nbytes):
+        """Take nbytes of tokens. Retransmissions may drive the bucket negative to delay new data."""
+        now = time.perf_counter()
+        self.refill(now)
+        self.tokens -= nbytes
+        if self.due is not None:
+            if len(self.errors) < ERROR_SAMPLES:
+                self.errors.append(now - self.due)
+            self.due = None
+        if self.first_send is None:
+            self.first_send = now
+        self.last_send = now
+        self.sent_bytes += nbytes
+
+    def wait(self, nbytes):
+        """Block until nbytes may be sent, then take them."""
+        wait = self.delay(nbytes)
+        if wait > 0:
+            precise_sleep(time.perf_counter() + wait)
+        self.consume(nbytes)
+
+    def stats(self):
+        """Achieved rate and how late releases were compared to their schedule."""
+        elapsed = (self.last_send or 0) - (self.first_send or 0)
+        errors = sorted(self.errors)
+        stats = {"target_rate": self.rate, "achieved_rate": self.sent_bytes / elapsed if elapsed > 0 else None,
+                 "paced_releases": len(errors)}
+        if errors:
+            stats["mean_error_us"] = round(sum(errors) / len(errors) * 1e6, 1)
+            stats["p99_error_us"] = round(errors[int(len(errors) * 0.99)] * 1e6, 1)
+        return stats
@@ -0,0 +1,211 @@
+# Description: Lazy packetizer feeding the selective repeat sender from a file.
+#
+# SelectiveRepeatSender only needs len(packets) and packets[index]. Instead of building
+# every packet of the requested range up front, FilePacketizer reads the file in blocks of
+# PREFETCH packets when the sender reaches them, straight into a payload ring
+# (readinto), and packs the headers into a parallel header ring, all of a block at once (see
+# batchsum.py). Packets are handed out as
+# (header, payload) memoryviews that send_packet passes to sendmsg, so payload bytes are
+# never copied in user space. The rings hold window + PREFETCH packets: the sender never has
+# more than window packets unacknowledged, so a slot is only reused once its packet has
+# been acknowledged and memory stays constant however large the range is.
+#
+# The payload size can be lowered during the transfer (see pmtu.PacketSizer): resize applies
+# from the first packet not read yet, earlier packets keep their size for retransmissions.
+#
+# With packet_cache enabled (the default), every block is read into buffers of its own
+# instead, kept by the cache, and the rings are never allocated. The cache is a byte-budgeted
+# LRU cache shared by all the transfers of the process: when many clients fetch the same
+# popular file, the blocks after the first transfer are served from memory, without a file
+# read or a check value per packet.
+# The check value covers the sequence number and the integrity scheme, so both are part of the
+# key with the file (path, inode, mtime and size), the offset and the payload size; clients
+# number every range from 0, so the same range requested again hits.
+import collections
+import os
+import threading
+import utils
+from batchsum import pack_headers
+from utils import HEADER_SIZE, INTEGRITY_KEYED, MAX_PAYLOAD, RECEIVE_WINDOW, current_integrity, make_packet
+
+PREFETCH = 64  # packets read ahead of the sender in one file read
+CACHE_BYTES = int(os.environ.get("UDP_PACKET_CACHE_MB", 64)) * 1024 * 1024  # Budget of packet_cache, 0: no cache
+
+
+class PacketCache:
+    """LRU cache of blocks of ready to send packets, (packed headers, payloads) buffers, holding
+    at most budget bytes. Blocks are never modified once cached, so packets handed out of an
+    evicted block stay valid."""
+
+    def __init__(self, budget=CACHE_BYTES):
+        self.budget = budget
+        self.blocks = collections.OrderedDict()  # key -> (headers, payloads), least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()  # Transfers run in threads of their own
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key, headers, payloads):
+        size = len(headers) + len(payloads)
+        if size > self.budget:
+            return
+        with self.lock:
+            if key in self.blocks:
+                return  # Another transfer of the same range got there first
+            self.blocks[key] = (headers, payloads)
+            self.bytes += size
+            while self.bytes > self.budget:
+                _, (old_headers, old_payloads) = self.blocks.popitem(last=False)
+                self.bytes -= len(old_headers) + len(old_payloads)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"blocks": len(self.blocks), "bytes": self.bytes, "budget": self.budget, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+packet_cache = PacketCache()
+
+
+class FilePacketizer:
+    """The packets of bytes [offset, offset + size) of path, numbered from first_seq."""
+
+    def __init__(self, path, offset, size, first_seq, payload_size=MAX_PAYLOAD, window=RECEIVE_WINDOW,
+                 prefetch=PREFETCH, cache=None):
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.offset = offset
+        self.size = max(0, min(size, stat.st_size - offset))
+        self.first_seq = first_seq
+        self.payload_size = payload_size  # Of the packets not read yet
+        self.slot_size = payload_size  # Largest payload a ring slot holds
+        self.segments = [(0, 0, payload_size)]  # (first index, offset in the range, payload size)
+        self.prefetch = max(1, prefetch)
+        self.count = -(-self.size // payload_size)
+
+        # Whole blocks of prefetch slots, so a block read never wraps around the ring
+        blocks = -(-min(window + self.prefetch, self.count) // self.prefetch)
+        self.slots = max(1, blocks) * self.prefetch
+        self.payloads = self.headers = None  # The rings, allocated by the first block read without the cache
+        self.held = [None] * self.slots  # slot -> (index, (header, payload))
+
+        self.read_ahead = 0  # Index of the first packet not read sequentially yet
+        self.reads = 0
+        self.rereads = 0
+
+        self.cache = packet_cache if cache is None else cache
+        self.file_key = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)  # Changes when the file does
+        self.cache_hits = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        held = self.held[index % self.slots]
+        if held is not None and held[0] == index:
+            return held[1]
+
+        if index == self.read_ahead:
+            self.read_block(index)
+            return self.held[index % self.slots][1]
+
+        # Not in the ring (only if the sender ran ahead of its window): build this packet alone
+        self.rereads += 1
+        self.reads += 1
+        start, payload_size, _ = self.locate(index)
+        self.file.seek(self.offset + start)
+        return make_packet(self.first_seq + index, self.file.read(min(payload_size, self.size - start)))
+
+    def locate(self, index):
+        """Offset in the range and payload size of packet index, and the index where that size ends."""
+        end = self.count
+        for first, start, payload_size in reversed(self.segments):
+            if first <= index:
+                return start + (index - first) * payload_size, payload_size, end
+            end = first
+
+    def resize(self, payload_size, index):
+        """Use payload_size (at most the initial one) from packet index on, or from the first packet
+        not read yet if that is later. Returns the index it applies from, None if nothing changed."""
+        payload_size = min(payload_size, self.slot_size)
+        index = max(index, self.read_ahead)
+        if index >= self.count or payload_size == self.payload_size:
+            return None
+        start, _, _ = self.locate(index)
+        self.segments = [segment for segment in self.segments if segment[0] < index] + [(index, start, payload_size)]
+        self.payload_size = payload_size
+        self.count = index + -(-(self.size - start) // payload_size)
+        return index
+
+    def read_block(self, index):
+        slot = index % self.slots
+        start, payload_size, end = self.locate(index)
+        count = min(self.prefetch, end - index, self.slots - slot)  # Never across a resize or the ring end
+        length = min(count * payload_size, self.size - start)
+
+        scheme = current_integrity()
+        key = None
+        if self.cache.budget:
+            key = (self.file_key, self.offset + start, payload_size, length, self.first_seq + index, scheme,
+                   utils.integrity_key if scheme == INTEGRITY_KEYED else None)
+        block = self.cache.get(key) if key else None
+        if block is not None:
+            headers, region = memoryview(block[0]), memoryview(block[1])
+            self.cache_hits += 1
+        else:
+            if key:
+                # Read into buffers of its own the cache keeps, not into the ring
+                block = (bytearray(count * HEADER_SIZE), bytearray(length))
+                headers, region = memoryview(block[0]), memoryview(block[1])
+            else:
+                if self.payloads is None:
+                    self.payloads = memoryview(bytearray(self.slots * self.slot_size))
+                    self.headers = memoryview(bytearray(self.slots * HEADER_SIZE))
+                # Payloads smaller than a slot are read back to back into the slots of the block
+                region = self.payloads[slot * self.slot_size:(slot + count) * self.slot_size]
+                headers = self.headers[slot * HEADER_SIZE:(slot + count) * HEADER_SIZE]
+            self.file.seek(self.offset + start)
+            self.file.readinto(region[:length])
+            self.reads += 1
+            pack_headers(headers[:count * HEADER_SIZE], region[:length], self.first_seq + index, payload_size, scheme)
+            if key:
+                self.cache.put(key, *block)
+
+        for i in range(count):
+            payload = region[i * payload_size:i * payload_size + min(payload_size, length - i * payload_size)]
+            self.held[slot + i] = (index + i, (headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE], payload))
+        self.read_ahead = index + count
+
+    def stats(self):
+        return {"packets": self.count, "reads": self.reads, "rereads": self.rereads,
+                "ring_slots": self.slots, "ring_bytes": len(self.payloads) + len(self.headers) if self.payloads else 0,
+                "payload_size": self.payload_size, "cache_hits": self.cache_hits, "cache_bytes": self.cache.bytes}
+
+    def close(self):
+        self.held = [None] * self.slots
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,259 @@
+# Description: Zero-copy receive of a byte range straight into a memory-mapped output file.
+#
+# The receive side counterpart of packetizer.py. The payload of packet index of a range
+# belongs at index * payload_size in it, so instead of buffering out-of-order packets and
+# writing them in order, MappedRange maps the range of the (preallocated) output file and
+# PlacedReceiver receives every datagram with recvmsg_into scattered over three buffers:
+# the header, the file slot of the next new packet and a spill buffer. Packets arriving in
+# order land in place without a single copy in user space; retransmissions and reordered
+# packets are copied once from the slot they were received into to their own, and only a
+# bitmap of received packets is kept. The page cache writes the file back.
+#
+# The payload size has to stay fixed for the whole range, the client asks the server to
+# keep it (no PacketSizer) in REQUEST. ACKs, credit and grants follow the same rules as
+# utils.modified_sliding_window_recv; the credit only depends on the socket buffer since
+# nothing waits for a consumer. Without recvmsg_into (Windows, session sockets) datagrams
+# are received into a scratch buffer and copied to their slot.
+import mmap
+import os
+import socket
+import time
+from utils import (ACK_DELAY, ACK_EVERY, BUFFER_SIZE, GRANT_BATCH, HEADER_SIZE, INITIAL_TIMEOUT, MAX_IDLE,
+                   MESSAGE_FLAG, RECEIVE_WINDOW, SACK_MAX_BYTES, LossMeter, extract_message, extract_seq_num,
+                   extract_stamp, is_parity, make_grant, pack_sack, pending_packets, receive_capacity, verify_parts)
+
+HAS_RECVMSG = hasattr(socket.socket, "recvmsg_into")
+SACK_BITS = SACK_MAX_BYTES * 8
+
+
+class MappedRange:
+    """Bytes [offset, offset + size) of path, memory-mapped for writing. The file is extended
+    to hold the range if it is shorter. view is the range as a writable memoryview."""
+
+    def __init__(self, path, offset, size):
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if os.fstat(self.file.fileno()).st_size < offset + size:
+            self.file.truncate(offset + size)
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY  # mmap offsets must be aligned
+        self.map = mmap.mmap(self.file.fileno(), offset + size - start, offset=start)
+        self.view = memoryview(self.map)[offset - start:]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # A slice of the map is still referenced (by a traceback), it closes with it
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PlacedReceiver:
+    """Receives the packets of a range numbered from first_seq into target (a writable buffer,
+    usually MappedRange.view) at (seq - first_seq) * payload_size."""
+
+    def __init__(self, client, first_seq, target, payload_size, fec=None, window_size=RECEIVE_WINDOW,
+                 ack_every=ACK_EVERY, ack_delay=ACK_DELAY, pull_from=None):
+        self.client = client
+        self.first_seq = first_seq
+        self.target = target
+        self.size = len(target)
+        self.payload_size = payload_size
+        self.count = -(-self.size // payload_size)
+        self.fec = fec
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.pull_from = pull_from
+        # One bit per packet, padded so the SACK window never reads past the end
+        self.received = bytearray((self.count + 7) // 8 + SACK_MAX_BYTES + 1)
+        self.expected = 0  # Index of the first packet not received
+        self.highest = -1  # Highest index received
+        self.header = bytearray(HEADER_SIZE)
+        self.spill = bytearray(BUFFER_SIZE)  # What a datagram carries beyond its slot (parity, strays)
+        self.scratch = bytearray(BUFFER_SIZE)  # Whole datagrams when they cannot go to a slot
+        self.scatter = HAS_RECVMSG and hasattr(client, "recvmsg_into")
+        self.loss = LossMeter()
+        self.capacity = receive_capacity(client, window_size)
+        self.update_after = max(1, min(GRANT_BATCH, self.capacity // 4)) if pull_from is not None else self.capacity // 4
+        self.advertised = 0  # Index right after the credit last advertised or granted
+        self.addr = pull_from
+        self.echo = 0
+        self.unacked = 0
+        self.ack_deadline = None
+        self.in_place = 0  # Packets received straight into their slot
+        self.copied = 0  # Packets copied to their slot
+
+    def slot(self, index):
+        start = index * self.payload_size
+        return self.target[start:min(start + self.payload_size, self.size)]
+
+    def has(self, index):
+        return self.received[index >> 3] >> (index & 7) & 1
+
+    def place(self, index, payload, in_place=False):
+        if not in_place:
+            self.slot(index)[:] = payload
+            self.copied += 1
+        else:
+            self.in_place += 1
+        self.received[index >> 3] |= 1 << (index & 7)
+        self.highest = max(self.highest, index)
+
+    def sack_bits(self):
+        """Bit i set if packet expected + 1 + i has arrived."""
+        start = self.expected + 1
+        window = self.received[start >> 3:(start >> 3) + SACK_MAX_BYTES + 1]
+        return (int.from_bytes(window, 'little') >> (start & 7)) & ((1 << SACK_BITS) - 1)
+
+    def acknowledge(self):
+        edge = self.expected + self.capacity
+        sack = pack_sack(self.first_seq + self.expected, self.sack_bits(), self.echo, self.loss.rate, self.capacity)
+        self.client.sendto(sack, self.addr)
+        self.unacked, self.ack_deadline = 0, None
+        if self.pull_from is None:
+            self.advertised = edge
+
+    def grant(self):
+        edge = self.expected + self.capacity
+        self.client.sendto(make_grant(self.first_seq + self.expected, self.first_seq + edge), self.addr)
+        self.advertised = edge
+
+    def receive(self):
+        """The next datagram as (header, payload, sender, index of the slot it was received into or None)."""
+        pending = pending_packets.get(self.client)
+        if pending:
+            data, addr = pending.pop(0)
+            return data[:HEADER_SIZE], data[HEADER_SIZE:], addr, None
+
+        guess = self.highest + 1  # The next new packet, where in-order data belongs
+        while guess < self.count and self.has(guess):
+            guess += 1  # Already rebuilt by FEC
+        if self.scatter and guess < self.count:
+            slot = self.slot(guess)
+            nbytes, _, _, addr = self.client.recvmsg_into([self.header, slot, self.spill])
+            length = nbytes - HEADER_SIZE
+            if length <= len(slot):
+                return memoryview(self.header), slot[:max(length, 0)], addr, guess
+            return memoryview(self.header), bytes(slot) + self.spill[:length - len(slot)], addr, None
+
+        nbytes, addr = self.client.recvfrom_into(self.scratch)
+        view = memoryview(self.scratch)[:nbytes]
+        return view[:HEADER_SIZE], view[HEADER_SIZE:], addr, None
+
+    def run(self, progress=None):
+        """Receive until the range is complete. progress(bytes) is called as the range fills up in
+        order. Returns the size of the range."""
+        last_received_time = time.monotonic()
+        try:
+            while self.expected < self.count:
+                self.update_credit()
+                try:
+                    self.client.settimeout(self.next_timeout())
+                    header, payload, addr, slot_index = self.receive()
+                except socket.timeout:
+                    self.on_quiet(time.monotonic() - last_received_time)
+                    continue
+
+                if not self.accepts(header, payload):
+                    continue  # Corrupted or a late message, the sender's timer will resend it
+                last_received_time = time.monotonic()
+                self.addr = addr
+                if self.on_packet(header, payload, slot_index) and progress is not None:
+                    progress(min(self.expected * self.payload_size, self.size))
+        finally:
+            self.flush()
+        return self.size
+
+    def accepts(self, header, payload):
+        """True for a verified data or parity packet whose payload fits its slot."""
+        if len(header) < HEADER_SIZE or extract_message(header) & MESSAGE_FLAG or not verify_parts(header, payload):
+            return False
+        index = extract_seq_num(header) - self.first_seq
+        return is_parity(header) or not 0 <= index < self.count or len(payload) == len(self.slot(index))
+
+    def update_credit(self):
+        """Advertise the room freed since the last window update, or grant it with pull, once
+        it is worth a datagram."""
+        if self.addr is not None and self.expected + self.capacity - self.advertised >= self.update_after:
+            if self.pull_from is not None:
+                self.grant()
+            else:
+                self.acknowledge()
+
+    def next_timeout(self):
+        if self.ack_deadline is None:
+            return INITIAL_TIMEOUT
+        return max(self.ack_deadline - time.monotonic(), 0.0001)
+
+    def on_quiet(self, idle):
+        """Nothing arrived for next_timeout() seconds, nor for idle seconds since the last packet."""
+        if self.ack_deadline is not None and time.monotonic() >= self.ack_deadline:
+            self.acknowledge()
+        elif idle > MAX_IDLE:
+            raise TimeoutError("sender stopped sending")
+        elif self.pull_from is not None:
+            self.grant()  # Quiet: our last grant may have been lost
+        elif self.addr is not None:
+            self.acknowledge()  # Quiet: our last window update may have been lost
+
+    def flush(self):
+        """Acknowledge the packets still waiting for a SACK, the range is complete or abandoned."""
+        if self.unacked and self.addr is not None:
+            try:
+                self.acknowledge()
+            except OSError:
+                pass
+
+    def on_packet(self, header, payload, slot_index):
+        """Place a packet accepts() let through, acknowledge if due. Returns True if the range grew in order."""
+        seq_num = extract_seq_num(header)
+        self.echo = extract_stamp(header)
+        urgent = False
+        recovered = {}
+        if is_parity(header):
+            if self.fec is not None:
+                recovered = self.fec.on_parity(bytes(header) + bytes(payload), self.first_seq + self.expected)
+        else:
+            index = seq_num - self.first_seq
+            if not 0 <= index < self.count:
+                return False  # Stray packet of another transfer
+            self.loss.on_packet(seq_num)
+            # A new gap, a filled hole or a duplicate, packets in order above a known hole can wait
+            urgent = index != self.highest + 1 or self.has(index)
+            if not self.has(index):
+                self.place(index, payload, in_place=slot_index == index)
+            if self.fec is not None and index >= self.expected:
+                recovered = self.fec.on_data(seq_num, payload, self.first_seq + self.expected)
+            self.unacked += 1
+        for seq, data in recovered.items():
+            index = seq - self.first_seq
+            if 0 <= index < self.count and not self.has(index):
+                self.place(index, data)
+                urgent = True
+
+        expected = self.expected
+        while self.expected < self.count and self.has(self.expected):
+            self.expected += 1
+
+        if urgent or self.unacked >= self.ack_every or self.expected == self.count:
+            self.acknowledge()
+        elif self.unacked and self.ack_deadline is None:
+            self.ack_deadline = time.monotonic() + self.ack_delay
+        return self.expected > expected
+
+    def stats(self):
+        return {"packets": self.count, "in_place": self.in_place, "copied": self.copied,
+                "loss": round(self.loss.rate, 4)}
+
+
+def receive_into(client, first_seq, target, payload_size, fec=None, pull_from=None, progress=None):
+    """Receive the packets numbered from first_seq into target, see PlacedReceiver.
+    Returns (bytes received, receiver stats)."""
+    receiver = PlacedReceiver(client, first_seq, target, payload_size, fec, pull_from=pull_from)
+    received = receiver.run(progress)
+    return received, receiver.stats()
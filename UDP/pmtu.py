@@ -0,0 +1,157 @@
+# Description: Datagram sizing from the path MTU.
+#
+# A datagram larger than the path MTU is fragmented by IP and lost as a whole when any one
+# fragment is lost, so on a lossy 1500 byte path a 4 KB datagram is lost about three times
+# as often as a 1472 byte one. The client finds the largest datagram that crosses the path
+# unfragmented when it connects and asks the server for that payload size in REQUEST:
+#
+#   1. The ceiling is the route MTU the kernel reports (IP_MTU on Linux: 65536 on loopback,
+#      9000 with jumbo frames, 1500 on Ethernet) minus the IP and UDP headers, and never more
+#      than BUFFER_SIZE, the receive buffers of the peer.
+#   2. With IP_MTU_DISCOVER set to IP_PMTUDISC_DO the kernel sends every datagram with the
+#      Don't Fragment bit and refuses (EMSGSIZE) those over the MTU it knows of.
+#   3. Probe messages of the ceiling and then of the common MTU plateaus below it are sent
+#      with send_rdt; the largest one the server acknowledges wins (RFC 4821 style, so
+#      paths that drop ICMP "fragmentation needed" are handled too).
+#
+# Where the socket options are missing the ceiling is BUFFER_SIZE on loopback and an
+# Ethernet MTU elsewhere, still probed. During a transfer PacketSizer steps the payload size
+# down the plateaus while the receiver reports high loss, see SelectiveRepeatSender.
+import ipaddress
+import socket
+import sys
+from utils import BUFFER_SIZE, HEADER_SIZE, make_packet, send_rdt
+
+# Linux values, the socket module does not export them on every build
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+IP_MTU = getattr(socket, "IP_MTU", 14)
+HAS_PMTU = sys.platform.startswith("linux")
+
+IP_UDP_OVERHEAD = 28  # IPv4 (20) and UDP (8) headers
+ETHERNET_MTU = 1500
+MTU_PLATEAUS = [9000, 1500, 1280, 576]  # Jumbo frames, Ethernet, IPv6 minimum, IPv4 minimum
+MIN_PAYLOAD = MTU_PLATEAUS[-1] - IP_UDP_OVERHEAD - HEADER_SIZE  # Crosses any IPv4 path unfragmented
+PROBE_ATTEMPTS = 2  # Timeouts before a probe size is given up
+
+SHRINK_LOSS = 0.03  # Loss rate above which smaller packets are tried
+GROW_LOSS = 0.01  # Loss rate below which larger packets are tried again
+SIZE_GAIN = 0.75  # Smaller packets are kept only if they cut the loss rate by at least a quarter
+RESIZE_HOLDOFF = 1024  # New packets between two resizes, so the receiver reports a loss rate of the new size
+LOSS_MEMORY = 8 * RESIZE_HOLDOFF  # New packets after which a loss rate seen at another size is stale
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def route_mtu(addr):
+    """MTU of the route to addr as the kernel knows it, None if it cannot tell."""
+    if not HAS_PMTU:
+        return None
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(addr)  # Nothing is sent, this only picks the route
+            return sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+
+
+def datagram_ceiling(addr):
+    """Largest datagram worth probing towards addr."""
+    mtu = route_mtu(addr)
+    if mtu is None:
+        mtu = BUFFER_SIZE + IP_UDP_OVERHEAD if is_loopback(addr[0]) else ETHERNET_MTU
+    return min(BUFFER_SIZE, mtu - IP_UDP_OVERHEAD)
+
+
+def probe_sizes(ceiling):
+    """Datagram sizes to probe, largest first."""
+    return [ceiling] + [mtu - IP_UDP_OVERHEAD for mtu in MTU_PLATEAUS if mtu - IP_UDP_OVERHEAD < ceiling]
+
+
+def set_dont_fragment(sock, enabled=True):
+    """Switch the Don't Fragment bit on (or back to the kernel default) for sock, False if unsupported."""
+    if not HAS_PMTU:
+        return False
+    try:
+        if enabled:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        else:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, 1)  # IP_PMTUDISC_WANT
+        return True
+    except OSError:
+        return False
+
+
+def discover_payload_size(client, addr):
+    """Largest payload whose datagram reaches addr unfragmented, found with probe messages.
+    Returns None if not even the smallest probe was acknowledged."""
+    dont_fragment = set_dont_fragment(client)
+    try:
+        for size in probe_sizes(datagram_ceiling(addr)):
+            padding = size - HEADER_SIZE - len(b"PROBE \n")
+            probe = make_packet(0, b"PROBE " + b"x" * padding + b"\n")
+            try:
+                if send_rdt(client, addr, probe, max_attempts=PROBE_ATTEMPTS) == 1:
+                    return size - HEADER_SIZE
+            except OSError:
+                continue  # EMSGSIZE: over the MTU the kernel knows of
+        return None
+    finally:
+        if dont_fragment:
+            set_dont_fragment(client, False)
+
+
+class PacketSizer:
+    """Payload size of a transfer, stepped down the MTU plateaus while loss is high.
+
+    Fragmented datagrams are lost more often than small ones, random loss is not. The sizer
+    remembers the loss rate seen at every size and only keeps a smaller size if it made the
+    loss rate drop, otherwise it goes back up. Once the loss rate of the larger size is stale
+    and loss is low, the larger size is tried again.
+    """
+
+    def __init__(self, max_payload, overhead=0):
+        smaller = [mtu - IP_UDP_OVERHEAD - HEADER_SIZE - overhead for mtu in MTU_PLATEAUS]
+        self.sizes = [max_payload] + [size for size in smaller if size < max_payload]
+        self.level = 0
+        self.loss_at = {}  # level -> (loss rate reported while sending at that size, packet index)
+        self.hold_until = RESIZE_HOLDOFF
+        self.resizes = 0
+
+    @property
+    def payload_size(self):
+        return self.sizes[self.level]
+
+    def on_loss(self, loss, index):
+        """The receiver reports loss while packet index is the next new one.
+        Returns the payload size to use from now on, None to keep the current one."""
+        if index < self.hold_until:
+            return None
+        self.loss_at[self.level] = (loss, index)
+        level = self.level
+        larger = self.recent_loss(level - 1, index)
+        smaller = self.recent_loss(level + 1, index)
+        if level > 0 and (loss > larger * SIZE_GAIN if larger is not None else loss < GROW_LOSS):
+            level -= 1  # The smaller packets did not help, or it is quiet again
+        elif loss > SHRINK_LOSS and level + 1 < len(self.sizes) and (smaller is None or smaller < loss * SIZE_GAIN):
+            level += 1
+        if level == self.level:
+            return None
+        self.level = level
+        self.hold_until = index + RESIZE_HOLDOFF
+        self.resizes += 1
+        return self.payload_size
+
+    def recent_loss(self, level, index):
+        if level not in self.loss_at or index - self.loss_at[level][1] > LOSS_MEMORY:
+            return None
+        return self.loss_at[level][0]
+
+    def stats(self):
+        return {"payload_size": self.payload_size, "resizes": self.resizes,
+                "loss_at": {self.sizes[level]: round(loss, 4) for level, (loss, _) in self.loss_at.items()}}
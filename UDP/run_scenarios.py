@@ -0,0 +1,227 @@
+# Description: Run the batch clients through the impairment proxy, one scenario at a time.
+#
+#   python run_scenarios.py scenarios/*.json [--transport udp udp-async tcp] [--report results.json]
+#
+# For every scenario a test file is generated in a temporary folder, the server is started on
+# it, impair.py is put in front of the server and batch.py downloads the file through the
+# proxy. A scenario passes if the download finishes within its timeout and the file matches.
+# Everything runs on localhost without root, so it works on CI machines. The servers and
+# clients run as subprocesses: the UDP and TCP trees share module names. udp-async is the UDP
+# batch client against async_server.py instead of server_SR.py.
+#
+# Besides the impairment settings of impair.py a scenario may set:
+#   file_size  bytes of the test file (default 2 MB)
+#   chunks     byte ranges downloaded at once (default 1)
+#   fec        forward error correction of UDP transfers: "none", "xor" or "rs"
+#   flow       flow control of UDP transfers: "credit" or "pull"
+#   timeout    seconds a download may take (default 120)
+#   transports the transports the scenario applies to (default all)
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from impair import TcpProxy, UdpProxy, load_scenario
+
+CUR_PATH = os.path.dirname(os.path.abspath(__file__))
+TCP_PATH = os.path.join(os.path.dirname(CUR_PATH), "TCP")
+LOCALHOST = "127.0.0.1"
+DEFAULT_FILE_SIZE = 2 * 1024 * 1024
+DEFAULT_TIMEOUT = 120.0
+SERVER_STARTUP = 10.0  # seconds to wait for a server to listen
+
+# Server module, the folder of the transport and the name of the server's file list variable
+TRANSPORTS = {
+    "udp": ("server_SR", CUR_PATH, "FILE_LIST"),
+    "udp-async": ("async_server", CUR_PATH, "FILE_LIST"),
+    "tcp": ("server", TCP_PATH, "FILELIST"),
+}
+SERVER_CODE = ("import sys, {module} as server\n"
+               "server.HOST, server.PORT = {host!r}, {port}\n"
+               "server.FOLDER, server.{file_list} = {folder!r}, {file_list_path!r}\n"
+               "server.run()\n")
+
+
+def is_udp(transport):
+    return TRANSPORTS[transport][1] == CUR_PATH
+
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind((LOCALHOST, 0))
+        return sock.getsockname()[1]
+
+
+def make_test_file(path, size, seed=0):
+    rng = random.Random(seed)
+    md5 = hashlib.md5()
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            block = rng.randbytes(min(remaining, 1024 * 1024))
+            md5.update(block)
+            f.write(block)
+            remaining -= len(block)
+    return md5.hexdigest()
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def wait_listening(log_path, process):
+    """Wait until the server of process says it is running. Returns False if it died or never did."""
+    deadline = time.monotonic() + SERVER_STARTUP
+    while time.monotonic() < deadline and process.poll() is None:
+        with open(log_path, "r") as f:
+            if "Server is running" in f.read():
+                return True
+        time.sleep(0.05)
+    return False
+
+
+@contextlib.contextmanager
+def running_server(transport, folder):
+    module, path, file_list = TRANSPORTS[transport]
+    port = free_port(socket.SOCK_DGRAM if is_udp(transport) else socket.SOCK_STREAM)
+    code = SERVER_CODE.format(module=module, host=LOCALHOST, port=port, folder=folder, file_list=file_list,
+                              file_list_path=os.path.join(os.path.dirname(folder), "filelist.txt"))
+    log_path = os.path.join(os.path.dirname(folder), "server.log")
+    with open(log_path, "w") as log:
+        process = subprocess.Popen([sys.executable, "-u", "-c", code], cwd=path, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not wait_listening(log_path, process):
+            raise RuntimeError(f"the {transport} server did not start, see {log_path} (--keep)")
+        yield port
+    finally:
+        process.kill()
+        process.wait()
+
+
+@contextlib.contextmanager
+def running_proxy(transport, port, scenario):
+    proxy_class = UdpProxy if is_udp(transport) else TcpProxy
+    proxy = proxy_class((LOCALHOST, 0), (LOCALHOST, port), scenario)
+    stop = threading.Event()
+    thread = threading.Thread(target=proxy.run, kwargs={"stop": stop}, daemon=True)
+    thread.start()
+    try:
+        yield proxy
+    finally:
+        stop.set()
+        thread.join()
+
+
+def batch_command(transport, scenario, port, manifest, report):
+    _, path, _ = TRANSPORTS[transport]
+    command = [sys.executable, os.path.join(path, "batch.py"), manifest, "--host", LOCALHOST, "--port", str(port),
+               "--report", report, "--chunks", str(scenario.get("chunks", 1))]
+    if is_udp(transport) and scenario.get("fec"):
+        command += ["--fec", scenario["fec"]]
+    if is_udp(transport) and scenario.get("flow"):
+        command += ["--flow", scenario["flow"]]
+    return command
+
+
+def run_scenario(scenario, transport, workdir, log):
+    """Download the test file of scenario through the proxy, returns the result dict."""
+    name = scenario["name"]
+    result = {"scenario": name, "transport": transport, "status": "failed", "wall_time": None,
+              "throughput": None, "retries": None, "proxy": None, "error": None}
+    folder = os.path.join(workdir, f"{name}-{transport}", "files")
+    os.makedirs(folder)
+    size = scenario.get("file_size", DEFAULT_FILE_SIZE)
+    expected = make_test_file(os.path.join(folder, "scenario.bin"), size, scenario.get("seed", 0))
+    target = os.path.join(workdir, f"{name}-{transport}", "scenario.out")
+    manifest = os.path.join(workdir, f"{name}-{transport}", "manifest.txt")
+    report_path = os.path.join(workdir, f"{name}-{transport}", "report.json")
+    with open(manifest, "w") as f:
+        f.write(f"scenario.bin {target}\n")
+
+    try:
+        with running_server(transport, folder) as port, running_proxy(transport, port, scenario) as proxy:
+            command = batch_command(transport, scenario, proxy.address[1], manifest, report_path)
+            try:
+                subprocess.run(command, stdout=log, stderr=log, timeout=scenario.get("timeout", DEFAULT_TIMEOUT))
+            except subprocess.TimeoutExpired:
+                result["error"] = f"timed out after {scenario.get('timeout', DEFAULT_TIMEOUT)} s"
+        result["proxy"] = proxy.stats()
+    except RuntimeError as e:
+        result["error"] = str(e)
+        return result
+
+    if os.path.exists(report_path):
+        with open(report_path, "r") as f:
+            report = json.load(f)
+        result.update(wall_time=report["wall_time"], throughput=report["throughput"], retries=report["retries"])
+        if report["failed"] and result["error"] is None:
+            result["error"] = report["files"][0]["error"]
+    if result["error"] is None:
+        if not os.path.exists(target) or file_md5(target) != expected:
+            result["error"] = "downloaded file does not match"
+        else:
+            result["status"] = "ok"
+    return result
+
+
+def print_table(results):
+    print(f"{'scenario':<16} {'transport':<9} {'status':<7} {'time s':>8} {'MB/s':>8} {'lost':>6} {'retries':>8}")
+    for result in results:
+        proxy = result["proxy"] or {}
+        lost = sum(proxy.get(direction, {}).get(key, 0) for direction in ("up", "down")
+                   for key in ("lost", "burst_lost", "queue_dropped"))
+        wall_time = f"{result['wall_time']:.2f}" if result["wall_time"] is not None else "-"
+        throughput = f"{result['throughput'] / 1e6:.2f}" if result["throughput"] is not None else "-"
+        retries = result["retries"] if result["retries"] is not None else "-"
+        print(f"{result['scenario']:<16} {result['transport']:<9} {result['status']:<7} {wall_time:>8} "
+              f"{throughput:>8} {lost:>6} {retries:>8}")
+        if result["error"]:
+            print(f"    {result['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the batch clients through emulated bad networks.")
+    parser.add_argument("scenarios", nargs="+", help="JSON scenario files")
+    parser.add_argument("--transport", nargs="+", choices=sorted(TRANSPORTS), default=sorted(TRANSPORTS))
+    parser.add_argument("--report", help="write the JSON results to this path")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder with the server and client logs")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="scenarios-")
+    results = []
+    with open(os.path.join(workdir, "log.txt"), "w") as log:
+        for path in args.scenarios:
+            scenario = load_scenario(path)
+            for transport in args.transport:
+                if transport not in scenario.get("transports", TRANSPORTS):
+                    continue
+                print(f"Running {scenario['name']} over {transport}...", file=sys.stderr)
+                log.write(f"==== {scenario['name']} over {transport}\n")
+                log.flush()
+                results.append(run_scenario(scenario, transport, workdir, log))
+
+    print_table(results)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(json.dumps(results, indent=2) + "\n")
+    if args.keep:
+        print(f"Logs in {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if all(result["status"] == "ok" for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
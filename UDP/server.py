@@ -41,7 +41,7 @@ def send_file_chunk(server, client_addr, file, offset, chunk, seq_num, request_i
         f.seek(offset)
         print(seq_num)
         while totalSent < chunk:
-            part = f.read(min(BUFFER - 4 - 32, chunk - totalSent))
+            part = f.read(min(MAX_PAYLOAD, chunk - totalSent))
             if not part:
                 break
             
@@ -1,13 +1,27 @@
 import threading
 import struct
 import logging
+import utils
 from utils import *
+from congestion import make_controller, CONTROLLERS, DEFAULT_CONGESTION
+from pacing import Pacer
+from packetizer import FilePacketizer
+from fec import FecEncoder, FEC_CODES, FEC_NONE, PARITY_HEADER, data_payload
+from pmtu import PacketSizer, MIN_PAYLOAD
+from sessions import Dispatcher
 
 HOST = socket.gethostbyname(socket.gethostname())
 PORT = 12345
 FOLDER = os.path.join(CUR_PATH, 'files')
 FILE_LIST = os.path.join(CUR_PATH, 'filelist.txt')
 MB = 1024 * 1024
+CC_TRACE_DIR = os.environ.get("CC_TRACE_DIR")  # Write the cwnd/pacing trace of every transfer here
+MAX_RATE = int(os.environ.get("UDP_MAX_RATE", 0))  # Server wide cap in bytes per second, 0: none
+
+# Totals of this server process, workers.py collects them from every worker
+server_stats = {"sessions": 0, "active_sessions": 0, "transfers": 0, "failed_transfers": 0, "bytes_sent": 0,
+                "packets_sent": 0, "loss_events": 0, "timeouts": 0}
+stats_lock = threading.Lock()
 
 def get_file_list():
     fileList = []
@@ -30,32 +44,91 @@ def scan_available_files():
             list.write(f"{file} {round(os.path.getsize(os.path.join(FOLDER, file)) / MB, 2)}MB\n")
 
 
-def send_file(server, client_addr, file, offset, chunk, seq_num, request_id):
-    
-        with open(os.path.join(FOLDER, file), 'rb') as f:
-            totalSent = 0
-            f.seek(offset)
-            saved = -2
-            count_saved = 0
-            packets = []
-            while totalSent < chunk:
-                part = f.read(min(BUFFER_SIZE - 4 - 32, chunk - totalSent))
-                if not part:
-                    break
-                packet = make_packet(seq_num, part)
-                packets.append(packet)
-                seq_num += 1
-                totalSent += len(part)
-            
-            # print(f"Sending file chunk: {file} {offset} {chunk} {seq_num}")
-            # sliding_window_send(server, client_addr, packets, window_size=10)
-            
-            adaptive_window = AdaptiveWindow()
-            modified_sliding_window_send(server, client_addr, packets, adaptive_window)            
-            # print(f"Finished sending file chunk: {file} {offset} {chunk} {seq_num}")
+def negotiate_integrity(requested):
+    """Pick the integrity scheme asked for in CONNECT, falling back to the default one."""
+    scheme = INTEGRITY_NAMES.get(requested, DEFAULT_INTEGRITY)
+    if scheme == INTEGRITY_KEYED and not utils.integrity_key:
+        scheme = DEFAULT_INTEGRITY
+    return scheme
+
+
+def open_transfer(file, offset, chunk, seq_num, congestion=DEFAULT_CONGESTION, max_rate=0, fec=FEC_NONE,
+                  payload_size=MAX_PAYLOAD, fixed_size=False):
+    """The packets of a transfer and what sends them: (packets, controller, pacer, encoder, sizer)."""
+    # Packets are built lazily as the window reaches them, see packetizer.py
+    # payload_size is what the client found to cross the path unfragmented, see pmtu.py.
+    # With FEC the payloads are a little shorter so a parity packet still fits in a datagram
+    overhead = PARITY_HEADER.size if fec != FEC_NONE else 0
+    payload_size = data_payload(payload_size, fec)
+    packets = FilePacketizer(os.path.join(FOLDER, file), offset, chunk, seq_num, payload_size)
+    controller = make_controller(congestion, packet_size=payload_size, trace=CC_TRACE_DIR is not None)
+    # Packets go out at the controller's pacing rate, capped by the client and the server limit
+    caps = [rate for rate in (max_rate, MAX_RATE) if rate]
+    pacer = Pacer(packet_size=HEADER_SIZE + MAX_PAYLOAD, max_rate=min(caps) if caps else None)
+    encoder = FecEncoder(fec) if fec != FEC_NONE else None
+    # A client placing packets at seq * payload_size in its file needs them all the same size
+    sizer = PacketSizer(payload_size, overhead) if not fixed_size else None
+    return packets, controller, pacer, encoder, sizer
+
+
+def count(**deltas):
+    with stats_lock:
+        for key, delta in deltas.items():
+            server_stats[key] += delta
+
+
+def count_transfer(packets, controller, completed):
+    """Add a finished transfer to server_stats, bytes and packets only if the client got them all."""
+    stats = controller.stats()
+    if completed:
+        count(transfers=1, bytes_sent=packets.size, packets_sent=len(packets), loss_events=stats["loss_events"],
+              timeouts=stats["timeouts"])
+    else:
+        count(failed_transfers=1, loss_events=stats["loss_events"], timeouts=stats["timeouts"])
+
+
+def report_transfer(file, offset, chunk, packets, controller, pacer, encoder, sizer):
+    print(f"Sent {file} [{offset}, {offset + chunk}): {controller.stats()}")
+    if sizer is not None:
+        print(f"Packet size {file} [{offset}, {offset + chunk}): {sizer.stats()}")
+    if encoder is not None:
+        print(f"FEC {file} [{offset}, {offset + chunk}): {encoder.stats()}")
+    print(f"Pacing {file} [{offset}, {offset + chunk}): {pacer.stats()}")
+    print(f"Packetizer {file} [{offset}, {offset + chunk}): {packets.stats()}")
+    if CC_TRACE_DIR:
+        controller.write_trace(os.path.join(CC_TRACE_DIR, f"{file}.{offset}.{controller.name}.csv"))
+
+
+def send_file(server, client_addr, file, offset, chunk, seq_num, request_id, congestion=DEFAULT_CONGESTION, max_rate=0,
+              fec=FEC_NONE, payload_size=MAX_PAYLOAD, pull=False, fixed_size=False):
+        packets, controller, pacer, encoder, sizer = open_transfer(file, offset, chunk, seq_num, congestion, max_rate,
+                                                                   fec, payload_size, fixed_size)
+        with packets:
+            # The client's credit (or with pull its grants) bounds the window too, see utils.py
+            sent = modified_sliding_window_send(server, client_addr, packets, controller, pacer, encoder, sizer, pull)
+            count_transfer(packets, controller, sent)
+            report_transfer(file, offset, chunk, packets, controller, pacer, encoder, sizer)
             active_requests.remove(request_id)
 
 
+def parse_request(request):
+    """The settings of a REQUEST line: (file, offset, chunk, seq_num, congestion, max_rate, fec,
+    payload_size, pull, fixed_size). Older clients leave the later ones out."""
+    info = request.split()
+    fileName = info[1]
+    offset = int(info[2])
+    chunk = int(info[3])
+    seq_num = int(info[4])
+    congestion = info[5] if len(info) > 5 and info[5] in CONTROLLERS else DEFAULT_CONGESTION
+    max_rate = int(info[6]) if len(info) > 6 and info[6].isdigit() else 0
+    fec = FEC_CODES.get(info[7], FEC_NONE) if len(info) > 7 else FEC_NONE
+    payload_size = int(info[8]) if len(info) > 8 and info[8].isdigit() else MAX_PAYLOAD
+    payload_size = max(MIN_PAYLOAD, payload_size)
+    pull = len(info) > 9 and info[9] == "pull"
+    fixed_size = len(info) > 10 and info[10] == "fixed"
+    return fileName, offset, chunk, seq_num, congestion, max_rate, fec, payload_size, pull, fixed_size
+
+
 active_requests = set()
 
 def handle_client(server, client_addr):
@@ -90,52 +163,77 @@ def handle_client(server, client_addr):
                         print("Failed to send file size.")
                         break
                 
+                elif request.startswith('HASH'):
+                    fileName = request.split()[1]
+                    data = file_checksum(os.path.join(FOLDER, fileName)).encode(FORMAT) + delimiter.encode(FORMAT)
+                    msg_hash = make_packet(0, data)
+                    ack = send_rdt(server, client_addr, msg_hash)
+                    if ack != 1:
+                        print("Failed to send file hash.")
+                        break
+                
                 elif request.startswith("REQUEST"):
-                    info = request.split()
-                    fileName = info[1]
-                    offset = int(info[2])
-                    chunk = int(info[3])
-                    seq_num = int(info[4])
-                    print(f"Request for file chunk: {fileName} {offset} {chunk} {seq_num}")
+                    (fileName, offset, chunk, seq_num, congestion, max_rate, fec, payload_size, pull,
+                     fixed_size) = parse_request(request)
+                    print(f"Request for file chunk: {fileName} {offset} {chunk} {seq_num} ({congestion}, rate cap {max_rate}, fec {fec}, payload {payload_size}, {'pull' if pull else 'credit'})")
                     request_id = (addr, fileName, offset, chunk, seq_num)
                     
                     if os.path.exists(os.path.join(FOLDER, fileName)) and request_id not in active_requests:
                         active_requests.add(request_id)
-                        send_file(server, addr, fileName, offset, chunk, seq_num, request_id)
+                        send_file(server, addr, fileName, offset, chunk, seq_num, request_id, congestion, max_rate, fec,
+                                  payload_size, pull, fixed_size)
                     else:
                         print(f"File {fileName} not found or request already active.")
                         break
                 
+                elif request.startswith("PROBE"):
+                    pass  # Path MTU probe of the client, see pmtu.py: the ACK was the answer
+                
                 elif request.startswith("EXIT"):
+                    forget_session(server, client_addr)
                     return
+        except SessionClosed:
+            raise
         except Exception as e:
             print(f"Error processing request from {client_addr}: {e}")
             continue
 
+def serve_session(server, addr):
+    """Handshake with one client and serve its requests, server only carries this client's datagrams."""
+    data, addr, _ = recv_rdt(server, 0, {})
+    request = data.decode(FORMAT).split()
+    if request and request[0] == "CONNECT":
+        print(f"Connection request from {addr}")
+        scheme = negotiate_integrity(request[1] if len(request) > 1 else None)
+        
+        welcome = f"Welcome to the server!\nINTEGRITY {integrity_name(scheme)}\n".encode(FORMAT)
+        msg_welcome = make_packet(0, welcome)
+        ack = send_rdt(server, addr, msg_welcome, max_attempts=MAX_RETRIES)
+        if ack != 1:
+            print(f"Failed to send welcome message to {addr}")
+            return
+        else:
+            set_integrity(scheme, session=True)
+            print(f"Client {addr} connected, integrity {integrity_name(scheme)}.\n")
+    else:
+        print(f"Invalid connection request from {addr}")
+        return
+    
+    # Handle client requests
+    count(sessions=1, active_sessions=1)
+    try:
+        handle_client(server, addr)
+    finally:
+        count(active_sessions=-1)
+
 def run():
-    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server = tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
     server.bind((HOST, PORT))
     
     print(f"Server is running on {HOST} : {PORT}\n")
     try:
-        data, addr, _ = recv_rdt(server, 0, {})
-        if data.decode(FORMAT) == "CONNECT":
-            print(f"Connection request from {addr}")
-            
-            welcome = "Welcome to the server!\n".encode(FORMAT)
-            msg_welcome = make_packet(0, welcome)
-            ack = send_rdt(server, addr, msg_welcome)
-            if ack != 1:
-                print(f"Failed to send welcome message to {addr}")
-                return
-            else:
-                print(f"Client {addr} connected.\n")
-        else:
-            print(f"Invalid connection request from {addr}")
-            return
-        
-        # Handle client requests
-        handle_client(server, addr)
+        # Every client gets its own session thread, see sessions.py
+        Dispatcher(server, serve_session).run()
             
     except KeyboardInterrupt:
         print("\nServer interrupted by user.")
@@ -2,6 +2,7 @@ import threading
 import struct
 import logging
 from utils import *
+from sessions import Dispatcher
 
 
 HOST = socket.gethostbyname(socket.gethostname())
@@ -41,7 +42,7 @@ def send_file(server, client_addr, file, offset, size, seq_num, request_id):
         f.seek(offset)
 
         while totalSent < size:
-            part = f.read(min(BUFFER_SIZE - 4 - 32, size - totalSent))
+            part = f.read(min(MAX_PAYLOAD, size - totalSent))
             if not part:
                 break
             
@@ -118,40 +119,48 @@ def handle_client(server, client_addr):
                     print(f"Client {client_addr} disconnected.")
                     return
         
+        except SessionClosed:
+            raise
         except Exception as e:
             print(f"Error processing request from {client_addr}: {e}")
             continue
 
 
+def serve_session(server, addr):
+    """Handshake with one client and serve its requests, server only carries this client's datagrams."""
+    data, addr, _ = recv_rdt(server, 0, {})
+    
+    if data.decode(FORMAT).split()[:1] == ["CONNECT"]:
+        print(f"Connection request from {addr}")
+
+        welcome = "Welcome to the server!\n".encode(FORMAT)
+        msg_welcome = make_packet(0, welcome)
+        ack = send_rdt(server, addr, msg_welcome, max_attempts=MAX_RETRIES)
+        if ack != 1:
+            print(f"Failed to send welcome message to {addr}")
+            return
+        else:
+            print(f"Client {addr} connected.\n")
+    
+    else:
+        print(f"Invalid connection request from {addr}")
+        return
+    
+    # Handle client requests
+    handle_client(server, addr)
+
+
 def run():
-    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server = tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
     server.bind((HOST, PORT))
     print(f"Server is running on {HOST} : {PORT}.\n")
     
     try:
-        data, addr, _ = recv_rdt(server, 0, {})
-        
-        if data.decode(FORMAT) == "CONNECT":
-            print(f"Connection request from {addr}")
-    
-            welcome = "Welcome to the server!\n".encode(FORMAT)
-            msg_welcome = make_packet(0, welcome)
-            ack = send_rdt(server, addr, msg_welcome)
-            if ack != 1:
-                print(f"Failed to send welcome message to {addr}")
-                return
-            else:
-                print(f"Client {addr} connected.\n")
-        
-        else:
-            print(f"Invalid connection request from {addr}")
-            return
-        
-        # Handle client requests
-        handle_client(server, addr)
+        # Every client gets its own session thread, see sessions.py
+        Dispatcher(server, serve_session).run()
             
-    except Exception as e:
-        print(f"Error processing request from {addr}: {e}")
+    except KeyboardInterrupt:
+        print("\nServer interrupted by user.")
             
     finally:
         print("Server shutting down ...")
@@ -0,0 +1,184 @@
+# Description: Serve many UDP clients from one socket.
+#
+# The Dispatcher owns the server socket. A single thread reads every datagram and hands
+# it to the session of its sender; a CONNECT from an unknown address opens a new session.
+# Each session runs the usual blocking request loop (recv_rdt, send_rdt, the selective
+# repeat sender) in its own thread, on a SessionSocket that only sees the datagrams of its
+# peer, so none of that code needs to know other clients exist.
+#
+# The peer address is the session ID: ACKs (8 bytes), SACKs and grants carry no room for one.
+# Sessions get a sequential number for the logs and are closed after SESSION_TIMEOUT
+# seconds without a datagram from their client.
+import queue
+import socket
+import threading
+import time
+from utils import (BUFFER_SIZE, ACK, MESSAGE_FLAG, SessionClosed, extract_data, extract_message, extract_seq_num,
+                   extract_stamp, forget_session, verify_packet)
+
+MAX_SESSIONS = 64
+SESSION_TIMEOUT = 300.0  # seconds without any datagram from the client
+SWEEP_INTERVAL = 1.0  # how often idle sessions are looked for
+QUEUE_SIZE = 4096  # datagrams waiting for a session thread, more are dropped like a full socket buffer
+
+
+def is_connect(data):
+    """True for a verified stop-and-wait CONNECT message, the only datagram that opens a session."""
+    return (len(data) != ACK.size and bytes(extract_data(data)[:7]) == b"CONNECT" and verify_packet(data)
+            and bool(extract_message(data) & MESSAGE_FLAG))
+
+
+class SessionSocket:
+    """The part of a socket that utils needs, connected to one peer of a shared socket."""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.timeout = None
+        self.closed = False
+
+    def deliver(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            pass  # The sender's retransmission timer recovers it
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def recvfrom(self, size):
+        if self.closed:
+            raise SessionClosed(self.addr)
+        try:
+            data = self.queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout("timed out")
+        if data is None:
+            raise SessionClosed(self.addr)
+        return data[:size], self.addr
+
+    def recvfrom_into(self, buffer):
+        data, addr = self.recvfrom(len(buffer))
+        buffer[:len(data)] = data
+        return len(data), addr
+
+    def sendto(self, data, addr):
+        return self.sock.sendto(data, addr)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, addr=None):
+        return self.sock.sendmsg(buffers, ancdata, flags, addr or self.addr)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # Wake up a blocked receive without ever blocking the dispatcher: a wedged session
+            # thread may have left its queue full, the datagrams dropped are not needed any more
+            while True:
+                try:
+                    self.queue.put_nowait(None)
+                    return
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+
+class Session:
+    def __init__(self, number, sock, addr):
+        self.number = number
+        self.addr = addr
+        self.socket = SessionSocket(sock, addr)
+        self.last_activity = time.monotonic()
+        self.thread = None
+
+
+class Dispatcher:
+    """Reads the shared socket and runs handler(session_socket, addr) once per client."""
+
+    def __init__(self, sock, handler, max_sessions=MAX_SESSIONS, session_timeout=SESSION_TIMEOUT):
+        self.sock = sock
+        self.handler = handler
+        self.max_sessions = max_sessions
+        self.session_timeout = session_timeout
+        self.sessions = {}  # peer address -> Session
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.last_sweep = time.monotonic()
+
+    def run(self):
+        self.sock.settimeout(SWEEP_INTERVAL)
+        try:
+            while True:
+                try:
+                    data, addr = self.sock.recvfrom(BUFFER_SIZE)
+                except socket.timeout:
+                    data = None
+                except ConnectionResetError:
+                    continue  # ICMP port unreachable from a client that went away (Windows)
+
+                if data is not None:
+                    self.dispatch(data, addr)
+                if time.monotonic() - self.last_sweep >= SWEEP_INTERVAL:
+                    self.sweep()
+        finally:
+            with self.lock:
+                sessions = list(self.sessions.values())
+            for session in sessions:
+                session.socket.close()
+
+    def dispatch(self, data, addr):
+        with self.lock:
+            session = self.sessions.get(addr)
+        if session is not None:
+            session.last_activity = time.monotonic()
+            session.socket.deliver(data)
+        elif is_connect(data):
+            self.open(addr, data)
+        elif len(data) != ACK.size and bytes(extract_data(data)[:4]) == b"EXIT" and verify_packet(data):
+            # The session already ended, our ACK of its EXIT got lost
+            self.sock.sendto(ACK.pack(extract_seq_num(data) + 1, extract_stamp(data)), addr)
+
+    def open(self, addr, data):
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                print(f"Refusing {addr}: {self.max_sessions} sessions already open.")
+                return
+            self.opened += 1
+            session = Session(self.opened, self.sock, addr)
+            self.sessions[addr] = session
+        print(f"Session {session.number} opened for {addr} ({len(self.sessions)} active)")
+        session.socket.deliver(data)
+        session.thread = threading.Thread(target=self.serve, args=(session,), daemon=True)
+        session.thread.start()
+
+    def serve(self, session):
+        try:
+            self.handler(session.socket, session.addr)
+        except SessionClosed:
+            pass
+        except Exception as e:
+            print(f"Session {session.number} ({session.addr}) failed: {e}")
+        finally:
+            self.close(session)
+
+    def close(self, session):
+        with self.lock:
+            if self.sessions.get(session.addr) is session:
+                del self.sessions[session.addr]
+        session.socket.close()
+        forget_session(session.socket, session.addr)
+        print(f"Session {session.number} closed for {session.addr} ({len(self.sessions)} active)")
+
+    def sweep(self):
+        self.last_sweep = time.monotonic()
+        with self.lock:
+            idle = [session for session in self.sessions.values()
+                    if self.last_sweep - session.last_activity > self.session_timeout]
+        for session in idle:
+            print(f"Session {session.number} ({session.addr}) idle for {self.session_timeout:.0f} s, closing.")
+            session.socket.close()  # Its thread sees SessionClosed and cleans up
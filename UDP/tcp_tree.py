@@ -0,0 +1,16 @@
+# Description: Loads modules of the TCP tree for the UDP clients that reuse them.
+#
+# Both trees have modules of the same names (client, server, batch, async_client), so the TCP
+# folder is not put on sys.path: a module is imported by its path, as tcp_<name>.
+import importlib.util
+import os
+
+TCP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "TCP")
+
+
+def load_tcp_module(name):
+    """TCP/<name>.py, imported as tcp_<name>."""
+    spec = importlib.util.spec_from_file_location(f"tcp_{name}", os.path.join(TCP_PATH, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
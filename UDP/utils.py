@@ -1,10 +1,15 @@
 # Description: Utility functions for UDP client and server.
+import contextlib
 import hashlib
 import struct
 import socket
 import time
 import os
 import math
+import zlib
+import heapq
+import contextvars
+from pacing import precise_sleep, SPIN_THRESHOLD
 
 # Constants
 BUFFER_SIZE = 1024 * 4
@@ -17,110 +22,531 @@ INVALID_PACKET = 0xFFFFFFFF # Invalid sequence number
 INITIAL_TIMEOUT = 1.0  # Initial timeout in seconds
 ALPHA = 0.125  # Smoothing factor for RTT
 BETA = 0.25  # Smoothing factor for deviation
-MIN_TIMEOUT = 1.0  # seconds
+MIN_TIMEOUT = 0.2  # seconds, echoed timestamps make a lower floor than RFC 6298's 1 s safe
 MAX_TIMEOUT = 10.0  # seconds
+MAX_IDLE = 30.0  # seconds without progress before a windowed transfer is abandoned
+RECEIVE_WINDOW = 1024  # packets buffered out of order by the receiver
+SOCKET_BUFFER = 1024 * 1024 * 4  # Kernel buffer able to hold a full window of datagrams
+RING_SLOTS = 8  # Receive buffers per socket, a received packet stays valid for RING_SLOTS receives
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")  # Scatter-gather send, missing on Windows
 
-# Variables for dynamic timeout
-estimated_rtt = INITIAL_TIMEOUT
-deviation = 0.0
-timeout_interval = INITIAL_TIMEOUT
+ACK = struct.Struct('!II')  # Cumulative ACK: next expected sequence number, echoed timestamp
 
+# Selective ACK: cumulative ACK | kind (1) | loss (1) | bitmap length (2) | credit (2) | echo (4) | crc32 (4) | bitmap
+# Bit i of the bitmap means packet cumulative + 1 + i has arrived. The kind byte sits where a
+# data packet carries its integrity scheme, so the two can never be confused. The loss byte is
+# the loss rate the receiver measures, in 1/LOSS_SCALE (0 from receivers that do not measure).
+# The credit is how many packets from the cumulative ACK on the receiver has room for.
+SACK = struct.Struct('!IBBHHII')
+SACK_KIND = 0xFF
 
-def calculate_checksum(data):
-    """Calculate the MD5 checksum of the given data."""
-    return hashlib.md5(data).hexdigest()
+# Grant of the receiver-pull mode: first sequence number | kind (1) | end sequence number | crc32 (4)
+# The sender may send the new packets of [first, end), and nothing it was not granted.
+GRANT = struct.Struct('!IB3xII')
+GRANT_KIND = 0xFE
+GRANT_BATCH = 64  # packets the consumer frees before the receiver grants them (at most a quarter of its capacity)
+INITIAL_CREDIT = 64  # packets sent before the receiver advertised its credit
+DATAGRAM_OVERHEAD = 512  # bytes of kernel bookkeeping per queued datagram, next to twice its buffer
+SACK_MAX_BYTES = RECEIVE_WINDOW // 8
+LOSS_SCALE = 255
+LOSS_WINDOW = 256  # data packets per loss rate sample
+LOSS_GAIN = 0.5  # weight of a new sample in the smoothed loss rate
+DUP_ACK_THRESHOLD = 3  # Duplicate ACKs (or packets SACKed above a hole) before a fast retransmit
+ACK_EVERY = 4  # In-order data packets acknowledged by one SACK, gaps and duplicates are acknowledged at once
+ACK_DELAY = 0.005  # seconds a SACK may be held back waiting for more in-order packets
 
+# RTT estimator of every session, per (socket, peer address)
+rtt_estimators = {}
 
-def make_packet(seq_num, data):
-    """Create a packet with a sequence number, checksum, and data."""
-    header = struct.pack('!I', seq_num)
-    checksum_value = calculate_checksum(header + data)
-    checksum_value = checksum_value.encode() if isinstance(checksum_value, str) else checksum_value
-    return struct.pack('!32s', checksum_value) + header + data
+# Datagrams read by a windowed sender that belong to the next exchange, per socket
+pending_packets = {}
+
+# Pooled receive buffers, per socket
+receive_rings = {}
+
+# Stop-and-wait message counters, per (socket, peer address): [next to send, next expected]
+message_counters = {}
+
+
+# Integrity schemes, negotiated at CONNECT and carried in every packet header
+INTEGRITY_NONE = 0  # Only valid when the whole file hash is checked end-to-end
+INTEGRITY_CRC32 = 1
+INTEGRITY_KEYED = 2  # BLAKE2b keyed with a shared secret, truncated to 8 bytes
+INTEGRITY_ADLER32 = 3  # Weaker than CRC-32 on short packets, but computed for a batch at once (see batchsum.py)
+INTEGRITY_NAMES = {"none": INTEGRITY_NONE, "crc32": INTEGRITY_CRC32, "keyed": INTEGRITY_KEYED,
+                   "adler32": INTEGRITY_ADLER32}
+DEFAULT_INTEGRITY = INTEGRITY_CRC32
+
+# Packet layout: seq (4) | integrity scheme (1) | message (1) | padding (2) | check value (8) | timestamp (4) | data
+# The timestamp is rewritten on every (re)transmission and echoed in the ACK, so it is left
+# out of the check value; the sender only trusts echoes of timestamps it actually sent.
+# The message byte is 0 for windowed data and MESSAGE_FLAG | counter for stop-and-wait
+# messages (send_rdt/recv_rdt), whose 7-bit counter tells a new message from a retransmission.
+# PARITY_FLAG marks the parity packets of forward error correction (see fec.py), which are
+# sent along windowed data but are outside its sequence space.
+PACKET_PREFIX = struct.Struct('!IBB2x')
+MESSAGE_FLAG = 0x80
+PARITY_FLAG = 0x40
+PACKET_CHECK = struct.Struct('!Q')
+PACKET_STAMP = struct.Struct('!I')
+STAMP_OFFSET = PACKET_PREFIX.size + PACKET_CHECK.size
+HEADER_SIZE = STAMP_OFFSET + PACKET_STAMP.size
+MAX_PAYLOAD = BUFFER_SIZE - HEADER_SIZE
+
+# Integrity of the current session
+integrity_scheme = DEFAULT_INTEGRITY
+integrity_key = os.environ.get("RDT_KEY", "").encode() or None
+
+# Integrity of the session served by the calling thread or asyncio task, None: integrity_scheme.
+# Every thread starts with an empty context and every asyncio task runs in a context of its
+# own (see async_rdt.py), so servers with a thread or a task per session need no locking.
+session_integrity = contextvars.ContextVar("session_integrity", default=None)
+
+
+class SessionClosed(Exception):
+    """The session of a socket was closed while waiting for its peer."""
+
+
+def set_integrity(scheme, key=None, session=False):
+    """Switch the integrity scheme used for outgoing packets and accepted on incoming ones,
+    process wide or (session=True) only for the session served by the calling thread or task."""
+    global integrity_scheme, integrity_key
+    if key is not None:
+        integrity_key = key
+    if scheme == INTEGRITY_KEYED and not integrity_key:
+        raise ValueError("keyed integrity needs a shared key (set RDT_KEY)")
+    if session:
+        session_integrity.set(scheme)
+    else:
+        integrity_scheme = scheme
+
+
+def current_integrity():
+    scheme = session_integrity.get()
+    return integrity_scheme if scheme is None else scheme
+
+
+def integrity_name(scheme):
+    for name, value in INTEGRITY_NAMES.items():
+        if value == scheme:
+            return name
+    return str(scheme)
+
+
+def calculate_checksum(scheme, prefix, data):
+    """Calculate the check value of a packet for the given integrity scheme."""
+    if scheme == INTEGRITY_CRC32:
+        return zlib.crc32(data, zlib.crc32(prefix))
+    if scheme == INTEGRITY_ADLER32:
+        return zlib.adler32(data, zlib.adler32(prefix))
+    if scheme == INTEGRITY_KEYED:
+        digest = hashlib.blake2b(prefix, key=integrity_key, digest_size=8)
+        digest.update(data)
+        return int.from_bytes(digest.digest(), 'big')
+    return 0
+
+
+def accepts_scheme(scheme):
+    """A session never accepts a weaker scheme than the negotiated one, except crc32 on a 'none' session."""
+    negotiated = current_integrity()
+    if scheme == negotiated:
+        return True
+    return negotiated == INTEGRITY_NONE and scheme == INTEGRITY_CRC32
+
+
+def file_checksum(path, offset=0, size=None):
+    """Calculate the MD5 checksum of a file (or a range of it), used end-to-end with INTEGRITY_NONE."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = size
+        while remaining is None or remaining > 0:
+            block = f.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+            if not block:
+                break
+            md5.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return md5.hexdigest()
+
+
+def pack_header(buffer, seq_num, data, scheme=None, stamp=0, offset=0, message=0):
+    """Write the header of a packet carrying data into buffer at offset, without allocating."""
+    scheme = current_integrity() if scheme is None else scheme
+    PACKET_PREFIX.pack_into(buffer, offset, seq_num, scheme, message)
+    prefix = memoryview(buffer)[offset:offset + PACKET_PREFIX.size]
+    PACKET_CHECK.pack_into(buffer, offset + PACKET_PREFIX.size, calculate_checksum(scheme, prefix, data))
+    PACKET_STAMP.pack_into(buffer, offset + STAMP_OFFSET, stamp)
+
+def make_packet(seq_num, data, scheme=None):
+    """Create a packet with a sequence number, check value, and data."""
+    packet = bytearray(HEADER_SIZE + len(data))
+    packet[HEADER_SIZE:] = data
+    pack_header(packet, seq_num, data, scheme, timestamp())
+    return packet
+
+def split_packet(packet):
+    """(header, payload) views of a packet given whole or as a (header, payload) pair."""
+    if isinstance(packet, tuple):
+        return packet
+    view = memoryview(packet)
+    return view[:HEADER_SIZE], view[HEADER_SIZE:]
+
+def packet_size(packet):
+    if isinstance(packet, tuple):
+        return len(packet[0]) + len(packet[1])
+    return len(packet)
+
+def send_packet(sock, addr, packet, stamp, header):
+    """Send packet with its timestamp set to stamp. header is a HEADER_SIZE bytearray reused for
+    every send; the payload goes to the kernel straight from its buffer."""
+    head, payload = split_packet(packet)
+    header[:] = head
+    PACKET_STAMP.pack_into(header, STAMP_OFFSET, stamp)
+    send_parts(sock, addr, header, payload)
+
+def send_parts(sock, addr, header, payload):
+    if HAS_SENDMSG:
+        sock.sendmsg((header, payload), (), 0, addr)
+    else:
+        sock.sendto(header + payload, addr)
+
+def timestamp():
+    """Microseconds of the monotonic clock, modulo 2**32 (wraps every 71 minutes)."""
+    return int(time.monotonic() * 1e6) & 0xFFFFFFFF
+
+def extract_stamp(packet):
+    """Extract the timestamp the ACK of this packet has to echo"""
+    return PACKET_STAMP.unpack_from(packet, STAMP_OFFSET)[0]
+
+def echo_rtt(echo):
+    """Seconds since the timestamp echo was taken."""
+    return ((timestamp() - echo) & 0xFFFFFFFF) / 1e6
 
 def extract_seq_num(packet):
-    """Extract sequence number from packet with checksum"""
-    # Skip 32 bytes checksum, then read 4 bytes sequence number
-    return struct.unpack('!I', packet[32:36])[0]
+    """Extract sequence number from packet"""
+    return PACKET_PREFIX.unpack_from(packet)[0]
+
+def extract_scheme(packet):
+    return PACKET_PREFIX.unpack_from(packet)[1]
+
+def extract_message(packet):
+    """The message byte: 0 for windowed data, MESSAGE_FLAG | counter for stop-and-wait messages"""
+    return PACKET_PREFIX.unpack_from(packet)[2]
+
+def is_parity(packet):
+    return extract_message(packet) & (MESSAGE_FLAG | PARITY_FLAG) == PARITY_FLAG
 
 def extract_data(packet):
-    """Extract data from packet, skipping checksum and sequence number"""
-    # Skip 32 bytes checksum and 4 bytes sequence number
-    return packet[36:]
+    """Extract data from packet, skipping the header (a view if packet is a memoryview)"""
+    return packet[HEADER_SIZE:]
 
 def verify_packet(packet):
-    """Verify packet integrity using checksum"""
-    stored_checksum = packet[:32].strip(b'\x00')  # First 32 bytes are checksum
-    actual_data = packet[32:]  # Rest is header + data
-    calculated_checksum = calculate_checksum(actual_data).encode()
-    return stored_checksum == calculated_checksum
+    """Verify packet integrity using the scheme in its header"""
+    if len(packet) < HEADER_SIZE:
+        return False
+    view = memoryview(packet)
+    return verify_parts(view[:HEADER_SIZE], view[HEADER_SIZE:])
+
+def verify_parts(header, payload):
+    """Verify a packet received as separate header and payload buffers"""
+    _, scheme, _ = PACKET_PREFIX.unpack_from(header)
+    if not accepts_scheme(scheme):
+        return False
+    stored_check = PACKET_CHECK.unpack_from(header, PACKET_PREFIX.size)[0]
+    return stored_check == calculate_checksum(scheme, header[:PACKET_PREFIX.size], payload)
+
+
+class ReceiveRing:
+    """A ring of preallocated receive buffers. recv returns a memoryview of the datagram that
+    stays valid until the ring comes around again, len(buffers) receives later."""
+
+    def __init__(self, slots=RING_SLOTS, size=BUFFER_SIZE):
+        self.buffers = [memoryview(bytearray(size)) for _ in range(slots)]
+        self.next = 0
+
+    def recv(self, sock):
+        buffer = self.buffers[self.next]
+        self.next = (self.next + 1) % len(self.buffers)
+        length, addr = sock.recvfrom_into(buffer)
+        return buffer[:length], addr
+
+
+def receive_packet(sock):
+    """Receive a datagram into the socket's ring, see ReceiveRing."""
+    ring = receive_rings.get(sock)
+    if ring is None:
+        ring = receive_rings[sock] = ReceiveRing()
+    return ring.recv(sock)
+
+
+
+def tune_socket(sock):
+    """Enlarge the kernel buffers so a burst of one window is not dropped by the OS."""
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+    return sock
 
 
+def make_sack(cumulative, received, echo=0, loss=0.0, credit=RECEIVE_WINDOW):
+    """Build a selective ACK for the next expected sequence number and the buffered ones above it,
+    echoing the timestamp of the packet that triggered it and reporting the measured loss rate
+    and the packets the receiver has room for."""
+    bits = 0
+    for seq_num in received:
+        offset = seq_num - cumulative - 1
+        if 0 <= offset < SACK_MAX_BYTES * 8:
+            bits |= 1 << offset
+    return pack_sack(cumulative, bits, echo, loss, credit)
 
-def send_rdt(client, addr, packet):
-    """Send a packet and handle retransmissions with dynamic timeout."""
-    global estimated_rtt, deviation, timeout_interval
+
+def pack_sack(cumulative, bits, echo=0, loss=0.0, credit=RECEIVE_WINDOW):
+    """Build a selective ACK from its bitmap as an integer, bit i for packet cumulative + 1 + i."""
+    bitmap = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    loss = min(LOSS_SCALE, round(loss * LOSS_SCALE))
+    credit = max(0, min(0xFFFF, credit))
+    prefix = SACK.pack(cumulative, SACK_KIND, loss, len(bitmap), credit, echo, 0)[:SACK.size - 4]
+    crc = zlib.crc32(bitmap, zlib.crc32(prefix))
+    return SACK.pack(cumulative, SACK_KIND, loss, len(bitmap), credit, echo, crc) + bitmap
+
+
+def is_sack(packet):
+    return len(packet) >= SACK.size and packet[4] == SACK_KIND
+
+
+def parse_sack(packet):
+    """Return (cumulative ACK, list of selectively acknowledged sequence numbers, echoed timestamp,
+    loss rate measured by the receiver, credit) or None if corrupted."""
+    cumulative, _, loss, length, credit, echo, crc = SACK.unpack_from(packet)
+    bitmap = packet[SACK.size:]
+    if len(bitmap) != length or zlib.crc32(bitmap, zlib.crc32(packet[:SACK.size - 4])) != crc:
+        return None
+
+    selected = []
+    bits = int.from_bytes(bitmap, 'little')
+    while bits:
+        lowest = bits & -bits
+        selected.append(cumulative + lowest.bit_length())
+        bits ^= lowest
+    return cumulative, selected, echo, loss / LOSS_SCALE, credit
+
+
+def make_grant(first, end):
+    """Grant the sender the packets [first, end) in receiver-pull mode."""
+    prefix = GRANT.pack(first, GRANT_KIND, end, 0)[:GRANT.size - 4]
+    return GRANT.pack(first, GRANT_KIND, end, zlib.crc32(prefix))
+
+
+def is_grant(packet):
+    return len(packet) == GRANT.size and packet[4] == GRANT_KIND
+
+
+def parse_grant(packet):
+    """Return the granted (first, end) sequence numbers or None if corrupted."""
+    first, _, end, crc = GRANT.unpack(packet)
+    if zlib.crc32(packet[:GRANT.size - 4]) != crc:
+        return None
+    return first, end
+
+
+def receive_capacity(sock, window_size=RECEIVE_WINDOW):
+    """Packets the receiver can hold between the consumer and the network: the kernel buffer
+    of sock (full size datagrams, each charged about twice its size) and at most window_size."""
+    try:
+        rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)  # Already doubled by Linux
+    except (OSError, AttributeError):
+        return window_size
+    return max(ACK_EVERY, min(window_size, rcvbuf // (2 * BUFFER_SIZE + DATAGRAM_OVERHEAD)))
+
+
+class LossMeter:
+    """Loss rate of windowed data as it arrives, before retransmission or FEC repairs it.
+
+    Every sequence number skipped by a new highest one counts as lost, so reordering counts as
+    loss too. The rate is smoothed over samples of LOSS_WINDOW packets.
+    """
+
+    def __init__(self, window=LOSS_WINDOW):
+        self.window = window
+        self.highest = None
+        self.lost = 0
+        self.total = 0
+        self.rate = 0.0
+        self.samples = 0
+
+    def on_packet(self, seq_num):
+        if self.highest is not None and seq_num <= self.highest:
+            return  # Retransmission or reordered
+        gap = 0 if self.highest is None else seq_num - self.highest - 1
+        self.highest = seq_num
+        self.lost += gap
+        self.total += gap + 1
+        if self.total >= self.window:
+            sample = self.lost / self.total
+            self.rate = sample if not self.samples else (1 - LOSS_GAIN) * self.rate + LOSS_GAIN * sample
+            self.samples += 1
+            self.lost = self.total = 0
+
+
+class RttEstimator:
+    """Smoothed RTT and retransmission timeout of one session (RFC 6298).
+
+    Callers only feed unambiguous samples: echoed timestamps, or packets sent once (Karn).
+    Every expired timer doubles the timeout until the next valid sample.
+    """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_TIMEOUT
+        self.samples = 0
+        self.backoffs = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = max(MIN_TIMEOUT, min(MAX_TIMEOUT, self.srtt + 4 * self.rttvar))
+        self.samples += 1
+
+    def backoff(self):
+        self.rto = min(MAX_TIMEOUT, self.rto * 2)
+        self.backoffs += 1
+
+
+def session_rtt(client, addr):
+    """The RTT estimator of the session with addr on this socket."""
+    key = (client, addr)
+    if key not in rtt_estimators:
+        rtt_estimators[key] = RttEstimator()
+    return rtt_estimators[key]
+
+
+def forget_session(client, addr):
+    """Drop the per session state kept for addr on this socket."""
+    rtt_estimators.pop((client, addr), None)
+    message_counters.pop((client, addr), None)
+    if not isinstance(client, socket.socket):
+        # A socket object per session (see sessions.py): its buffers go with it
+        pending_packets.pop(client, None)
+        receive_rings.pop(client, None)
+
+
+def unread_packet(client, data, addr):
+    """Hand a datagram back so the next recv_rdt on this socket returns it first."""
+    pending_packets.setdefault(client, []).append((data, addr))
+
+
+def next_packet(client):
+    """The next datagram for this socket: an unread one first, else one from the receive ring."""
+    if pending_packets.get(client):
+        return pending_packets[client].pop(0)
+    return receive_packet(client)
+
+
+def message_counters_for(client, addr):
+    key = (client, addr)
+    if key not in message_counters:
+        message_counters[key] = [0, None]  # Next counter to send, next expected (None: any)
+    return message_counters[key]
+
+
+def is_duplicate_message(client, addr, message):
+    """A stop-and-wait message that was already delivered, its ACK must have been lost."""
+    expected = message_counters_for(client, addr)[1]
+    return expected is not None and message == MESSAGE_FLAG | ((expected - 1) % 128)
+
+
+def send_rdt(client, addr, packet, max_attempts=None):
+    """Send a packet and handle retransmissions with dynamic timeout.
+    Gives up and returns None after max_attempts timeouts (default: retry forever)."""
+    rtt = session_rtt(client, addr)
+    counters = message_counters_for(client, addr)
+    stamps = set()  # Timestamps of our transmissions, an ACK echoing one of them is an exact sample
+
+    # Mark the packet as the next stop-and-wait message, so the peer can tell it from a retransmission
+    head, payload = split_packet(packet)
+    header = bytearray(HEADER_SIZE)
+    seq_num = extract_seq_num(head)
+    pack_header(header, seq_num, payload, extract_scheme(head), message=MESSAGE_FLAG | counters[0])
+
+    attempts = 0
     while True:
-        start_time = time.time()  # Measure RTT
-        client.sendto(packet, addr)
+        stamp = timestamp()
+        stamps.add(stamp)
+        PACKET_STAMP.pack_into(header, STAMP_OFFSET, stamp)
+        send_parts(client, addr, header, payload)
+        deadline = time.monotonic() + rtt.rto
         try:
-            client.settimeout(timeout_interval)
-            response, _ = client.recvfrom(BUFFER_SIZE)
-            
-            if len(response) < 4:
-                # print("Invalid packet received, resending")
-                continue
-            
-            # print(response)
-            response_number = struct.unpack('!I', response)[0]
-            # print(f"Received ACK {response_number}")
-            
-            if response_number == INVALID_PACKET:  # NACK received
-                # print("NACK received, resending packet")
-                continue
-            
-            # Calculate RTT dynamically
-            sample_rtt = time.time() - start_time
-            estimated_rtt = (1 - ALPHA) * estimated_rtt + ALPHA * sample_rtt
-            deviation = (1 - BETA) * deviation + BETA * abs(sample_rtt - estimated_rtt)
-            timeout_interval = max(MIN_TIMEOUT, min(MAX_TIMEOUT, estimated_rtt + 4 * deviation))
-            
-            return response_number  # ACK received
+            while True:
+                client.settimeout(max(deadline - time.monotonic(), 0.0001))
+                response, peer = receive_packet(client)
+
+                if len(response) == ACK.size:
+                    response_number, echo = ACK.unpack(response)
+                    if response_number == INVALID_PACKET:  # NACK received
+                        break
+                    if echo not in stamps:
+                        continue  # Late ACK of an earlier message
+                    rtt.sample(echo_rtt(echo))
+                    counters[0] = (counters[0] + 1) % 128
+                    return response_number  # ACK received
+
+                # Windowed data of a finished transfer and SACKs need no answer here
+                if peer != addr or not verify_packet(response) or not extract_message(response):
+                    continue
+                if is_duplicate_message(client, peer, extract_message(response)):
+                    # The peer resends its last message because our ACK got lost
+                    client.sendto(ACK.pack(extract_seq_num(response) + 1, extract_stamp(response)), peer)
+                    continue
+
+                # The peer already sent its next message, so ours arrived and only the ACK was lost
+                unread_packet(client, bytes(response), peer)
+                counters[0] = (counters[0] + 1) % 128
+                return seq_num + 1
         except socket.timeout:
+            rtt.backoff()
+            attempts += 1
+            if max_attempts is not None and attempts >= max_attempts:
+                return None
             print("Timeout, resending packet")
 
 
 def recv_rdt(client, expected_seq, received_packets):
     """Receive a packet, check checksum, and handle ACK/NACK."""
-    global estimated_rtt, deviation, timeout_interval
     while True:
         try:
-            client.settimeout(timeout_interval)
-            data, addr = client.recvfrom(BUFFER_SIZE)
-            
-            if len(data) < 32:
-                # print("Invalid packet received, sending NACK")
-                nack = struct.pack('!I', INVALID_PACKET)
-                client.sendto(nack, addr)
-                continue
+            client.settimeout(INITIAL_TIMEOUT)
+            data, addr = next_packet(client)
             
-            # Unpack and verify checksum
-            packet_checksum = struct.unpack('!32s', data[:32])[0].decode()
-            payload = data[32:] 
+            if len(data) == ACK.size or is_sack(data) or is_grant(data):
+                continue  # Late ACK or grant of a finished transfer
             
-            if calculate_checksum(payload) == packet_checksum:
-                if len(payload) < 4:
-                    # print("Invalid packet received, sending NACK")
-                    nack = struct.pack('!I', INVALID_PACKET)
-                    client.sendto(nack, addr)
+            # Verify the check value and unpack the header
+            if verify_packet(data):
+                message = extract_message(data)
+                if not message:
+                    continue  # Windowed data of a finished transfer
+                seq_num = extract_seq_num(data)
+                echo = extract_stamp(data)
+                
+                if is_duplicate_message(client, addr, message):
+                    # Already delivered, only our ACK got lost
+                    client.sendto(ACK.pack(seq_num + 1, echo), addr)
                     continue
                 
-                seq_num = struct.unpack('!I', payload[:4])[0]
-                data = payload[4:]
+                data = bytes(extract_data(data))  # Out of the receive ring, callers keep and decode it
                 
                 # Handle out-of-order packets
                 if seq_num == expected_seq:
-                    ack = struct.pack('!I', seq_num + 1)
+                    message_counters_for(client, addr)[1] = ((message & ~MESSAGE_FLAG) + 1) % 128
+                    ack = ACK.pack(seq_num + 1, echo)
                     client.sendto(ack, addr)
                     return data, addr, seq_num + 1  # Pass next expected sequence
                 
@@ -128,168 +554,28 @@ def recv_rdt(client, expected_seq, received_packets):
                     # print("Handling out-of-order packet")
                     # Buffer out-of-order packets
                     received_packets[seq_num] = data
-                    ack = struct.pack('!I', expected_seq)  # Reconfirm last ACK
+                    ack = ACK.pack(expected_seq, echo)  # Reconfirm last ACK
                     client.sendto(ack, addr)
                 
                 else:
                     # Duplicate packet
                     # print("Duplicate packet received")
-                    ack = struct.pack('!I', expected_seq)
+                    ack = ACK.pack(expected_seq, echo)
                     client.sendto(ack, addr)
             else:
                 # Checksum mismatch, send NACK
                 # print("Checksum mismatch, sending NACK")
-                nack = struct.pack('!I', INVALID_PACKET)
+                nack = ACK.pack(INVALID_PACKET, 0)
                 client.sendto(nack, addr)
         except socket.timeout:
             # print("Timeout while receiving packet")
             continue
+        except SessionClosed:
+            raise
         except Exception as e:
             print(f"Unexpected error in recv_rdt: {e}")
 
 
- 
- 
-# def send_rdt(client, addr, packet):
-#     while True:
-#         client.sendto(packet, addr)
-#         try:
-#             client.settimeout(TIMEOUT)
-#             response, _ = client.recvfrom(BUFFER_SIZE)
-#             response_number = struct.unpack('!I', response)[0]
-#             if response_number == 0:  # NACK received
-#                 print("NACK received, resending packet")
-#                 continue
-#             return response_number  # ACK received
-#         except socket.timeout:
-#             print("Timeout, resending packet")
-
-
-# def recv_rdt(client):
-#     """Receive a packet and send an acknowledgment."""
-#     while True:
-#         try:
-#             data, addr = client.recvfrom(BUFFER_SIZE)
-#             packet_checksum = struct.unpack('!32s', data[:32])[0].decode()
-#             payload = data[32:]
-#             if calculate_checksum(payload) == packet_checksum:
-#                 seq_num = struct.unpack('!I', payload[:4])[0]
-#                 ack = struct.pack('!I', seq_num + 1)
-#                 client.sendto(ack, addr)
-#                 return payload[4:], addr
-#             else:
-#                 print("Checksum mismatch, sending NACK")
-#                 nack = struct.pack('!I', 0) # NACK with sequence number 0 (invalid packet)
-#                 client.sendto(nack, addr)
-#         except socket.timeout:
-#             print("Timeout while receiving packet")
-#         except struct.error as e:
-#             print(f"Packet structure error: {e}")
-#         except Exception as e:
-#             print(f"Unexpected error in recv_rdt: {e}")
-
-
-# selective repeat            
-def sliding_window_send(client, addr, packets, window_size):
-    """Improved sliding window send with per-packet timers and selective retransmissions."""
-    global estimated_rtt, deviation, timeout_interval
-    base = 0
-    next_seq_num = 0
-    window = {}
-    max_seq_num = len(packets)
-
-    while base < max_seq_num:
-        # Send packets within the window
-        while next_seq_num < min(base + window_size, max_seq_num):
-            if next_seq_num not in window:
-                try:
-                    start_time = time.time()  # Measure RTT
-                    response = send_rdt(client, addr, packets[next_seq_num])
-                    
-                    if response is not None and response > base:
-                        old_base = base
-                        base = response
-                        # Clear acknowledged packets
-                        for seq in range(old_base, base):
-                            window.pop(seq, None)
-                        
-                        # Calculate RTT dynamically
-                        sample_rtt = time.time() - start_time
-                        estimated_rtt = (1 - ALPHA) * estimated_rtt + ALPHA * sample_rtt
-                        deviation = (1 - BETA) * deviation + BETA * abs(sample_rtt - estimated_rtt)
-                        timeout_interval = max(MIN_TIMEOUT, min(MAX_TIMEOUT, estimated_rtt + 4 * deviation))
-                        
-                except Exception as e:
-                    print(f"Error sending packet {next_seq_num}: {e}")
-                    return
-            window[next_seq_num] = True
-            next_seq_num += 1
-
-        # Check for timeouts and handle retransmissions
-        try:
-            client.settimeout(timeout_interval)
-            response, _ = client.recvfrom(BUFFER_SIZE)
-            # print(f"Received ACK {response}")
-            
-            # Check if this is a file request (starts with checksum)
-            if len(response) > 32 and b'SIZE' in response:
-                # Skip file request
-                nack = struct.pack('!I', INVALID_PACKET)  # Use a specific value to indicate NACK
-                client.sendto(nack, addr)
-                continue
-            
-            if len(response) >= 4:
-                ack_num = struct.unpack('!I', response)[0]
-                if ack_num > base:
-                    old_base = base
-                    base = ack_num
-                    # Clear acknowledged packets
-                    for seq in range(old_base, base):
-                        window.pop(seq, None)
-        except socket.timeout:
-            continue
-        except Exception as e:
-            print(f"Warning in sliding window: {e}")  # Changed to warning
-            if "unpack requires" in str(e):
-                continue  # Skip invalid packets
-            return
-        
-        
-def sliding_window_recv(client, expected_seq, window_size):
-    """Improved sliding window receive with out-of-order buffering."""
-    global estimated_rtt, deviation, timeout_interval
-    received_packets = {}
-    buffer = {}
-
-    while True:
-        try:
-            client.settimeout(timeout_interval)
-            data, addr, next_seq = recv_rdt(client, expected_seq, buffer)
-            
-            if data:  # Only process if we got valid data
-                # Handle in-order packet
-                if next_seq == expected_seq + 1:
-                    yield {expected_seq: data}
-                    expected_seq = next_seq
-                    
-                    # Process buffered packets that are now in order
-                    while expected_seq in buffer:
-                        buffered_data = buffer.pop(expected_seq)
-                        yield {expected_seq: buffered_data}
-                        expected_seq += 1
-                # Handle out-of-order packet
-                elif next_seq > expected_seq + 1:
-                    buffer[next_seq-1] = data
-
-        except socket.timeout:
-            # print("Timeout while receiving packet")
-            continue
-        except Exception as e:
-            print(f"Error in sliding window receive: {e}")
-            continue
-        
-
-
 class AdaptiveWindow:
     def __init__(self, initial_size=10, min_size=5, max_size=50):
         self.window_size = initial_size
@@ -345,102 +631,405 @@ class AdaptiveWindow:
                 
         return self.window_size
 
-def modified_sliding_window_send(client, addr, packets, adaptive_window):
-    """Modified sliding window send with adaptive window size"""
-    global timeout_interval, estimated_rtt, deviation
-    base = 0
-    next_seq_num = 0
-    window = {}
-    max_seq_num = len(packets)
-    
-    while base < max_seq_num:
-        current_window_size = adaptive_window.window_size
+class SelectiveRepeatSender:
+    """Pipelined selective repeat sender.
+
+    Keeps up to window_size packets in flight and gives every packet its own
+    retransmission deadline in a heap. A single receive loop waits until the next
+    deadline, processes ACKs and retransmits only the packets whose timer expired.
+    New packets are released through the pacer (see pacing.py) at the controller's
+    pacing rate, so a window is spread over the round trip instead of sent as a burst.
+    With an FEC encoder (see fec.py) every block of new packets is followed by its parity,
+    with a packet sizer (see pmtu.py) new packets shrink while the receiver reports high loss.
+    New packets never go beyond the credit the receiver advertises in its SACKs, or with pull
+    beyond the ranges it grants. run() is the blocking loop over fill, on_response and expire;
+    async_rdt.py calls the same steps from an event loop instead.
+    """
+
+    def __init__(self, client, addr, packets, controller, pacer=None, fec=None, sizer=None, pull=False):
+        self.client = client
+        self.addr = addr
+        self.packets = packets
+        self.controller = controller  # AdaptiveWindow-like congestion controller, see congestion.py
+        self.pacer = pacer
+        self.fec = fec
+        self.sizer = sizer  # Needs packets that can be resized, see FilePacketizer.resize
+        self.rtt = session_rtt(client, addr)
+        self.first_seq = extract_seq_num(split_packet(packets[0])[0]) if packets else 0
+        self.header = bytearray(HEADER_SIZE)  # Reused for every transmission, see send_packet
+        self.base = 0  # Index of the oldest unacknowledged packet
+        self.next_index = 0  # Index of the next packet never sent
+        self.send_times = {}  # index -> time of the last transmission
+        self.stamps = {}  # timestamp of a transmission -> index, until its echo comes back
+        self.deadlines = {}  # index -> current retransmission deadline
+        self.retransmitted = set()
+        self.sacked = set()  # indexes above base the receiver already holds
+        self.fast_retransmitted = set()
+        self.duplicate_acks = 0
+        self.timers = []  # heap of (deadline, index), stale entries are skipped lazily
+        self.pull = pull
+        self.limit = 0 if pull else INITIAL_CREDIT  # Index of the first packet the receiver has no room for
+        self.grants = []  # granted (first, end) index ranges above limit, pull mode only
+        self.finished = False  # The receiver moved on to its next message
+
+    def transmit(self, index):
+        now = time.monotonic()
+        stamp = timestamp()
+        packet = self.packets[index]
+        send_packet(self.client, self.addr, packet, stamp, self.header)
+        if self.pacer is not None:
+            self.pacer.consume(packet_size(packet))
+        if index in self.send_times:
+            self.retransmitted.add(index)
+        if len(self.stamps) > 8 * RECEIVE_WINDOW:
+            self.stamps = {old: i for old, i in self.stamps.items() if i >= self.base}  # Echoes that never came
+        self.stamps[stamp] = index
+        self.send_times[index] = now
+        self.deadlines[index] = now + self.rtt.rto
+        heapq.heappush(self.timers, (self.deadlines[index], index))
+
+    def send_parity(self, index):
+        """Feed a new packet to the FEC encoder and send the parity of the block it completes."""
+        for parity in self.fec.add(self.packets[index], last=index == len(self.packets) - 1):
+            send_packet(self.client, self.addr, parity, timestamp(), self.header)
+            if self.pacer is not None:
+                self.pacer.consume(len(parity))
+
+    def echo_rtt(self, echo):
+        # The echo names the exact transmission that was acknowledged, retransmission or not
+        if echo is None or self.stamps.pop(echo, None) is None:
+            return None
+        rtt = echo_rtt(echo)
+        self.rtt.sample(rtt)
+        return rtt
+
+    def sample_rtt(self, index):
+        # Without a usable echo only packets sent once give an unambiguous RTT sample (Karn)
+        if index not in self.retransmitted and index in self.send_times:
+            rtt = time.monotonic() - self.send_times[index]
+            self.rtt.sample(rtt)
+            return rtt
+        return None
+
+    def on_ack(self, ack_num, selected=(), echo=None, loss=None, credit=None):
+        """Process a cumulative ACK, the sequence numbers it selectively acknowledges, its echoed
+        timestamp, the loss rate the receiver reports and the packets it has room for."""
+        if loss is not None and self.fec is not None:
+            self.fec.loss = loss
+        if loss is not None and self.sizer is not None:
+            self.resize(loss)
+        index = ack_num - self.first_seq
+        if index < self.base or index > self.next_index:
+            return False  # Old or bogus ACK
+
+        progress = index > self.base
+        window_update = credit is not None and not self.pull and index + credit > self.limit
+        if window_update:
+            self.limit = index + credit
+        newly_acked = 0
+        rtt = self.echo_rtt(echo)
+        if progress:
+            if rtt is None:
+                rtt = self.sample_rtt(index - 1)
+            newly_acked = index - self.base - sum(1 for sacked in self.sacked if sacked < index)
+            for acked in range(self.base, index):
+                self.send_times.pop(acked, None)
+                self.deadlines.pop(acked, None)
+                self.retransmitted.discard(acked)
+                self.sacked.discard(acked)
+                self.fast_retransmitted.discard(acked)
+            self.base = index
+            self.duplicate_acks = 0
+        elif window_update:
+            progress = True  # Not a duplicate ACK (RFC 5681), but the receiver is alive
+        else:
+            self.duplicate_acks += 1
+
+        newest_sacked = None
+        for seq_num in selected:
+            sacked = seq_num - self.first_seq
+            if self.base < sacked < self.next_index and sacked not in self.sacked:
+                self.sacked.add(sacked)
+                self.deadlines.pop(sacked, None)  # Its timer no longer matters
+                newest_sacked = sacked if newest_sacked is None else max(newest_sacked, sacked)
+                newly_acked += 1
+                progress = True
+        if newest_sacked is not None and rtt is None:
+            rtt = self.sample_rtt(newest_sacked)
+
+        if newly_acked:
+            self.controller.on_ack(newly_acked, rtt)
+        self.fast_retransmit()
+        return progress
+
+    def on_grant(self, first, end):
+        """The receiver grants the new packets of the sequence numbers [first, end)."""
+        first, end = first - self.first_seq, min(end - self.first_seq, len(self.packets))
+        if end <= self.limit:
+            return False
+        self.grants.append((first, end))
+        self.grants.sort()
+        while self.grants and self.grants[0][0] <= self.limit:
+            self.limit = max(self.limit, self.grants.pop(0)[1])
+        return True
+
+    def repair_end(self, index):
+        """Index of the first packet sent after the receiver had every chance to get packet index
+        without a retransmission: the next packet, or with FEC the one after its block's parity."""
+        if self.fec is None:
+            return index + 1
+        end = self.fec.repair_end(self.first_seq + index)
+        return len(self.packets) + 1 if end is None else end - self.first_seq
+
+    def resize(self, loss):
+        """Let the sizer pick the payload size of the packets not sent yet."""
+        size = self.sizer.on_loss(loss, self.next_index)
+        if size is not None and self.packets.resize(size, self.next_index) is not None:
+            self.controller.packet_size = size
+
+    def fast_retransmit(self):
+        """Resend holes without waiting for their timer: the first hole after DUP_ACK_THRESHOLD
+        duplicate ACKs, and any hole with DUP_ACK_THRESHOLD packets SACKed above its repair end.
+        With FEC duplicate ACKs are expected until the parity arrives, only SACKs count."""
+        lost = []
+        if self.duplicate_acks >= DUP_ACK_THRESHOLD and self.base not in self.fast_retransmitted and self.fec is None:
+            lost.append(self.base)
+
+        if len(self.sacked) >= DUP_ACK_THRESHOLD:
+            third = heapq.nlargest(DUP_ACK_THRESHOLD, self.sacked)[-1]
+            for index in range(self.base, third):
+                if (index not in self.sacked and index not in self.fast_retransmitted and index not in lost
+                        and self.repair_end(index) <= third):
+                    lost.append(index)
+
+        if lost:
+            self.controller.on_loss()
+        for index in lost:
+            self.fast_retransmitted.add(index)
+            self.transmit(index)
+
+    def expire(self):
+        now = time.monotonic()
+        expired = False
+        while self.timers and self.timers[0][0] <= now:
+            deadline, index = heapq.heappop(self.timers)
+            if self.deadlines.get(index) != deadline:
+                continue  # Already acknowledged or re-armed
+            if not expired:
+                self.controller.on_timeout()
+                self.rtt.backoff()
+                expired = True
+            self.transmit(index)
+
+    def in_flight(self):
+        return self.next_index - self.base - len(self.sacked)
+
+    def next_timeout(self):
+        if not self.timers:
+            return self.rtt.rto
+        return max(0.001, self.timers[0][0] - time.monotonic())
+
+    def can_send(self):
+        return (self.next_index < len(self.packets) and self.next_index < min(self.limit, self.base + RECEIVE_WINDOW)
+                and self.in_flight() < self.controller.window_size)
+
+    def pacing_delay(self):
+        """Seconds until the pacer lets the next new packet go (0: now)."""
+        if self.pacer is None:
+            return 0.0
+        self.pacer.set_rate(self.controller.pacing_rate)
+        return self.pacer.delay(packet_size(self.packets[self.next_index]))
+
+    def on_peer_packet(self, data, peer):
+        """A data packet from the receiver instead of an ACK."""
+        if not verify_packet(data) or not extract_message(data):
+            return False
+        if is_duplicate_message(self.client, peer, extract_message(data)):
+            # The receiver resends its request because our ACK of it was lost, acknowledge it again
+            self.client.sendto(ACK.pack(extract_seq_num(data) + 1, extract_stamp(data)), peer)
+            return False
+        if self.next_index >= len(self.packets):
+            # The receiver only moves on once it has everything, so our last ACKs were lost
+            unread_packet(self.client, bytes(data), peer)
+            return True
+        return False
+
+    def fill(self):
+        """Send new packets while the congestion window has room, never beyond what the receiver
+        can buffer. Returns the seconds until the pacer lets the next one go, 0 if a window is full."""
+        while self.can_send():
+            pacing_delay = self.pacing_delay()
+            if pacing_delay > 0:
+                return pacing_delay
+            self.transmit(self.next_index)
+            if self.fec is not None:
+                self.send_parity(self.next_index)
+            self.next_index += 1
+        return 0.0
+
+    def on_response(self, response, peer):
+        """Process a datagram of the receiver. Returns True if it shows the receiver is making progress."""
+        if is_sack(response):
+            sack = parse_sack(response)
+            return sack is not None and self.on_ack(*sack)
+        if len(response) == ACK.size:
+            ack_num, echo = ACK.unpack(response)
+            return ack_num != INVALID_PACKET and self.on_ack(ack_num, echo=echo)
+        if is_grant(response):
+            grant = parse_grant(response)
+            return grant is not None and self.on_grant(*grant)
+        if self.on_peer_packet(response, peer):
+            self.finished = True
+            return True
+        return False
+
+    def done(self):
+        return self.finished or self.base >= len(self.packets)
+
+    def run(self):
+        """Send every packet. Returns False if the receiver stopped responding."""
+        last_progress = time.monotonic()
         
-        # Send packets within the window
-        while next_seq_num < min(base + current_window_size, max_seq_num):
-            if next_seq_num not in window:
-                try:
-                    start_time = time.time()
-                    response = send_rdt(client, addr, packets[next_seq_num])
-                    rtt = time.time() - start_time
-                    
-                    if response is not None and response > base:
-                        # Successful transmission
-                        adaptive_window.update_window_size(rtt, packet_loss=False)
-                        old_base = base
-                        base = response
-                        for seq in range(old_base, base):
-                            window.pop(seq, None)
-                        
-                        # Calculate RTT dynamically
-                        sample_rtt = time.time() - start_time
-                        estimated_rtt = (1 - ALPHA) * estimated_rtt + ALPHA * sample_rtt
-                        deviation = (1 - BETA) * deviation + BETA * abs(sample_rtt - estimated_rtt)
-                        timeout_interval = max(MIN_TIMEOUT, min(MAX_TIMEOUT, estimated_rtt + 4 * deviation))
-                        
-                    else:
-                        # Failed transmission
-                        adaptive_window.update_window_size(rtt, packet_loss=True)
-                        
-                except Exception as e:
-                    print(f"Error sending packet {next_seq_num}: {e}")
-                    adaptive_window.update_window_size(timeout_interval, packet_loss=True)
-                    return
-                    
-            window[next_seq_num] = True
-            next_seq_num += 1
-
-def modified_sliding_window_recv(client, expected_seq, adaptive_window):
-    """Modified sliding window receive with adaptive window size"""
-    global timeout_interval, estimated_rtt, deviation
-    received_packets = {}
+        while not self.done():
+            pacing_delay = self.fill()
+            timeout = self.next_timeout()
+            if pacing_delay > 0:
+                if pacing_delay < SPIN_THRESHOLD and pacing_delay < timeout:
+                    # Too short for the socket timeout to be accurate, spin and send
+                    precise_sleep(time.perf_counter() + pacing_delay)
+                    continue
+                timeout = min(timeout, max(pacing_delay - SPIN_THRESHOLD, 0.0001))
+
+            try:
+                self.client.settimeout(timeout)
+                response, peer = receive_packet(self.client)
+                if self.on_response(response, peer):
+                    last_progress = time.monotonic()
+                if self.finished:
+                    return True
+            except socket.timeout:
+                if time.monotonic() - last_progress > MAX_IDLE:
+                    print(f"Receiver {self.addr} stopped responding.")
+                    return False
+
+            self.expire()
+        return True
+
+
+def modified_sliding_window_send(client, addr, packets, controller, pacer=None, fec=None, sizer=None, pull=False):
+    """Modified sliding window send with a congestion controlled window"""
+    return SelectiveRepeatSender(client, addr, packets, controller, pacer, fec, sizer, pull).run()
+
+
+def modified_sliding_window_recv(client, expected_seq, window_size=RECEIVE_WINDOW, fec=None,
+                                 ack_every=ACK_EVERY, ack_delay=ACK_DELAY, pull_from=None):
+    """Selective repeat receive: buffers out-of-order packets inside the window,
+    acknowledges with selective ACKs and yields {seq: data} in order.
+    In-order data is a memoryview into the receive ring, valid until the next item is requested.
+    With an FEC decoder (see fec.py) lost packets are rebuilt from parity packets.
+
+    ACKs are coalesced: one SACK covers ack_every in-order packets or goes out ack_delay
+    seconds after the first of them, whichever comes first. Anything the sender has to react
+    to is acknowledged at once: a new gap, a packet filling one, a duplicate (our ACK was lost)
+    and packets rebuilt by FEC. Close the generator when done, that sends the held back SACK.
+
+    Flow control: every SACK carries the credit of the receiver, the packets it has room for
+    from the consumer's position on (see receive_capacity). The consumer's position only moves
+    when it asks for the next item, so a consumer stuck writing to disk stops the sender
+    instead of overflowing the socket buffer. With pull_from (the sender's address) the
+    receiver pulls instead: the sender waits for explicit grants of sequence number ranges."""
     buffer = {}
-    last_received_time = time.time()
+    loss = LossMeter()
+    last_received_time = time.monotonic()
+    unacked = 0  # In-order packets received since the last SACK
+    ack_deadline = None
+    highest = expected_seq - 1  # Highest sequence number received
+    addr, echo = pull_from, 0
+    capacity = receive_capacity(client, window_size)
+    consumed = expected_seq  # Sequence number of the first packet the consumer has not taken yet
+    advertised = expected_seq  # Right edge of the credit last advertised or granted
+    update_after = max(1, min(GRANT_BATCH, capacity // 4)) if pull_from is not None else capacity // 4
 
-    while True:
-        try:
-            current_window_size = adaptive_window.window_size
-            client.settimeout(timeout_interval)
+    def acknowledge():
+        nonlocal unacked, ack_deadline, advertised
+        edge = consumed + capacity
+        client.sendto(make_sack(expected_seq, buffer, echo, loss.rate, edge - expected_seq), addr)
+        unacked, ack_deadline = 0, None
+        if pull_from is None:
+            advertised = edge
+
+    def grant():
+        nonlocal advertised
+        client.sendto(make_grant(expected_seq, consumed + capacity), addr)
+        advertised = consumed + capacity
+
+    try:
+        while True:
+            if addr is not None and consumed + capacity - advertised >= update_after:
+                # The consumer made room: grant it, or tell a sender that may be waiting for credit
+                if pull_from is not None:
+                    grant()
+                else:
+                    acknowledge()
+            try:
+                timeout = INITIAL_TIMEOUT
+                if ack_deadline is not None:
+                    timeout = max(ack_deadline - time.monotonic(), 0.0001)
+                client.settimeout(timeout)
+                data, addr = next_packet(client)
+            except socket.timeout:
+                if ack_deadline is not None and time.monotonic() >= ack_deadline:
+                    acknowledge()
+                elif time.monotonic() - last_received_time > MAX_IDLE:
+                    raise TimeoutError("sender stopped sending")
+                elif pull_from is not None:
+                    grant()  # Quiet: our last grant may have been lost
+                elif addr is not None:
+                    acknowledge()  # Quiet: our last window update may have been lost
+                continue
             
-            start_time = time.time()
-            data, addr, next_seq = recv_rdt(client, expected_seq, buffer)
-            rtt = time.time() - start_time
+            if not verify_packet(data) or extract_message(data) & MESSAGE_FLAG:
+                continue  # Corrupted or a late message, the sender's timer will resend it
+            last_received_time = time.monotonic()
             
-            if data:
-                # Update window size based on successful reception
-                adaptive_window.update_window_size(rtt, packet_loss=False)
-                last_received_time = time.time()
-                
-                # Handle in-order packet
-                if next_seq == expected_seq + 1:
-                    yield {expected_seq: data}
-                    expected_seq = next_seq
-                    
-                    # Process buffered packets that are now in order
-                    while expected_seq in buffer and len(buffer) <= current_window_size:
-                        buffered_data = buffer.pop(expected_seq)
-                        yield {expected_seq: buffered_data}
-                        expected_seq += 1
-                
-                # Handle out-of-order packet within window size
-                elif next_seq > expected_seq + 1 and next_seq <= expected_seq + current_window_size:
-                    buffer[next_seq-1] = data
-                    
-                # Clean up old buffered packets outside window
-                current_time = time.time()
-                if current_time - last_received_time > timeout_interval:
-                    # Packet loss detected, update window size
-                    adaptive_window.update_window_size(current_time - last_received_time, packet_loss=True)
-                    # Remove packets outside window
-                    buffer = {seq: data for seq, data in buffer.items() 
-                            if seq <= expected_seq + current_window_size}
-
-        except socket.timeout:
-            # Update window size on timeout
-            adaptive_window.update_window_size(timeout_interval, packet_loss=True)
-            continue
+            seq_num = extract_seq_num(data)
+            echo = extract_stamp(data)
+            if is_parity(data):
+                recovered = fec.on_parity(data, expected_seq) if fec is not None else {}
+                urgent = False
+            else:
+                loss.on_packet(seq_num)
+                recovered = {}
+                # A new gap, a filled hole or a duplicate, packets in order above a known hole can wait
+                urgent = seq_num != highest + 1 or seq_num in buffer
+                highest = max(highest, seq_num)
+                if seq_num == expected_seq:
+                    buffer[seq_num] = extract_data(data)  # Delivered before the ring comes around, no copy
+                elif expected_seq < seq_num < expected_seq + window_size and seq_num not in buffer:
+                    buffer[seq_num] = bytes(extract_data(data))  # Waits for the hole, copy it out of the ring
+                if fec is not None and seq_num >= expected_seq:
+                    recovered = fec.on_data(seq_num, buffer.get(seq_num, extract_data(data)), expected_seq)
+                unacked += 1
+            for seq, payload in recovered.items():
+                if expected_seq <= seq < expected_seq + window_size:
+                    buffer.setdefault(seq, payload)
+                    urgent = True
             
-        except Exception as e:
-            print(f"Error in sliding window receive: {e}")
-            adaptive_window.update_window_size(timeout_interval, packet_loss=True)
-            continue
\ No newline at end of file
+            # Deliver everything that is now in order
+            ready = []
+            while expected_seq in buffer:
+                ready.append((expected_seq, buffer.pop(expected_seq)))
+                expected_seq += 1
+            
+            # Acknowledge before yielding, the caller may take a while with the data
+            if urgent or unacked >= ack_every:
+                acknowledge()
+            elif unacked and ack_deadline is None:
+                ack_deadline = time.monotonic() + ack_delay
+            for seq_num, payload in ready:
+                yield {seq_num: payload}
+                consumed = seq_num + 1
+    finally:
+        if unacked and addr is not None:
+            with contextlib.suppress(OSError):
+                acknowledge()
@@ -0,0 +1,213 @@
+# Description: Multi-process UDP server, worker processes sharing the port with SO_REUSEPORT.
+#
+#   python workers.py --workers 4 [--async] [--host 0.0.0.0] [--port 12345]
+#
+# Check values, packetizing and the sender loops run in Python, so one server process stays
+# on one core however many sessions it multiplexes. Here the parent binds one socket per
+# worker to the port with SO_REUSEPORT, all of them before the first worker starts, and every
+# worker serves its socket like server_SR.py does (a thread per session, see sessions.py) or
+# with --async like async_server.py. Linux hands every datagram to the socket picked by a hash
+# of its flow (addresses and ports of both ends), so all datagrams of a session reach the
+# same worker as long as the group of sockets does not change. The parent keeps its copy of
+# every socket open, so the group never changes: a worker that dies is restarted on the same
+# socket, and the flows hashed to it are not moved to another worker in between.
+#
+# Every STATS_INTERVAL seconds the workers send server_SR.server_stats to the parent over a
+# pipe, and the parent prints the totals over all workers whenever they change, so they lag
+# by up to that interval. Without SO_REUSEPORT (Windows) the server runs as a single process.
+import argparse
+import asyncio
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import sys
+import threading
+import time
+import server_SR
+from sessions import Dispatcher
+from utils import tune_socket
+
+HAS_REUSEPORT = hasattr(socket, "SO_REUSEPORT")
+
+HOST = server_SR.HOST
+PORT = 12345
+FOLDER = server_SR.FOLDER
+FILE_LIST = server_SR.FILE_LIST
+WORKERS = os.cpu_count() or 1
+ASYNC = False  # Serve the sessions of a worker on an event loop (async_server.py) instead of threads
+STATS_INTERVAL = 5.0  # seconds between two statistics reports of a worker
+RESTART_DELAY = 1.0  # seconds before a worker that died is restarted
+
+
+def open_sockets(host, port, count):
+    """count UDP sockets bound to (host, port) in one SO_REUSEPORT group."""
+    sockets = []
+    try:
+        for _ in range(count):
+            sock = tune_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((host, port))
+    except OSError:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+
+def report_stats(conn, interval):
+    """Send the statistics of this worker to the parent every interval seconds."""
+    while True:
+        with server_SR.stats_lock:
+            snapshot = dict(server_SR.server_stats)
+        try:
+            conn.send(snapshot)
+        except OSError:
+            os._exit(1)  # The parent is gone, nobody restarts or stops us
+        time.sleep(interval)
+
+
+def serve_worker(index, sock, conn, folder, file_list, use_async, interval):
+    """Body of worker process index: serve the sessions that reach sock."""
+    server_SR.FOLDER, server_SR.FILE_LIST = folder, file_list  # Not inherited where workers are spawned, not forked
+    threading.Thread(target=report_stats, args=(conn, interval), daemon=True).start()
+    print(f"Worker {index} (pid {os.getpid()}) serving {sock.getsockname()}")
+    try:
+        if use_async:
+            import async_server  # Only workers need it
+            asyncio.run(async_server.serve(sock))
+        else:
+            Dispatcher(sock, server_SR.serve_session).run()
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool:
+    """Starts a worker process per socket, restarts those that die and sums their statistics."""
+
+    def __init__(self, host, port, workers, use_async=False, interval=STATS_INTERVAL):
+        self.sockets = open_sockets(host, port, workers)
+        self.address = self.sockets[0].getsockname()
+        self.use_async = use_async
+        self.interval = interval
+        self.processes = [None] * workers
+        self.conns = [None] * workers
+        self.stats = [{} for _ in range(workers)]  # Last report of every worker
+        self.retired = {}  # Totals of the workers that died, their replacements count from zero
+        self.restarts = 0
+
+    def start(self, index):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=serve_worker, daemon=True,
+                                          args=(index, self.sockets[index], sender, server_SR.FOLDER,
+                                                server_SR.FILE_LIST, self.use_async, self.interval))
+        process.start()
+        sender.close()
+        self.processes[index], self.conns[index] = process, receiver
+        self.stats[index] = {}
+
+    def collect(self, timeout):
+        """Read the reports that arrive within timeout seconds."""
+        conns = [conn for conn in self.conns if conn is not None]
+        for conn in multiprocessing.connection.wait(conns, timeout):
+            index = self.conns.index(conn)
+            try:
+                self.stats[index] = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                self.conns[index] = None  # Died, see restart_dead
+
+    def restart_dead(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            print(f"Worker {index} (pid {process.pid}) exited with {process.exitcode}, restarting.")
+            for key, value in self.stats[index].items():
+                if key != "active_sessions":
+                    self.retired[key] = self.retired.get(key, 0) + value
+            if self.conns[index] is not None:
+                self.conns[index].close()
+            time.sleep(RESTART_DELAY)
+            self.restarts += 1
+            self.start(index)
+
+    def totals(self):
+        """server_stats summed over every worker, with the sessions of every worker."""
+        totals = dict(self.retired)
+        for stats in self.stats:
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+        totals["workers"] = len(self.processes)
+        totals["restarts"] = self.restarts
+        totals["sessions_per_worker"] = [stats.get("sessions", 0) for stats in self.stats]
+        return totals
+
+    def run(self, duration=None):
+        for index in range(len(self.processes)):
+            self.start(index)
+        print(f"Server is running on {self.address[0]} : {self.address[1]} with {len(self.processes)} workers\n")
+        end = time.monotonic() + duration if duration else None
+        last = None
+        while end is None or time.monotonic() < end:
+            self.collect(self.interval)
+            self.restart_dead()
+            totals = self.totals()
+            if totals != last:
+                print(f"Totals: {json.dumps(totals)}")
+                last = totals
+
+    def stop(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
+        for sock in self.sockets:
+            sock.close()
+
+
+def run(workers=None, use_async=None):
+    workers = workers or WORKERS
+    use_async = ASYNC if use_async is None else use_async
+    server_SR.FOLDER, server_SR.FILE_LIST = FOLDER, FILE_LIST
+    if not HAS_REUSEPORT or workers == 1:
+        if use_async:
+            import async_server
+            async_server.HOST, async_server.PORT = HOST, PORT
+            async_server.FOLDER, async_server.FILE_LIST = FOLDER, FILE_LIST
+            async_server.run()
+        else:
+            server_SR.HOST, server_SR.PORT = HOST, PORT
+            server_SR.run()
+        return
+
+    pool = WorkerPool(HOST, PORT, workers, use_async)
+    try:
+        pool.run()
+    except KeyboardInterrupt:
+        print("\nServer interrupted by user.")
+    finally:
+        print("Server shutting down...")
+        pool.stop()
+        print(f"Totals: {json.dumps(pool.totals())}")
+
+
+def main(argv=None):
+    global HOST, PORT
+    parser = argparse.ArgumentParser(description="Serve reliable UDP from several processes sharing one port.")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes (default: one per CPU)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve the sessions of a worker on an event loop instead of threads")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args(argv)
+    HOST, PORT = args.host, args.port
+    run(args.workers, args.use_async or ASYNC)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())